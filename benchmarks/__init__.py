@@ -0,0 +1,6 @@
+### @package benchmarks
+#
+# Offline benchmarks of the submission pipeline.
+# Discord is replaced by the fakes in benchmarks.fakes, attachments are served by a local HTTP server.
+# Run with: python -m benchmarks.bench_pipeline --help
+#
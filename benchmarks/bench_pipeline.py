@@ -0,0 +1,240 @@
+import argparse
+import asyncio
+import math
+import os
+import shutil
+import tempfile
+import time
+from dataclasses import dataclass, field
+
+from benchmarks.cdn import FakeCDN
+from benchmarks.fakes import FakeAttachment, FakeBot, FakeDMChannel, FakeGuild, FakeMember, FakeMessage, snowflakes
+from discord_bot.cogs.picture_processor import PictureProcessor
+from discord_bot.database import Singleton, SingletonDatabase, TeamRecord
+from discord_bot.environment import BASE_GUILD
+from discord_bot.log_setup import start_logging
+
+### @package benchmarks.bench_pipeline
+#
+# Drives the cog with fake teams and messages and reports throughput and latencies.
+#
+# Per configuration (number of teams x attachment size) it measures:
+# - registering the teams in the database and looking members up
+# - live messages through on_message: messages/s, MB/s and p50/p99 latency from dispatch to the reaction
+# - flushing the changed records
+# - walking the DM history of all teams after a 'restart', via walk_dms
+#
+# Everything is written to a temporary folder, which is removed afterwards.
+#
+
+
+@dataclass
+class Config:
+    teams: int
+    size: int
+    messages_per_team: int
+    attachments_per_message: int
+    rate: float
+    image_stages: bool
+
+
+@dataclass
+class Result:
+    config: Config
+    add_team_us: float = 0
+    lookups_per_s: float = 0
+    messages: int = 0
+    unacknowledged: int = 0
+    messages_per_s: float = 0
+    mb_per_s: float = 0
+    ack_p50_ms: float = 0
+    ack_p99_ms: float = 0
+    flush_ms: float = 0
+    walked_messages: int = 0
+    walk_messages_per_s: float = 0
+    notes: list[str] = field(default_factory=list)
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return math.nan
+    values = sorted(values)
+    return values[max(0, math.ceil(p * len(values)) - 1)]
+
+
+def make_message(team_record: TeamRecord, cdn: FakeCDN, config: Config) -> FakeMessage:
+    attachments = []
+    for _ in range(config.attachments_per_message):
+        attachment_id = snowflakes.next()
+        attachments.append(FakeAttachment(attachment_id, cdn.url(attachment_id, config.size), config.size))
+    message = FakeMessage(team_record.founder, team_record.dm_channel, attachments)
+    team_record.dm_channel.messages.append(message)
+    return message
+
+
+def register_teams(bot: FakeBot, database: SingletonDatabase, config: Config, result: Result) -> list[TeamRecord]:
+    team_records = []
+    start = time.perf_counter()
+    for i in range(config.teams):
+        founder = FakeMember(snowflakes.next(), f"founder-{i}", bot.guild)
+        channel = FakeDMChannel(snowflakes.next(), founder)
+        bot.channels[channel.id] = channel
+
+        team_record = TeamRecord(team_name=f"team-{i}", founder=founder, other_members=set(), dm_channel=channel)
+        database.validate_team_record(team_record)
+        team_record.data_folder = f"data/{channel.id}"
+        database.add_record(team_record)
+        team_records.append(team_record)
+    result.add_team_us = (time.perf_counter() - start) / config.teams * 1e6
+
+    lookups = 100_000
+    start = time.perf_counter()
+    for i in range(lookups):
+        database.locate_member(team_records[i % len(team_records)].founder)
+    result.lookups_per_s = lookups / (time.perf_counter() - start)
+    return team_records
+
+
+async def live_messages(cog: PictureProcessor, team_records: list[TeamRecord], cdn: FakeCDN, config: Config,
+                        result: Result):
+    messages = [make_message(team_record, cdn, config)
+                for _ in range(config.messages_per_team) for team_record in team_records]
+
+    async def deliver(message: FakeMessage):
+        message.dispatched_at = time.perf_counter()
+        await cog.on_message(message)
+
+    served_before = cdn.served_bytes
+    start = time.perf_counter()
+    tasks = []
+    for message in messages:
+        tasks.append(asyncio.create_task(deliver(message)))
+        if config.rate:
+            await asyncio.sleep(1 / config.rate)
+    await asyncio.gather(*tasks)
+    # messages are acknowledged by the download queue
+    await cog.queue.wait_until_idle()
+    elapsed = time.perf_counter() - start
+
+    latencies = [(m.acknowledged_at - m.dispatched_at) * 1000 for m in messages if m.acknowledged_at is not None]
+    result.messages = len(messages)
+    result.unacknowledged = len(messages) - len(latencies)
+    result.messages_per_s = len(messages) / elapsed
+    result.mb_per_s = (cdn.served_bytes - served_before) / 1024 ** 2 / elapsed
+    result.ack_p50_ms = percentile(latencies, 0.5)
+    result.ack_p99_ms = percentile(latencies, 0.99)
+
+
+async def walk_history(cog: PictureProcessor, team_records: list[TeamRecord], cdn: FakeCDN, config: Config,
+                       result: Result):
+    """! Messages that arrived while the bot was 'offline', picked up by walk_dms """
+    for team_record in team_records:
+        for _ in range(config.messages_per_team):
+            make_message(team_record, cdn, config)
+
+    start = time.perf_counter()
+    await cog.walk_dms.start()
+    await cog.queue.wait_until_idle()
+    elapsed = time.perf_counter() - start
+    result.walked_messages = config.messages_per_team * len(team_records)
+    result.walk_messages_per_s = result.walked_messages / elapsed
+
+
+async def run(config: Config, cdn: FakeCDN, workdir: str) -> Result:
+    result = Result(config)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    # every run starts with fresh stages and an empty database
+    Singleton._instances.clear()
+    try:
+        bot = FakeBot(FakeGuild(BASE_GUILD))
+        database = SingletonDatabase(bot)
+        database.ensure_loaded()
+        await database.wait_until_ready()
+        team_records = register_teams(bot, database, config, result)
+        await database.flush_dirty_records()
+
+        cog = PictureProcessor(bot)
+        if not config.image_stages:
+            cog.previews.enabled = False
+            cog.phashes.enabled = False
+            cog.transcoder.enabled = False
+        # the first walk finds empty histories
+        await cog.dm_walk_task
+
+        await live_messages(cog, team_records, cdn, config, result)
+
+        start = time.perf_counter()
+        await database.flush_dirty_records()
+        result.flush_ms = (time.perf_counter() - start) * 1000
+
+        await walk_history(cog, team_records, cdn, config, result)
+
+        problems = database.check_consistency()
+        if problems:
+            result.notes.append(f"{len(problems)} consistency problems, e.g. {problems[0]}")
+
+        cog.save_records.cancel()
+        await cog.queue.stop()
+        cog.queue.close()
+        await cog.downloads.close()
+        database.close()
+    finally:
+        Singleton._instances.clear()
+        os.chdir(cwd)
+    return result
+
+
+def print_results(results: list[Result]):
+    header = (f"{'teams':>7} {'size KB':>8} {'msgs':>7} {'msgs/s':>8} {'MB/s':>8} {'p50 ms':>8} {'p99 ms':>8} "
+              f"{'flush ms':>9} {'walk msg/s':>11} {'add us':>7} {'lookup/s':>10}")
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r.config.teams:>7} {r.config.size / 1024:>8.0f} {r.messages:>7} {r.messages_per_s:>8.1f} "
+              f"{r.mb_per_s:>8.1f} {r.ack_p50_ms:>8.1f} {r.ack_p99_ms:>8.1f} {r.flush_ms:>9.1f} "
+              f"{r.walk_messages_per_s:>11.1f} {r.add_team_us:>7.1f} {r.lookups_per_s:>10.0f}")
+        if r.unacknowledged:
+            print(f"        {r.unacknowledged} messages were not acknowledged")
+        for note in r.notes:
+            print(f"        {note}")
+
+
+async def main_async(args: argparse.Namespace) -> list[Result]:
+    cdn = FakeCDN()
+    await cdn.start()
+    results = []
+    try:
+        for size_kb in args.size_kb:
+            for teams in args.teams:
+                config = Config(teams, size_kb * 1024, args.messages, args.attachments, args.rate, args.image_stages)
+                workdir = tempfile.mkdtemp(prefix="bench-", dir=args.workdir)
+                try:
+                    results.append(await run(config, cdn, workdir))
+                finally:
+                    if not args.keep:
+                        shutil.rmtree(workdir, ignore_errors=True)
+    finally:
+        await cdn.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the submission pipeline without Discord")
+    parser.add_argument("--teams", type=int, nargs="+", default=[10, 100, 1000], help="team counts to run")
+    parser.add_argument("--size-kb", type=int, nargs="+", default=[256], help="attachment sizes to run")
+    parser.add_argument("--messages", type=int, default=2, help="live and offline messages per team")
+    parser.add_argument("--attachments", type=int, default=2, help="attachments per message")
+    parser.add_argument("--rate", type=float, default=0, help="live messages per second, 0 sends all at once")
+    parser.add_argument("--image-stages", action="store_true",
+                        help="keep previews, perceptual hashes and transcoding on (needs real images to be useful)")
+    parser.add_argument("--workdir", default=None, help="where to create the temporary data folders")
+    parser.add_argument("--keep", action="store_true", help="don't delete the data folders afterwards")
+    args = parser.parse_args()
+    start_logging(to_file=False)
+
+    print_results(asyncio.run(main_async(args)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+import os
+from collections import Counter
+
+from aiohttp import web
+
+### @package benchmarks.cdn
+#
+# Local stand-in for Discord's attachment CDN.
+# GET /attachments/<attachment id>/<size> returns <size> bytes that start like a PNG.
+# The attachment id is part of the content, so every attachment has its own hash and nothing is deduplicated.
+#
+
+PNG_MAGIC = b"\x89PNG\r\n\x1a\n"
+
+
+class FakeCDN:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.host = host
+        self.port = port
+        self.bodies: dict[int, bytes] = {}
+        self.served_bytes = 0
+        # attachment id to number of requests, more than one means a duplicate download
+        self.requests: Counter[int] = Counter()
+        self.runner: web.AppRunner = None
+
+    def url(self, attachment_id: int, size: int) -> str:
+        return f"http://{self.host}:{self.port}/attachments/{attachment_id}/{size}"
+
+    def __body(self, size: int) -> bytes:
+        # random bytes don't compress, generated once per size
+        if size not in self.bodies:
+            self.bodies[size] = os.urandom(size)
+        return self.bodies[size]
+
+    async def __serve(self, request: web.Request) -> web.Response:
+        attachment_id = request.match_info["attachment_id"]
+        size = int(request.match_info["size"])
+        self.requests[int(attachment_id)] += 1
+        head = PNG_MAGIC + attachment_id.encode()
+        body = head + self.__body(size)[len(head):]
+        self.served_bytes += len(body)
+        return web.Response(body=body, content_type="image/png")
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/attachments/{attachment_id}/{size}", self.__serve)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        # port 0 picks a free port
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
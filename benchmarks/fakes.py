@@ -0,0 +1,193 @@
+import datetime as dt
+import itertools
+import time
+from types import SimpleNamespace
+
+import discord
+
+### @package benchmarks.fakes
+#
+# Minimal stand-ins for the discord objects the bot touches.
+# They only implement what the cog and the database use, nothing talks to Discord.
+#
+
+
+class SnowflakeClock:
+    """! Hands out increasing snowflakes based on the current time, like Discord does """
+
+    def __init__(self):
+        self.last = 0
+
+    def next(self, when: dt.datetime = None) -> int:
+        snowflake = discord.utils.time_snowflake(when or discord.utils.utcnow())
+        self.last = max(self.last + 1, snowflake)
+        return self.last
+
+
+snowflakes = SnowflakeClock()
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int, name: str = "Benchmark guild"):
+        self.id = guild_id
+        self.name = name
+        self.members: dict[int, FakeMember] = {}
+
+    @property
+    def member_count(self) -> int:
+        return len(self.members)
+
+    def get_member(self, member_id: int) -> "FakeMember | None":
+        return self.members.get(member_id)
+
+
+class FakeMember:
+    """! Compares and hashes by id like discord.Member """
+
+    def __init__(self, member_id: int, name: str, guild: FakeGuild):
+        self.id = member_id
+        self.name = name
+        self.guild = guild
+        self.bot = False
+        guild.members[member_id] = self
+        # opened on the first DM, like Discord does
+        self.dm_channel: FakeDMChannel = None
+
+    @property
+    def mention(self) -> str:
+        return f"<@{self.id}>"
+
+    async def send(self, content: str = None, **kwargs) -> "FakeMessage":
+        if self.dm_channel is None:
+            self.dm_channel = FakeDMChannel(snowflakes.next(), self)
+        await self.dm_channel.send(content, **kwargs)
+        return FakeMessage(self, self.dm_channel, [])
+
+    def __eq__(self, other) -> bool:
+        return getattr(other, "id", None) == self.id
+
+    def __hash__(self) -> int:
+        return self.id >> 22
+
+    def __str__(self) -> str:
+        return self.name
+
+
+class FakeAttachment:
+    def __init__(self, attachment_id: int, url: str, size: int, content_type: str = "image/png"):
+        self.id = attachment_id
+        self.url = url
+        self.size = size
+        self.content_type = content_type
+        self.filename = f"{attachment_id}.png"
+
+
+class FakeMessage:
+    """! Remembers when it was dispatched and when the bot reacted to it """
+
+    def __init__(self, author: FakeMember, channel: "FakeDMChannel", attachments: list[FakeAttachment],
+                 content: str = ""):
+        self.created_at = discord.utils.utcnow()
+        self.id = snowflakes.next(self.created_at)
+        self.author = author
+        self.channel = channel
+        self.attachments = attachments
+        self.content = content
+        self.reactions: list[str] = []
+        # perf_counter timestamps
+        self.dispatched_at: float = None
+        self.acknowledged_at: float = None
+
+    async def add_reaction(self, emoji: str):
+        self.reactions.append(emoji)
+        if self.acknowledged_at is None:
+            self.acknowledged_at = time.perf_counter()
+
+
+class FakeDMChannel(discord.DMChannel):
+    """!
+    Subclasses DMChannel so isinstance checks pass, none of the real attributes are set up.
+    The history is what was 'sent' to the channel, oldest first.
+    """
+
+    def __init__(self, channel_id: int, recipient: FakeMember):
+        self.id = channel_id
+        self.recipients = [recipient]
+        self.messages: list[FakeMessage] = []
+        self.sent: list[str] = []
+
+    def __repr__(self) -> str:
+        return f"<FakeDMChannel id={self.id}>"
+
+    async def send(self, content: str = None, **kwargs):
+        self.sent.append(content)
+
+    def get_partial_message(self, message_id: int) -> "FakeMessage":
+        return next(m for m in self.messages if m.id == message_id)
+
+    async def fetch_message(self, message_id: int) -> "FakeMessage":
+        return self.get_partial_message(message_id)
+
+    async def history(self, limit: int = None, after=None, oldest_first: bool = False, **kwargs):
+        if isinstance(after, dt.datetime):
+            after = discord.Object(id=discord.utils.time_snowflake(after, high=True))
+        messages = [m for m in self.messages if after is None or m.id > after.id]
+        if not oldest_first:
+            messages.reverse()
+        for message in itertools.islice(messages, limit):
+            yield message
+
+
+class FakeResponse:
+    def __init__(self):
+        self.messages: list[dict] = []
+        self.deferred = False
+
+    def is_done(self) -> bool:
+        return self.deferred or bool(self.messages)
+
+    async def send_message(self, content: str = None, **kwargs):
+        self.messages.append({"content": content, **kwargs})
+
+    async def defer(self, **kwargs):
+        self.deferred = True
+
+
+class FakeFollowup:
+    def __init__(self):
+        self.messages: list[dict] = []
+
+    async def send(self, content: str = None, **kwargs):
+        self.messages.append({"content": content, **kwargs})
+
+
+class FakeInteraction:
+    """! A slash command invocation by user """
+
+    def __init__(self, user: FakeMember, command_name: str):
+        self.user = user
+        self.command = SimpleNamespace(name=command_name)
+        self.response = FakeResponse()
+        self.followup = FakeFollowup()
+
+
+class FakeBot:
+    """! What the cog and the database use of commands.Bot """
+
+    def __init__(self, guild: FakeGuild):
+        self.guild = guild
+        self.user = FakeMember(snowflakes.next(), "benchmark-bot", guild)
+        self.channels: dict[int, FakeDMChannel] = {}
+        self.latency = 0.0
+
+    def get_guild(self, guild_id: int) -> FakeGuild | None:
+        return self.guild if guild_id == self.guild.id else None
+
+    def get_channel(self, channel_id: int) -> FakeDMChannel | None:
+        return self.channels.get(channel_id)
+
+    def get_partial_messageable(self, channel_id: int, **kwargs) -> FakeDMChannel | None:
+        return self.channels.get(channel_id)
+
+    async def wait_until_ready(self):
+        return
@@ -0,0 +1,205 @@
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmarks.bench_pipeline import percentile
+from benchmarks.cdn import FakeCDN
+from benchmarks.fakes import (FakeAttachment, FakeBot, FakeDMChannel, FakeGuild, FakeInteraction, FakeMember,
+                              FakeMessage, snowflakes)
+from discord_bot.cogs.picture_processor import PictureProcessor
+from discord_bot.database import Singleton, SingletonDatabase
+from discord_bot.environment import BASE_GUILD
+from discord_bot.log_setup import start_logging
+from discord_bot.recorder import read_recording
+
+### @package benchmarks.replay
+#
+# Feeds a recording (see discord_bot.recorder) back into the cog, at the recorded pace, N times faster or as fast as possible.
+# Every event runs as its own task, like discord.py dispatches them, so the races of the event can happen again.
+# Afterwards the state is checked:
+# - the member index matches the teams and no team name is taken twice
+# - no attachment was downloaded more than once
+# - a restart (walk of all DMs) doesn't find anything that was missed
+# - the records loaded from disk match the ones in memory
+#
+
+
+class Replayer:
+    def __init__(self, cdn: FakeCDN, speed: float, image_stages: bool = False):
+        self.cdn = cdn
+        self.speed = speed
+        self.image_stages = image_stages
+        self.bot = FakeBot(FakeGuild(BASE_GUILD))
+        self.members: dict[int, FakeMember] = {}
+        # recorded ids to the ids used in the replay, new snowflakes keep the order but fit the replay's clock
+        self.message_ids: dict[int, int] = {}
+        self.attachment_ids: dict[int, int] = {}
+        self.messages: list[FakeMessage] = []
+        self.cog: PictureProcessor = None
+        self.database: SingletonDatabase = None
+
+    def member(self, member_id: int) -> FakeMember:
+        if member_id not in self.members:
+            member = FakeMember(member_id, f"member-{member_id}", self.bot.guild)
+            member.dm_channel = FakeDMChannel(snowflakes.next(), member)
+            self.bot.channels[member.dm_channel.id] = member.dm_channel
+            self.members[member_id] = member
+        return self.members[member_id]
+
+    def make_message(self, event: dict) -> FakeMessage:
+        author = self.member(event["a"])
+        attachments = []
+        for attachment_id, size, content_type in event["att"]:
+            replay_id = self.attachment_ids.setdefault(attachment_id, snowflakes.next())
+            attachments.append(FakeAttachment(replay_id, self.cdn.url(replay_id, size), size, content_type))
+
+        message = FakeMessage(author, author.dm_channel, attachments)
+        # the same message might have been recorded twice
+        if event["id"] in self.message_ids:
+            message.id = self.message_ids[event["id"]]
+        else:
+            self.message_ids[event["id"]] = message.id
+            author.dm_channel.messages.append(message)
+        return message
+
+    async def dispatch(self, event: dict):
+        kind = event["k"]
+        if kind == "m":
+            message = self.make_message(event)
+            self.messages.append(message)
+            message.dispatched_at = time.perf_counter()
+            await self.cog.on_message(message)
+        elif kind == "r":
+            interaction = FakeInteraction(self.member(event["u"]), "register")
+            members = {f"member{i + 1}": self.member(member_id) for i, member_id in enumerate(event["m"][:23])}
+            await self.cog.register.callback(self.cog, interaction, event["n"], **members)
+        elif kind == "l":
+            await self.cog.leave.callback(self.cog, FakeInteraction(self.member(event["u"]), "leave"))
+        elif kind == "w":
+            await self.cog.which_team.callback(self.cog, FakeInteraction(self.member(event["u"]), "which_team"))
+
+    async def replay(self, events: list[dict]) -> float:
+        """! Dispatch all events at their (scaled) time, returns the duration """
+        start = time.perf_counter()
+        tasks = []
+        for event in events:
+            if self.speed:
+                delay = event["t"] / self.speed - (time.perf_counter() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            else:
+                # let earlier events make progress, like a busy gateway would
+                await asyncio.sleep(0)
+            tasks.append(asyncio.create_task(self.dispatch(event)))
+
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for event, result in zip(events, results):
+            if isinstance(result, BaseException):
+                print(f"Event {event} failed: {result!r}", file=sys.stderr)
+        return time.perf_counter() - start
+
+    def state(self) -> dict[str, tuple[list[int], list[str]]]:
+        return {t.team_name: (sorted(t.member_ids), sorted(t.manifest)) for t in self.database.teams.values()}
+
+    async def run(self, events: list[dict]) -> list[str]:
+        problems = []
+        self.database = SingletonDatabase(self.bot)
+        self.database.ensure_loaded()
+        await self.database.wait_until_ready()
+
+        self.cog = PictureProcessor(self.bot)
+        if not self.image_stages:
+            self.cog.previews.enabled = False
+            self.cog.phashes.enabled = False
+            self.cog.transcoder.enabled = False
+        self.cog.recorder.enabled = False
+        # the rate limits apply to the recorded pace, not to the replay's
+        if self.speed:
+            self.cog.limiter.window /= self.speed
+        else:
+            self.cog.limiter.max_attachments = self.cog.limiter.max_bytes = 0
+        await self.cog.dm_walk_task
+
+        start = time.perf_counter()
+        await self.replay(events)
+        # messages are acknowledged by the download queue
+        await self.cog.queue.wait_until_idle()
+        duration = time.perf_counter() - start
+        latencies = [(m.acknowledged_at - m.dispatched_at) * 1000 for m in self.messages if m.acknowledged_at]
+        print(f"Replayed {len(events)} events in {duration:.1f}s ({len(events) / duration:.1f} events/s), "
+              f"{len(self.database.teams)} teams, {len(latencies)} of {len(self.messages)} messages acknowledged, "
+              f"ack p50 {percentile(latencies, 0.5):.1f}ms, p99 {percentile(latencies, 0.99):.1f}ms")
+
+        problems += self.database.check_consistency()
+        names = [t.team_name for t in self.database.teams.values()]
+        if len(names) != len(set(names)):
+            problems.append("A team name is used by more than one team")
+        problems += [f"Attachment {attachment_id} was downloaded {count} times"
+                     for attachment_id, count in self.cdn.requests.items() if count > 1]
+
+        # like a restart: everything in the DMs must be saved already
+        requests_before = sum(self.cdn.requests.values())
+        await self.cog.walk_dms.start()
+        await self.cog.queue.wait_until_idle()
+        missed = sum(self.cdn.requests.values()) - requests_before
+        if missed:
+            problems.append(f"The walk after the replay downloaded {missed} attachments that were missed live")
+
+        # what's on disk must match what's in memory
+        in_memory = self.state()
+        self.cog.save_records.cancel()
+        await self.cog.queue.stop()
+        self.cog.queue.close()
+        await self.cog.downloads.close()
+        self.database.close()
+        Singleton._instances.clear()
+        self.database = SingletonDatabase(self.bot)
+        self.database.ensure_loaded()
+        await self.database.wait_until_ready()
+        if self.state() != in_memory:
+            problems.append("The records loaded from disk differ from the ones in memory")
+        self.database.close()
+        return problems
+
+
+async def main_async(args: argparse.Namespace) -> list[str]:
+    events = list(read_recording(args.recording))
+    cdn = FakeCDN()
+    await cdn.start()
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="replay-", dir=args.workdir)
+    os.chdir(workdir)
+    Singleton._instances.clear()
+    try:
+        return await Replayer(cdn, args.speed, args.image_stages).run(events)
+    finally:
+        Singleton._instances.clear()
+        os.chdir(cwd)
+        await cdn.close()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recording of DMs and commands against a local stand-in")
+    parser.add_argument("recording", help="file written by the bot with RECORD_EVENTS set")
+    parser.add_argument("--speed", type=float, default=1, help="1 = recorded pace, N = N times faster, 0 = max. speed")
+    parser.add_argument("--image-stages", action="store_true", help="keep previews, perceptual hashes and transcoding on")
+    parser.add_argument("--workdir", default=None, help="where to create the temporary data folder")
+    parser.add_argument("--keep", action="store_true", help="don't delete the data folder afterwards")
+    args = parser.parse_args()
+    start_logging(to_file=False)
+
+    problems = asyncio.run(main_async(args))
+    for problem in problems:
+        print(f"PROBLEM: {problem}")
+    print("State is consistent" if not problems else f"{len(problems)} problems found")
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -35,6 +35,11 @@ setup(
 
     install_requires=dependencies,
 
+    extras_require={
+        # transcoding and other image processing
+        'images': ['Pillow', 'pillow-heif'],
+    },
+
     classifiers=[
 
         'Development Status :: 5 - Production/Stable',
@@ -61,6 +66,8 @@ setup(
     entry_points={
         'console_scripts': [
             'discord-bot=discord_bot:main',
+            'discord-bot-export=discord_bot.export:main',
+            'discord-bot-gallery=discord_bot.gallery:main',
         ],
     },
 )
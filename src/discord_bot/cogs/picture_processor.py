@@ -1,6 +1,5 @@
 import asyncio
-import atexit
-import os.path
+import time
 from typing import Literal, Optional
 
 import discord
@@ -8,10 +7,19 @@ from discord import app_commands, Forbidden
 from discord.ext import commands
 from discord.ext import tasks
 
-from discord_bot.environment import BASE_GUILD
+from discord_bot import metrics
+from discord_bot.environment import BASE_GUILD, BACKFILL_CONCURRENCY, OWNER_ID, DUPLICATE_DISTANCE
 from discord_bot.log_setup import logger
 from discord_bot.utils import utils as ut
 from discord_bot.database import SingletonDatabase, TeamRecord
+from discord_bot.download_queue import DownloadJob, DownloadQueue
+from discord_bot.downloads import DownloadPipeline, SavedAttachment
+from discord_bot.export import Exporter
+from discord_bot.limits import TeamLimiter
+from discord_bot.phash import PerceptualIndex
+from discord_bot.previews import PreviewGenerator
+from discord_bot.recorder import EventRecorder
+from discord_bot.transcoding import Transcoder
 
 
 ### @package misc
@@ -32,16 +40,53 @@ class PictureProcessor(commands.Cog):
         self.storage: dict[discord.member, set[discord.Message]] = {}
         self.data_path = datat_path
         self.database = SingletonDatabase(self.bot)
-        # TODO: race condition when team isn't loaded but a team is created in that time (actually not a irl problem)
-        #  solution: check if path exists and then load that team and raise error based on it
-        if not self.database.teams:
-            asyncio.create_task(self.database.load_records_from_files())
+        self.downloads = DownloadPipeline()
+        self.queue = DownloadQueue(self.database, self.downloads)
+        self.limiter = TeamLimiter()
+        self.transcoder = Transcoder(self.database)
+        self.previews = PreviewGenerator()
+        self.phashes = PerceptualIndex()
+        self.recorder = EventRecorder()
+        self.phashes.ensure_loaded()
+        self.__register_metrics()
+        # commands and messages wait for the database to be ready, so they never see a half loaded state
+        self.database.ensure_loaded()
+        # the queue outlives reloads, the images it saves go to the current cog
+        self.queue.on_saved = self.__image_saved
+        self.queue.on_finished = lambda job: self.limiter.release(job.data_folder, job.key)
+        self.queue.ensure_started()
 
         self.dm_walk_task = self.walk_dms.start()
         self.save_records.start()
-        atexit.register(self.shutdown_procedure)
         logger.info("Loaded.")
 
+    async def cog_unload(self):
+        # a reload creates a new cog with its own loops
+        self.save_records.cancel()
+        self.walk_dms.cancel()
+
+    def __register_metrics(self):
+        """! Backlogs of the stages are read when scraped, the functions are replaced on a reload """
+        metrics.pipeline_jobs.set_function(lambda: self.downloads.queued, stage="download_queued")
+        metrics.pipeline_jobs.set_function(lambda: self.downloads.in_flight, stage="download_in_flight")
+        metrics.pipeline_jobs.set_function(lambda: len(self.queue.in_flight), stage="download_window")
+        metrics.pipeline_jobs.set_function(lambda: self.previews.queue.qsize(), stage="previews")
+        metrics.pipeline_jobs.set_function(lambda: len(self.transcoder.tasks), stage="transcoding")
+        metrics.pipeline_jobs.set_function(lambda: len(self.phashes.tasks), stage="perceptual_hashes")
+
+    async def __wait_for_database(self, interaction: discord.Interaction) -> bool:
+        """!
+        Wait for the database to be restored, interactions must be answered within 3 seconds though
+        @return True if the database is ready, False if the user was told to try again
+        """
+        try:
+            await asyncio.wait_for(self.database.wait_until_ready(), timeout=2)
+            return True
+        except asyncio.TimeoutError:
+            await interaction.response.send_message(
+                "I'm still loading all teams, please try again in a few seconds.", ephemeral=True)
+            return False
+
 
     @app_commands.command(name=register_command_name, description="Create a team")
     # @app_commands.guild_only
@@ -88,6 +133,9 @@ class PictureProcessor(commands.Cog):
                 value=f"Reason: {e}, you can leave a team using `/{unregister_command}`. You're NOT able to join an existing team.",
                 color=ut.red)
 
+        if not await self.__wait_for_database(interaction):
+            return
+
         # let me make up for the hell above by doing even more horrible things, but it's for the better. trust me.
         other_members_set = set()
         for member_i in range(1, 24):
@@ -96,6 +144,7 @@ class PictureProcessor(commands.Cog):
         # ensure that we don't have the bot and None there
         # TODO: maybe check that other users ain't other bots
         other_members_set = other_members_set - {None, self.bot.user}
+        self.recorder.register(interaction, team_name, other_members_set)
 
         # check if all members are not registered in an other team and if the name is still available
         try:
@@ -149,6 +198,10 @@ class PictureProcessor(commands.Cog):
 
     @app_commands.command(name="which_team", description="Get the information in which team you're in.")
     async def which_team(self, interaction: discord.Interaction):
+        self.recorder.which_team(interaction)
+        if not await self.__wait_for_database(interaction):
+            return
+
         team_record = self.database.locate_member(interaction.user)
         if team_record is None:
             await interaction.response.send_message(f"You're currently not part of a team.", ephemeral=True)
@@ -167,6 +220,10 @@ class PictureProcessor(commands.Cog):
 
     @app_commands.command(name=unregister_command, description="Leave your team. You CAN'T JOIN an existing team!")
     async def leave(self, interaction: discord.Interaction):
+        self.recorder.leave(interaction)
+        if not await self.__wait_for_database(interaction):
+            return
+
         member = interaction.user
         team_record = self.database.locate_member(member)
         if team_record is None:
@@ -209,57 +266,226 @@ class PictureProcessor(commands.Cog):
         )
 
 
-    async def process_dm_message(self, m: discord.Message):
+    @staticmethod
+    async def __is_admin(interaction: discord.Interaction) -> bool:
+        if interaction.user.id != OWNER_ID:
+            logger.warning(f"User {interaction.user} tried /{interaction.command.name} (unauthorized)")
+            await interaction.response.send_message("This command is for the bot owner only.", ephemeral=True)
+            return False
+        return True
+
+    @app_commands.command(name="previews", description="Admin only. Render previews of all stored images.")
+    async def previews_backfill(self, interaction: discord.Interaction):
+        if not await self.__is_admin(interaction) or not await self.__wait_for_database(interaction):
+            return
+
+        if not self.previews.enabled:
+            await interaction.response.send_message("Pillow is not installed, can't render previews.", ephemeral=True)
+            return
+
+        await interaction.response.send_message("Rendering previews in the background, see the log for progress.",
+                                                ephemeral=True)
+        count = await self.previews.backfill(self.database)
+        await self.previews.queue.join()
+        logger.info(f"Preview backfill of {count} images done: {self.previews.stats()}")
+
+    @app_commands.command(name="duplicates", description="Admin only. List images that were submitted by several teams.")
+    async def duplicates(self, interaction: discord.Interaction, max_distance: int = DUPLICATE_DISTANCE, limit: int = 20):
+        if not await self.__is_admin(interaction) or not await self.__wait_for_database(interaction):
+            return
+
+        if not self.phashes.enabled:
+            await interaction.response.send_message("Pillow is not installed, can't compare images.", ephemeral=True)
+            return
+
+        # hashing missing images can take a while
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        await self.phashes.backfill(self.database)
+        active_founders = {founder.id for founder in self.database.teams}
+        pairs = await self.phashes.find_cross_team_duplicates(max_distance, active_founders)
+
+        if not pairs:
+            await interaction.followup.send(f"No duplicates across teams within a distance of {max_distance}.",
+                                            ephemeral=True)
+            return
+
+        lines = [f"**{len(pairs)}** suspected duplicates across teams (distance <= {max_distance}):"]
+        for distance, image, other in pairs[:limit]:
+            line = (f"`{distance:2}` '{image.team_name}' `{image.file.rsplit('/', 1)[-1]}` <-> "
+                    f"'{other.team_name}' `{other.file.rsplit('/', 1)[-1]}`")
+            # discord messages are limited to 2000 characters
+            if sum(len(l) + 1 for l in lines) + len(line) > 1900:
+                break
+            lines.append(line)
+        await interaction.followup.send("\n".join(lines), ephemeral=True)
+
+    @app_commands.command(name="export", description="Admin only. Write an archive of the submissions to the bot's disk.")
+    async def export(self, interaction: discord.Interaction, team_name: Optional[str] = None,
+                     archive_format: Literal["zip", "tar"] = "zip", full: bool = False):
+        if not await self.__is_admin(interaction) or not await self.__wait_for_database(interaction):
+            return
+
+        # copy the records on the loop, the archive is written in a thread
+        teams = [(t.to_json(), dict(t.manifest)) for t in self.database.teams.values()
+                 if team_name is None or t.team_name == team_name]
+        if not teams:
+            await interaction.response.send_message(f"There is no active team named '{team_name}'.", ephemeral=True)
+            return
+
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        result = await asyncio.to_thread(Exporter().export, teams, archive_format, not full, team_name or "all")
+        if result.path is None:
+            await interaction.followup.send("Nothing new to export.", ephemeral=True)
+            return
+
+        await interaction.followup.send(
+            f"Wrote {result.images} images ({result.bytes / 1024 ** 2:.1f} MB) of {result.teams} teams to `{result.path}`"
+            + (f", {result.missing} files were missing." if result.missing else "."),
+            ephemeral=True)
+
+    @app_commands.command(name="downloads", description="Admin only. Show stuck and failed downloads.")
+    async def download_jobs(self, interaction: discord.Interaction,
+                            action: Literal["status", "retry", "drop"] = "status", limit: int = 10):
+        if not await self.__is_admin(interaction):
+            return
+
+        if action == "retry":
+            count = await self.queue.requeue_dead()
+            await interaction.response.send_message(f"Queued {count} dead downloads again.", ephemeral=True)
+            return
+        if action == "drop":
+            count = await self.queue.drop_dead()
+            await interaction.response.send_message(f"Dropped {count} dead downloads.", ephemeral=True)
+            return
+
+        counts = await asyncio.to_thread(self.queue.store.counts)
+        troubled = await asyncio.to_thread(self.queue.store.troubled, limit)
+        lines = [f"**{counts.get('pending', 0)}** pending, **{len(self.queue.in_flight)}** running, "
+                 f"**{counts.get('dead', 0)}** dead. Since start: {self.queue.completed} done, "
+                 f"{self.queue.retried} retries, {self.queue.dead} given up.",
+                 "Downloader: " + ", ".join(f"{count} {name.replace('_', ' ')}"
+                                            for name, count in self.downloads.stats().items())]
+        for job, running_for in self.queue.stuck()[:limit]:
+            lines.append(f"running for {running_for:.0f}s: `{job.key}` of `{job.data_folder}`")
+        for job in troubled:
+            lines.append(f"{job.state}, {job.attempts} attempts: `{job.key}` of `{job.data_folder}` - {job.last_error}")
+
+        text = ""
+        for line in lines:
+            # discord messages are limited to 2000 characters
+            if len(text) + len(line) > 1900:
+                break
+            text += line + "\n"
+        await interaction.response.send_message(text, ephemeral=True)
+
+    def __image_saved(self, team_record: TeamRecord, job: DownloadJob, result: SavedAttachment):
+        """! Record an image the download queue saved and hand it to the image stages """
+        self.database.record_image(team_record, job.message_id, job.attachment_id, result.file_name, result.size,
+                                   result.sha256, job.author_id, job.created)
+        # a transcoded image replaces the saved file, the transcoder hands the final file on
+        if not self.transcoder.submit(team_record, job.key, team_record.manifest[job.key]):
+            self.previews.submit(result.file_name, result.sha256)
+            self.phashes.submit(team_record, result.file_name, result.sha256)
+
+    async def process_dm_message(self, m: discord.Message, live: bool = True) -> bool:
+        """!
+        Queue all new images of a message for download, the queue reacts to the message once they're saved
+        @param m message to process
+        @param live False when called by the backfill, live messages are handled with priority
+        @return True if all images of the message are durably queued or saved (or there were none)
+        """
 
         # ignore own messages
         if m.author == self.bot.user:
-            return
+            return True
 
         # ignore message with zero attachments
         if len(m.attachments) == 0:
-            return
+            return True
 
         # get channel from team record to pin it on the member
         team_record = self.database.locate_member(m.author)
 
-        logger.debug(f"Processing message from '{m.author.id}' with {len(m.attachments)} attachments.")
-
-        was_picture_included = False
+        logger.debug("Processing message from '%s' with %d attachments.", m.author.id, len(m.attachments),
+                     extra={"team": team_record.team_name, "message_id": m.id})
 
-        # iterate attachments, save new images
+        # collect new images, they're queued all at once
+        new_attachments = []
         for attachment in m.attachments:
-            if "image" not in attachment.content_type:
+            # the content type is only a hint and might be missing, the downloader checks the actual bytes
+            if attachment.content_type is not None and not attachment.content_type.startswith("image/"):
                 continue
 
             # check if we know that file
-            file_name = f"{team_record.data_folder}/{m.id}_{attachment.id}.png"
-            if os.path.isfile(file_name):
-                logger.debug(f"Already know file: {file_name}")
+            if team_record.knows_attachment(m.id, attachment.id):
+                logger.debug("Already know attachment: %s_%s", m.id, attachment.id,
+                             extra={"team": team_record.team_name, "message_id": m.id})
                 continue
 
-            # TODO: send the image to database, let it validate that we accept the image
-            # save new file
-            with open(file_name, "wb") as f:
-                await attachment.save(f)
-            logger.info(f"Found new file - saving in: {file_name}")
-            was_picture_included = True
-
-        # acknowledge file
-        if was_picture_included:
-            await m.add_reaction("\u2705")
+            new_attachments.append(attachment)
+
+        if not new_attachments:
+            return True
+
+        # queued before, e.g. by the backfill or before a restart, but not saved yet
+        queued = await self.queue.queued([TeamRecord.manifest_key(m.id, a.id) for a in new_attachments])
+        new_attachments = [a for a in new_attachments if TeamRecord.manifest_key(m.id, a.id) not in queued]
+        if not new_attachments:
+            return True
+
+        # the download stage would refuse them, they must not be charged or end up as dead jobs
+        max_bytes = self.downloads.max_bytes
+        too_large = [a for a in new_attachments if a.size > max_bytes]
+        new_attachments = [a for a in new_attachments if a.size <= max_bytes]
+
+        # one team must not hog the bandwidth or the disk, what exceeds a limit isn't downloaded
+        admission = self.limiter.admit(team_record, m.id, new_attachments, live=live)
+        admission.too_large = too_large
+        if too_large:
+            metrics.submissions_limited.inc(len(too_large), reason="size")
+        if admission.rate_limited or admission.over_quota or admission.too_large:
+            logger.warning("Refused %d attachments (rate limit), %d attachments (quota) and %d attachments (size)",
+                           len(admission.rate_limited), len(admission.over_quota), len(admission.too_large),
+                           extra={"team": team_record.team_name, "message_id": m.id})
+            try:
+                await m.channel.send(self.limiter.describe(admission, team_record, max_bytes))
+            except discord.HTTPException as e:
+                logger.warning(f"Failed to tell team '{team_record.team_name}' about the limit: {e!r}")
+
+        jobs = [DownloadJob.from_attachment(team_record, m, attachment, live=live) for attachment in admission.accepted]
+        if not jobs:
+            return True
+
+        # a message that is delivered twice is only queued once
+        try:
+            await self.queue.enqueue(jobs)
+        except Exception as e:
+            logger.error("Failed to queue %d attachments: %r", len(jobs), e,
+                         extra={"team": team_record.team_name, "message_id": m.id})
+            for job in jobs:
+                self.limiter.release(job.data_folder, job.key)
+            return False
+        return True
 
 
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
         member = message.author
-        logger.debug(message.content)
 
         if message.author == self.bot.user:
             return
 
         # we only do DMs here
-        if type(message.channel) is not discord.DMChannel:
+        if not isinstance(message.channel, discord.DMChannel):
+            metrics.messages_received.inc(channel="guild")
             return
+        metrics.messages_received.inc(channel="dm")
+        self.recorder.message(message)
+        # runs for every DM, so formatting is left to the logger
+        logger.debug("DM from %s: %s", member.id, message.content,
+                     extra={"member": member.id, "channel": message.channel.id, "message_id": message.id})
+
+        await self.database.wait_until_ready()
 
         # member is not a team founder - let's see what we respond
         if member not in self.database.teams.keys():
@@ -273,53 +499,116 @@ class PictureProcessor(commands.Cog):
             return
 
         # member is a founder, process the message
-        await self.process_dm_message(message)
+        team_record = self.database.teams[member]
+        if await self.process_dm_message(message):
+            # only move the checkpoint if there are no missing messages behind it
+            if team_record.backfill_done:
+                self.database.advance_checkpoint(team_record, message.id)
+        else:
+            # the next walk needs to pick this message up again
+            team_record.backfill_done = False
+
+    async def __walk_team(self, team_record: TeamRecord) -> int:
+        """!
+        Process all messages of a team that arrived after its checkpoint
+        @return number of scanned messages
+        """
+        if team_record.dm_channel is None:
+            logger.warning(f"No channel with '{team_record.founder.id}' found")
+            return 0
+
+        logger.info(f"Checking chat with {team_record.founder}")
+
+        # only fetch what we haven't seen yet
+        after = discord.Object(id=team_record.last_message_id) \
+            if team_record.last_message_id is not None else team_record.creation_time
+
+        # the checkpoint must not pass a message that failed to save
+        gap = False
+        scanned = 0
+        # rate limits of the history requests are handled by discord.py's buckets
+        async for message in team_record.dm_channel.history(limit=None, after=after, oldest_first=True):
+            scanned += 1
+            metrics.backfill_messages.inc()
+            if not await self.process_dm_message(message, live=False):
+                gap = True
+            elif not gap:
+                self.database.advance_checkpoint(team_record, message.id)
+
+        team_record.backfill_done = not gap
+        if gap:
+            logger.warning(f"Not all images of team '{team_record.team_name}' could be queued, will retry on next walk")
+
+        return scanned
 
-    # TODO: use new DM storage system
     @tasks.loop(count=1)
     async def walk_dms(self):
-        chat: discord.DMChannel
-
-        team_records = self.database.teams.values()
-        logger.info(f"Walking {len(team_records)} channels")
-        for team_record in team_records:
-            logger.info(f"Checking chat with {team_record.founder}")
-
-            if team_record.dm_channel is None:
-                logger.warning(f"No channel with '{team_record.founder.id}' found")
-                continue
-
-            async for message in team_record.dm_channel.history(limit=None):
-
-                if message.created_at < team_record.creation_time:
-                    logger.info(f"Breaking on: {message.id}, {message.created_at}")
-                    break
-
-                await self.process_dm_message(message)
-
-        logger.info(f"All chats walked successful.")
+        # the dict might change while we're walking
+        team_records = list(self.database.teams.values())
+        logger.info(f"Walking {len(team_records)} channels, {BACKFILL_CONCURRENCY} at once")
+
+        limit = asyncio.Semaphore(BACKFILL_CONCURRENCY)
+        start = time.monotonic()
+        teams_done = 0
+        messages_scanned = 0
+        metrics.backfill_teams.set(len(team_records), state="total")
+        metrics.backfill_teams.set(0, state="done")
+
+        async def walk(team_record: TeamRecord):
+            nonlocal teams_done, messages_scanned
+            async with limit:
+                try:
+                    messages_scanned += await self.__walk_team(team_record)
+                except Exception as e:
+                    logger.error(f"Failed to walk chat of team '{team_record.team_name}': {e!r}")
+
+            teams_done += 1
+            metrics.backfill_teams.set(teams_done, state="done")
+            elapsed = max(time.monotonic() - start, 1e-6)
+            logger.info(f"Backfill progress: {teams_done}/{len(team_records)} teams, "
+                        f"{messages_scanned} messages scanned, {messages_scanned / elapsed:.1f} messages/s")
+
+        await asyncio.gather(*(walk(team_record) for team_record in team_records))
+
+        logger.info(f"All chats walked successful in {time.monotonic() - start:.1f}s.")
 
     # make sure we're online before starting
     @walk_dms.before_loop
     async def before_walk(self):
         logger.info(f"Waiting for scan of DMs to begin")
         await self.bot.wait_until_ready()
-
-    def __save_records(self):
-        logger.info("Start saving of all data to disk...")
-        self.database.save_or_update_records()
-        logger.info("All data saved to disk")
+        await self.database.wait_until_ready()
+        # downloads that were queued before the restart go first
+        await self.queue.wait_until_resumed()
 
     # we do it all 10 seconds, but we sleep additional time in the method
     # we don't need to write immediately after starting...
     @tasks.loop(seconds=10)
     async def save_records(self):
         await asyncio.sleep(110)
-        self.__save_records()
+        # only changed records are written, the I/O happens outside the event loop
+        # an error would stop the loop for good, the records stay dirty and are written with the next run
+        try:
+            await self.database.flush_dirty_records()
+        except Exception as e:
+            logger.error(f"Failed to flush the team records, retrying with the next run: {e!r}")
+        self.recorder.flush()
+
+    async def shutdown(self):
+        """! Called by the bot when it closes, while the event loop still runs """
+        # the running downloads stay queued and are resumed on the next start
+        await self.queue.stop()
+        await self.downloads.close()
+        self.shutdown_procedure()
 
     def shutdown_procedure(self):
+        """! Writes the data of the cog, on close of the bot or on exit if the bot didn't close """
+        # everything is in the journal already, this only saves the replay on the next start
         logger.warning(f"Shutdown was issued. saving data...")
-        self.__save_records()
+        self.database.close()
+        self.queue.close()
+        self.recorder.close()
+        logger.info("All data saved to disk")
 
 async def setup(bot):
     await bot.add_cog(PictureProcessor(bot))
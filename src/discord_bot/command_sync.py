@@ -0,0 +1,96 @@
+import asyncio
+import hashlib
+import inspect
+import json
+import os
+
+import discord
+from discord import app_commands
+
+from discord_bot.environment import COMMAND_SYNC_CONCURRENCY
+from discord_bot.log_setup import logger
+from discord_bot.utils import files
+
+### @package command_sync
+#
+# Pushes the slash commands to guilds only if they changed since the last push.
+# The fingerprint of a guild is the sha256 of the commands discord.py would send for it,
+# the last pushed fingerprint per guild is kept in data/command_sync.json.
+# Every sync is a rate limited REST call, so skipping unchanged guilds saves most of them on a restart or reconnect.
+# The syncs that are needed run concurrently, limited by COMMAND_SYNC_CONCURRENCY.
+#
+
+
+def command_payload(tree: app_commands.CommandTree, command) -> dict:
+    """! The json of a command as it's sent to Discord, to_dict takes the tree since discord.py 2.4 """
+    if len(inspect.signature(command.to_dict).parameters) > 0:
+        return command.to_dict(tree)
+    return command.to_dict()
+
+
+class CommandSyncer:
+    def __init__(self, tree: app_commands.CommandTree, path: str = "data/command_sync.json",
+                 concurrency: int = COMMAND_SYNC_CONCURRENCY):
+        self.tree = tree
+        self.path = path
+        self.concurrency = concurrency
+        # guild id (as string, it's a json key) to the fingerprint that was pushed last
+        self.synced: dict[str, str] = self.__load()
+        # on_ready and /z might sync at the same time
+        self.lock = asyncio.Lock()
+
+    def __load(self) -> dict[str, str]:
+        if not os.path.isfile(self.path):
+            return {}
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Can't read '{self.path}', syncing commands to all guilds: {e!r}")
+            return {}
+
+    def fingerprint(self, guild: discord.Guild) -> str:
+        """! Hash of the commands of a guild, global commands must be copied to it already """
+        payload = [command_payload(self.tree, c) for c in self.tree.get_commands(guild=guild)]
+        payload.sort(key=lambda c: (c.get("type", 1), c["name"]))
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+    async def __sync_guild(self, guild: discord.Guild, fingerprint: str, limit: asyncio.Semaphore) -> bool:
+        async with limit:
+            try:
+                await self.tree.sync(guild=guild)
+            except discord.errors.Forbidden:
+                logger.warning(f"Don't have the permissions to push slash commands to: '{guild.name}'")
+                return False
+            except discord.HTTPException as e:
+                logger.error(f"Failed to push slash commands to '{guild.name}': {e!r}")
+                return False
+
+        self.synced[str(guild.id)] = fingerprint
+        logger.info(f"Pushed commands to: {guild.name}")
+        return True
+
+    async def sync(self, guilds: list[discord.Guild], force: bool = False) -> tuple[int, int]:
+        """!
+        Push the commands to all guilds whose commands changed since the last push
+        @param guilds guilds to check
+        @param force push to all given guilds, e.g. if commands were removed by hand
+        @return number of guilds that were synced and that were skipped
+        """
+        async with self.lock:
+            todo = []
+            for guild in guilds:
+                self.tree.copy_global_to(guild=guild)
+                fingerprint = self.fingerprint(guild)
+                if force or self.synced.get(str(guild.id)) != fingerprint:
+                    todo.append((guild, fingerprint))
+
+            limit = asyncio.Semaphore(self.concurrency)
+            results = await asyncio.gather(*(self.__sync_guild(g, f, limit) for g, f in todo))
+            synced = sum(results)
+            if synced:
+                await asyncio.to_thread(files.write_json_atomic, self.path, dict(self.synced), indent=4)
+
+        logger.info(f"Commands synced to {synced} guilds, {len(guilds) - len(todo)} unchanged guilds skipped"
+                    + (f", {len(todo) - synced} failed" if len(todo) > synced else ""))
+        return synced, len(guilds) - len(todo)
@@ -1,8 +1,9 @@
+import asyncio
 import datetime
-import glob
-import json
 import shutil
 import os
+import threading
+import time
 from dataclasses import dataclass, field
 import datetime as dt
 from typing import Iterable, Callable, Any, ClassVar
@@ -10,24 +11,54 @@ from typing import Iterable, Callable, Any, ClassVar
 import discord
 from discord.ext import commands
 
+from discord_bot import metrics
+from discord_bot.environment import STORAGE_BACKEND, SQLITE_PATH, JOURNAL_SYNC_MS, REBUILD_TEAM_INDEX
+from discord_bot.journal import Journal, Rotation, replay, team_key
 from discord_bot.log_setup import logger
+from discord_bot.persistence import Backend, RecordSnapshot, make_backend, CLOSE_PREFIX, MANIFEST_FILE
 
 message_idT = int
+attachment_idT = int
 
 @dataclass
 class TeamRecord:
     team_name: str
     founder: discord.Member
     other_members: set[discord.Member]
-    read_message_ids: set[message_idT] = field(default_factory=set, repr=False, compare=False)
+    # "<message_id>_<attachment_id>" to information about the saved file
+    manifest: dict[str, dict] = field(default_factory=dict, repr=False, compare=False)
     dm_channel: discord.DMChannel = None  # used to walk channels if we didn't get messages
     old_member_ids: set[int] = field(default_factory=set, repr=False, compare=False)
-    creation_time: dt.datetime = dt.datetime.now(tz=dt.timezone.utc)
+    creation_time: dt.datetime = field(default_factory=lambda: dt.datetime.now(tz=dt.timezone.utc))
+    # newest message in the dm channel of which all attachments are saved, backfill continues after it
+    last_message_id: message_idT = None
 
-    close_prefix: ClassVar = "closed_"
+    close_prefix: ClassVar = CLOSE_PREFIX
+    manifest_file: ClassVar = MANIFEST_FILE
 
     def __post_init__(self):
         self.__data_folder: str = None
+        # False as long as messages before the checkpoint might be missing, e.g. after a restart
+        # live messages may only move the checkpoint when there is no gap behind it
+        self.backfill_done: bool = True
+        # True if the record changed since it was written to disk the last time
+        self.dirty: bool = True
+        # running total of the sizes in the manifest, built on first use
+        self.__stored_bytes: int | None = None
+
+    def mark_dirty(self):
+        self.dirty = True
+
+    def advance_checkpoint(self, message_id: message_idT) -> bool:
+        """!
+        Move the backfill checkpoint forward, it never moves backwards
+        @return True if the checkpoint moved
+        """
+        if self.last_message_id is None or message_id > self.last_message_id:
+            self.last_message_id = message_id
+            self.mark_dirty()
+            return True
+        return False
 
     @property
     def data_folder(self):
@@ -37,15 +68,71 @@ class TeamRecord:
     def data_folder(self, path: str):
         os.makedirs(path, exist_ok=True)
         self.__data_folder = path
+        self.mark_dirty()
 
     @property
     def full_team(self) -> set[discord.Member]:
         return self.other_members.union({self.founder,})
 
+    @property
+    def member_ids(self) -> list[int]:
+        """! IDs of founder and other members, members that couldn't be resolved on load are skipped """
+        return [m.id for m in (self.founder, *self.other_members) if m is not None]
+
     # technically this data is not immutable...
     def __hash__(self):
         return self.team_name
 
+    @staticmethod
+    def manifest_key(message_id: message_idT, attachment_id: attachment_idT) -> str:
+        return f"{message_id}_{attachment_id}"
+
+    @property
+    def stored_bytes(self) -> int:
+        """! Bytes of all saved images, the sum is only built once and then kept up to date """
+        if self.__stored_bytes is None:
+            self.__stored_bytes = sum(entry.get("size") or 0 for entry in self.manifest.values())
+        return self.__stored_bytes
+
+    def set_manifest_entry(self, key: str, entry: dict):
+        """! Add or replace an entry of the manifest, all changes of the manifest must go through here """
+        if self.__stored_bytes is not None:
+            old = self.manifest.get(key)
+            self.__stored_bytes += (entry.get("size") or 0) - ((old or {}).get("size") or 0)
+        self.manifest[key] = entry
+        self.mark_dirty()
+
+    def knows_attachment(self, message_id: message_idT, attachment_id: attachment_idT) -> bool:
+        """! Check if an attachment was already processed, without touching the filesystem """
+        return self.manifest_key(message_id, attachment_id) in self.manifest
+
+    def add_to_manifest(self, message_id: message_idT, attachment_id: attachment_idT,
+                        file_name: str, size: int, sha256: str, author_id: int, created_at: dt.datetime) -> dict:
+        entry = {
+            "file": os.path.basename(file_name),
+            "size": size,
+            "sha256": sha256,
+            "author": author_id,
+            "created_at": created_at.timestamp(),
+            "saved_at": dt.datetime.now(tz=dt.timezone.utc).timestamp(),
+        }
+        self.set_manifest_entry(self.manifest_key(message_id, attachment_id), entry)
+        return entry
+
+    @staticmethod
+    def manifest_from_folder(folder: str) -> dict[str, dict]:
+        """!
+        Build a manifest from the files present in a team folder.
+        Used once for teams that were saved before manifests existed, size and hash are unknown then.
+        """
+        manifest = {}
+        for entry in os.scandir(folder):
+            name, ext = os.path.splitext(entry.name)
+            if not entry.is_file() or entry.name.startswith(".") or ext == ".json":
+                continue
+            manifest[name] = {"file": entry.name, "size": entry.stat().st_size, "sha256": None}
+        return manifest
+
     @staticmethod
     def to_id_list(s: Iterable):
         return [elm.id for elm in s]
@@ -59,21 +146,21 @@ class TeamRecord:
             "team_name": self.team_name,
             "founder": self.founder.id,
             "other_members": self.to_id_list(self.other_members),
-            "read_message_ids": list(self.read_message_ids),
             "dm_channel": self.dm_channel.id if self.dm_channel else None,
             "old_members": list(self.old_member_ids),
             "guild": self.founder.guild.id,  # needed to deserialize,
             "data_folder": self.data_folder,
-            "creation_time": self.creation_time.timestamp()
+            "creation_time": self.creation_time.timestamp(),
+            "last_message_id": self.last_message_id,
         }
 
-    def __write_to(self, path: str):
-        with open(path, "w") as f:
-            json.dump(self.to_json(), f, indent=4)
-
-    def write_to_disk(self, file_name="team_record.json"):
-        # TODO: maybe logging if data is overwritten
-        self.__write_to(f"{self.data_folder}/{file_name}")
+    def snapshot(self) -> RecordSnapshot:
+        """!
+        Copy everything that needs to be written, so that writing can happen outside the event loop.
+        The record counts as clean afterwards.
+        """
+        self.dirty = False
+        return self.data_folder, self.to_json(), dict(self.manifest)
 
     def close(self):
         path, target_folder = self.data_folder.rsplit("/", 1)
@@ -87,24 +174,44 @@ class TeamRecord:
         self.data_folder = new_data_folder
 
     @staticmethod
-    async def from_json(file: str, bot: commands.Bot):
-        with open(file, "r") as f:
-            data = json.load(f)
+    def resolve_dm_channel(channel_id: int | None, bot: commands.Bot) -> discord.abc.Messageable | None:
+        """!
+        Get the dm channel without a request to discord.
+        If it isn't cached, a partial channel is used, it supports everything we need (id, history, send)
+        """
+        if channel_id is None:
+            return None
+        return bot.get_channel(channel_id) or bot.get_partial_messageable(channel_id)
 
+    @staticmethod
+    def from_dict(data: dict, manifest: dict | None, bot: commands.Bot):
+        """!
+        Restore a record from what a storage backend loaded
+        @param data content of team_record.json
+        @param manifest processed attachments, None if the team was saved before manifests existed
+        @param bot bot to resolve guild, members and channel with
+        """
         guild = bot.get_guild(data["guild"])
-        # TODO why doesnt this seem to give a DMChannel?
-        dm_channel: discord.DMChannel = await bot.fetch_channel(data["dm_channel"]) if data["dm_channel"] else None
+        dm_channel = TeamRecord.resolve_dm_channel(data["dm_channel"], bot)
+
+        if manifest is None:
+            logger.info(f"No manifest found for team '{data['team_name']}', building it from its folder")
+            manifest = TeamRecord.manifest_from_folder(data["data_folder"])
 
         t = TeamRecord(
             team_name=data["team_name"],
             founder=guild.get_member(data["founder"]),
             other_members=TeamRecord.to_obj_set(data["other_members"], guild.get_member),
-            read_message_ids=set(data["read_message_ids"]),
+            manifest=manifest,
             dm_channel=dm_channel,
             old_member_ids=set(data["old_members"]),
-            creation_time=dt.datetime.fromtimestamp(data["creation_time"], tz=dt.timezone.utc)
+            creation_time=dt.datetime.fromtimestamp(data["creation_time"], tz=dt.timezone.utc),
+            last_message_id=data.get("last_message_id"),
         )
         t.data_folder = data["data_folder"]
+        # we might have missed messages while being offline
+        t.backfill_done = False
+        t.dirty = False
 
         return t
 
@@ -129,47 +236,127 @@ class Singleton(type):
 
 class SingletonDatabase(metaclass=Singleton):
 
-    def __init__(self, bot: commands.Bot, restore_from_files: bool = True):
+    def __init__(self, bot: commands.Bot, restore_from_files: bool = True, backend: Backend = None):
         # team name to members
         self.bot = bot
+        self.backend = backend if backend is not None else make_backend(STORAGE_BACKEND, SQLITE_PATH, REBUILD_TEAM_INDEX)
         self.teams: dict[discord.Member, TeamRecord] = dict()
-        self.all_registered_members: set[discord.Member] = set()
+        # member id to team, every registered member is in here
+        self.member_index: dict[int, TeamRecord] = dict()
         self.all_registered_team_names: set[str] = set()
+        # one flush at a time: a flush rotates the journal and may only compact what its own write covers
+        # the periodic flush and the shutdown flush run in different threads, so this is a thread lock
+        self.__flush_lock = threading.Lock()
+        # every mutation goes to the journal first, the backend is only written by the periodic flush
+        self.journal = Journal(sync_interval=JOURNAL_SYNC_MS / 1000)
+        # snapshots of closed teams, they aren't in self.teams anymore but need to be written once
+        self.__retired: list[RecordSnapshot] = []
+        self.__closed = False
+
+        # set once all records are restored, nobody may use the database before
+        self.ready = asyncio.Event()
+        self.__load_task: asyncio.Task = None
+
+    def ensure_loaded(self):
+        """! Start restoring the records, only the first call per process does something """
+        if self.__load_task is None:
+            self.__load_task = asyncio.create_task(self.load_records_from_files())
+
+    async def wait_until_ready(self):
+        await self.ready.wait()
+
+    def __index_team(self, team_record: TeamRecord):
+        for member_id in team_record.member_ids:
+            self.member_index[member_id] = team_record
+
+    def __unindex_team(self, team_record: TeamRecord):
+        for member_id in team_record.member_ids:
+            # the member might have been indexed for an other team in the meantime
+            if self.member_index.get(member_id) is team_record:
+                del self.member_index[member_id]
 
-    async def load_records_from_files(self, file_names="team_record.json"):
-        for file_path in glob.glob(f"data/**/{file_names}", recursive=True):
-
-            # ignore closed teams
-            if TeamRecord.close_prefix in file_path:
-                continue
-
-            team_record = await TeamRecord.from_json(file_path, self.bot)
-
-            self.teams[team_record.founder] = team_record
-            self.all_registered_members.update(team_record.full_team)
-            self.all_registered_team_names.add(team_record.team_name)
-
-    def locate_member(self, m: discord.Member):
-        if m not in self.all_registered_members:
-            return None
-
-        if m in self.teams.keys():
-            return self.teams[m]
-
-        for tr in self.teams.values():
-            if m in tr.full_team:
-                return tr
-
-        return None
+    @staticmethod
+    def __read_snapshot(backend: Backend, journal: Journal):
+        """! Load the last snapshot and replay the journal over it. This is blocking. """
+        loaded = backend.load()
+        loaded, retired, changed = replay(loaded, journal.entries())
+        # teams from before manifests existed, the folder scan is I/O as well
+        loaded = [
+            (data, manifest if manifest is not None else TeamRecord.manifest_from_folder(data["data_folder"]))
+            for data, manifest in loaded
+        ]
+        return loaded, retired, changed
+
+    async def load_records_from_files(self):
+        """! Load the last snapshot from the backend, replay the journal over it and open the ready barrier """
+        start = time.perf_counter()
+        try:
+            loaded, retired, changed = await asyncio.to_thread(self.__read_snapshot, self.backend, self.journal)
+
+            # no awaits in here, the records become visible all at once
+            for data, manifest in loaded:
+                team_record = TeamRecord.from_dict(data, manifest, self.bot)
+                if team_key(data) in changed:
+                    team_record.mark_dirty()
+
+                self.teams[team_record.founder] = team_record
+                self.__index_team(team_record)
+                self.all_registered_team_names.add(team_record.team_name)
+
+            self.__retired.extend(retired)
+        except Exception as e:
+            logger.critical(f"Failed to restore team records, the database stays closed: {e!r}")
+            raise
+
+        self.ready.set()
+        logger.info(f"Restored {len(self.teams)} teams in {(time.perf_counter() - start) * 1000:.1f}ms")
+
+        # fold the journal into a new snapshot right away
+        if changed or retired:
+            await self.flush_dirty_records()
+
+    def locate_member(self, m: discord.Member | discord.User) -> TeamRecord | None:
+        return self.member_index.get(m.id)
+
+    def check_consistency(self) -> list[str]:
+        """!
+        Verify the member index against the team records
+        @return list of found problems, empty if the index is consistent
+        """
+        problems = []
+        expected: dict[int, TeamRecord] = {}
+        for team_record in self.teams.values():
+            for member_id in team_record.member_ids:
+                if member_id in expected and expected[member_id] is not team_record:
+                    problems.append(
+                        f"Member {member_id} is part of '{expected[member_id].team_name}' "
+                        f"and '{team_record.team_name}'")
+                expected[member_id] = team_record
+
+        for member_id, team_record in expected.items():
+            indexed = self.member_index.get(member_id)
+            if indexed is not team_record:
+                problems.append(
+                    f"Member {member_id} should point to '{team_record.team_name}', "
+                    f"index has '{indexed.team_name if indexed else None}'")
+
+        for member_id in self.member_index.keys() - expected.keys():
+            problems.append(f"Member {member_id} is indexed for '{self.member_index[member_id].team_name}' "
+                            f"but isn't part of any team")
+
+        for problem in problems:
+            logger.error(f"Inconsistent member index: {problem}")
+
+        return problems
 
     def validate_team_record(self, team_record: TeamRecord):
-        if team_record.founder in self.all_registered_members:
-            team = self.locate_member(team_record.founder)
+        team = self.locate_member(team_record.founder)
+        if team is not None:
             raise ValueError(f"You are already part of team '{team.team_name}', you can't create a new one.")
 
         for member in team_record.other_members:
-            if member in self.all_registered_members:
-                team = self.locate_member(team_record.founder)
+            team = self.locate_member(member)
+            if team is not None:
                 raise ValueError(
                     f"Player {member.mention} is already part of team '{team.team_name}' by '{team.founder.name}'. "
                     f"Team will not be created"
@@ -178,6 +365,11 @@ class SingletonDatabase(metaclass=Singleton):
         if team_record.team_name in self.all_registered_team_names:
             raise ValueError(f"Team with name '{team_record.team_name}' already exists. No team will be created.")
 
+    def __journal(self, op: str, team_record: TeamRecord, **payload):
+        """! Journal a change of a team, founder and creation time identify the team on replay """
+        self.journal.append(op, founder=team_record.founder.id, creation_time=team_record.creation_time.timestamp(),
+                            **payload)
+
     def add_record(self, team_record: TeamRecord, validate=False):
         if validate:
             self.validate_team_record(team_record)
@@ -185,14 +377,15 @@ class SingletonDatabase(metaclass=Singleton):
         # TODO: create folder here and write team to file
 
         # okay, we can write the data
-        self.all_registered_members.update(team_record.full_team)
+        # nothing awaits in between, so this is done as a whole
+        self.__index_team(team_record)
         self.all_registered_team_names.add(team_record.team_name)
         self.teams[team_record.founder] = team_record
         logger.info(
             f"Team '{team_record.team_name}' created by '{team_record.founder.id}'. "
             f"Other members: {len(team_record.other_members)}. Channel: {team_record.dm_channel.id}.")
 
-        team_record.write_to_disk()
+        self.journal.append("add_team", record=team_record.to_json())
 
     def delete_team(self, key: TeamRecord | discord.Member):
         if type(key) is TeamRecord:
@@ -202,7 +395,7 @@ class SingletonDatabase(metaclass=Singleton):
         team_record = self.teams[key]
 
         # free members and name
-        self.all_registered_members = self.all_registered_members - team_record.full_team
+        self.__unindex_team(team_record)
         self.all_registered_team_names = self.all_registered_team_names - {team_record.team_name,}
 
         # delete the key
@@ -210,8 +403,10 @@ class SingletonDatabase(metaclass=Singleton):
         # we don't do file cleanup here.
 
         logger.info(f"Team '{team_record.team_name}' was deleted. Channel ID was: {team_record.dm_channel.id}")
-        # TODO: update file
         team_record.close()
+        self.__journal("delete_team", team_record, data_folder=team_record.data_folder)
+        # store the record as closed with the next flush
+        self.__retired.append(team_record.snapshot())
 
     def remove_member(self, member: discord.Member, team_record=None):
         if team_record is None:
@@ -228,18 +423,119 @@ class SingletonDatabase(metaclass=Singleton):
                 f"Keeping a headless team might cause unexpected side-effects!")
             team_record.close()
             del self.teams[member]  # remove from dict, nothing to see here
+            team_record.old_member_ids.add(member.id)
+            self.__retired.append(team_record.snapshot())
 
         # normal member
         else:
             team_record.other_members.remove(member)
-
+            team_record.mark_dirty()
 
         logger.info(f"Member {member.id} left team '{team_record.team_name}'")
 
         team_record.old_member_ids.add(member.id)
-        self.all_registered_members.remove(member)
-        team_record.write_to_disk()
+        self.member_index.pop(member.id, None)
+        self.__journal("remove_member", team_record, member=member.id, data_folder=team_record.data_folder)
+
+    def record_image(self, team_record: TeamRecord, message_id: message_idT, attachment_id: attachment_idT,
+                     file_name: str, size: int, sha256: str, author_id: int, created_at: dt.datetime):
+        """! Add a saved image to the manifest of a team """
+        entry = team_record.add_to_manifest(message_id, attachment_id, file_name, size, sha256, author_id, created_at)
+        self.__journal("image_saved", team_record, key=TeamRecord.manifest_key(message_id, attachment_id), entry=entry)
+
+    def update_image(self, team_record: TeamRecord, key: str, entry: dict):
+        """! Replace the manifest entry of an image, e.g. after it was transcoded """
+        team_record.set_manifest_entry(key, entry)
+        self.__journal("image_saved", team_record, key=key, entry=entry)
+
+    def advance_checkpoint(self, team_record: TeamRecord, message_id: message_idT):
+        """! Move the backfill checkpoint of a team """
+        if team_record.advance_checkpoint(message_id):
+            self.__journal("checkpoint", team_record, message_id=message_id)
+
+    def __take_dirty_snapshots(self) -> tuple[list[TeamRecord], list[RecordSnapshot], Rotation]:
+        """!
+        Copy all changed records and start a new journal segment.
+        Nothing may await in between, so that the snapshots contain everything of the older segments.
+        @return changed records, their snapshots and the rotation that ended the segments they cover
+        """
+        records = [record for record in self.teams.values() if record.dirty]
+        snapshots = [record.snapshot() for record in records] + self.__retired
+        self.__retired = []
+        return records, snapshots, self.journal.rotate()
+
+    def __restore_dirty(self, records: list[TeamRecord], snapshots: list[RecordSnapshot]):
+        """!
+        A write failed, the records are written with the next flush and the journal is kept until then.
+        Must run where the records are changed, on the event loop while it's running.
+        """
+        for record in records:
+            record.mark_dirty()
+        self.__retired = snapshots[len(records):] + self.__retired
+
+    def __write_and_compact(self, snapshots: list[RecordSnapshot], rotation: Rotation):
+        """! Sync the ended journal segment, write the snapshots and delete the segments they cover. This is blocking. """
+        segments = self.journal.seal(rotation)
+        if snapshots:
+            self.backend.write(snapshots)
+        self.journal.compact(segments)
+
+    async def __flush(self, start: float):
+        records, snapshots, rotation = self.__take_dirty_snapshots()
+        try:
+            await asyncio.to_thread(self.__write_and_compact, snapshots, rotation)
+        except Exception:
+            self.__restore_dirty(records, snapshots)
+            raise
+        if not snapshots:
+            logger.debug("No changed records to flush")
+            return
+        metrics.flush_seconds.observe(time.perf_counter() - start)
+        logger.info(f"Flushed {len(snapshots)} records ({len(self.teams)} active teams) in "
+                    f"{(time.perf_counter() - start) * 1000:.1f}ms")
+
+    async def flush_dirty_records(self):
+        """!
+        Write all records that changed since the last flush and compact the journal.
+        The records are copied on the event loop, the I/O happens in a worker thread.
+        Flushes never overlap, a second caller waits until the first one is done.
+        @raises Exception if the write failed, the records stay dirty and the journal is kept
+        """
+        start = time.perf_counter()
+        # polled, so that the event loop never blocks on a flush running in another thread
+        while not self.__flush_lock.acquire(blocking=False):
+            await asyncio.sleep(0.05)
+
+        # the lock is held until the write is done, even if the caller is cancelled in between
+        task = asyncio.ensure_future(self.__flush(start))
+        task.add_done_callback(lambda _: self.__flush_lock.release())
+        await asyncio.shield(task)
+
+    def save_or_update_records(self):
+        """! Synchronously write all changed records, used on shutdown when the event loop might be gone """
+        if self.__closed:
+            return
+        # a flush that was interrupted by the shutdown might never release the lock
+        if not self.__flush_lock.acquire(timeout=30):
+            logger.error("A flush is still running, not writing the records. The journal is kept and replayed.")
+            return
+        try:
+            records, snapshots, rotation = self.__take_dirty_snapshots()
+            try:
+                self.__write_and_compact(snapshots, rotation)
+            except Exception:
+                self.__restore_dirty(records, snapshots)
+                raise
+        finally:
+            self.__flush_lock.release()
+        logger.info(f"Flushed {len(snapshots)} records")
 
-    def save_or_update_records(self, file_name="team_record.json"):
-        for record in self.teams.values():
-            record.write_to_disk(file_name)
+    def close(self):
+        """! Final flush on shutdown, the journal is synced even if writing the snapshot fails """
+        if self.__closed:
+            return
+        try:
+            self.save_or_update_records()
+        finally:
+            self.journal.close()
+            self.__closed = True
@@ -0,0 +1,534 @@
+import asyncio
+import datetime as dt
+import random
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, NamedTuple, Optional
+from urllib.parse import parse_qs, urlsplit
+
+import aiohttp
+import discord
+
+from discord_bot import metrics
+from discord_bot.database import Singleton, SingletonDatabase, TeamRecord
+from discord_bot.downloads import AttachmentTooLarge, DownloadPipeline, NotAnImage, SavedAttachment
+from discord_bot.environment import (DOWNLOAD_CONCURRENCY, DOWNLOAD_MAX_ATTEMPTS, DOWNLOAD_QUEUE_PATH,
+                                     DOWNLOAD_RETRY_SECONDS, DOWNLOAD_WINDOW)
+from discord_bot.log_setup import logger
+
+### @package download_queue
+#
+# Durable queue in front of the download stage.
+# Every attachment that needs to be saved becomes a row in a sqlite database before anything is fetched,
+# a job is only deleted once its image is recorded in the team's manifest.
+# So a crash or restart loses nothing, the pending jobs are resumed on startup before the DMs are walked.
+#
+# Only a window of jobs is held in memory, everything else waits on disk, live messages before backfill work.
+# Failed jobs are retried with exponential backoff, jobs that keep failing (or can never succeed) are kept as 'dead'
+# until an admin retries or drops them.
+# Attachment links of Discord's CDN expire, they are refreshed by fetching the message again.
+#
+
+LIVE = 0
+BACKFILL = 1
+
+# a claimed job isn't handed out again for this long, unless the bot restarts
+LEASE_SECONDS = 600
+MAX_BACKOFF_SECONDS = 3600
+# the CDN answers expired links with one of these
+EXPIRED_STATUS = (403, 404, 410)
+
+
+class AttachmentGone(LookupError):
+    pass
+
+
+class QueuedAttachment(NamedTuple):
+    """! What the download stage needs of a discord.Attachment """
+    id: int
+    url: str
+    size: int
+    content_type: Optional[str]
+
+
+@dataclass
+class DownloadJob:
+    key: str  # manifest key of the attachment
+    founder: int
+    message_id: int
+    attachment_id: int
+    url: str
+    size: int
+    content_type: Optional[str]
+    file_base: str
+    author_id: int
+    created_at: float
+    priority: int = LIVE
+    attempts: int = 0
+    state: str = "pending"
+    last_error: Optional[str] = None
+
+    @classmethod
+    def from_attachment(cls, team_record: TeamRecord, m: discord.Message, attachment: discord.Attachment,
+                        live: bool = True) -> "DownloadJob":
+        return cls(
+            key=TeamRecord.manifest_key(m.id, attachment.id),
+            founder=team_record.founder.id,
+            message_id=m.id,
+            attachment_id=attachment.id,
+            url=attachment.url,
+            size=attachment.size,
+            content_type=attachment.content_type,
+            file_base=f"{team_record.data_folder}/{m.id}_{attachment.id}",
+            author_id=m.author.id,
+            created_at=m.created_at.timestamp(),
+            priority=LIVE if live else BACKFILL,
+        )
+
+    @property
+    def attachment(self) -> QueuedAttachment:
+        return QueuedAttachment(self.attachment_id, self.url, self.size, self.content_type)
+
+    @property
+    def created(self) -> dt.datetime:
+        return dt.datetime.fromtimestamp(self.created_at, tz=dt.timezone.utc)
+
+    @property
+    def data_folder(self) -> str:
+        return self.file_base.rsplit("/", 1)[0]
+
+
+def url_expired(url: str, now: float = None) -> bool:
+    """! Signed CDN links carry their expiry as hex timestamp in 'ex' """
+    try:
+        expires = int(parse_qs(urlsplit(url).query)["ex"][0], 16)
+    except (KeyError, ValueError):
+        return False
+    return expires <= (now if now is not None else time.time())
+
+
+def describe(e: Exception) -> str:
+    """! Short description of why a download failed, shown by /downloads """
+    if isinstance(e, aiohttp.ClientResponseError):
+        return f"HTTP {e.status} {e.message}"
+    return repr(e)
+
+
+class JobStore:
+    """!
+    The jobs in a sqlite database in WAL mode, every call is one transaction.
+    Calls block, they're meant to be run in a thread.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            key TEXT PRIMARY KEY,
+            founder INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            attachment_id INTEGER NOT NULL,
+            url TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            content_type TEXT,
+            file_base TEXT NOT NULL,
+            author_id INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            priority INTEGER NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            state TEXT NOT NULL DEFAULT 'pending',
+            last_error TEXT,
+            next_attempt REAL NOT NULL,
+            enqueued_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS jobs_due ON jobs (state, priority, next_attempt);
+        CREATE INDEX IF NOT EXISTS jobs_message ON jobs (message_id);
+    """
+
+    job_columns = ("key", "founder", "message_id", "attachment_id", "url", "size", "content_type", "file_base",
+                   "author_id", "created_at", "priority", "attempts", "state", "last_error")
+
+    def __init__(self, path: str = DOWNLOAD_QUEUE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # survives a crash of the bot, only a power loss might lose the last jobs
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(self.schema)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def __select(self, where: str, params: tuple = ()) -> list[DownloadJob]:
+        rows = self.connection.execute(f"SELECT {', '.join(self.job_columns)} FROM jobs {where}", params).fetchall()
+        return [DownloadJob(*row) for row in rows]
+
+    def add(self, jobs: list[DownloadJob], now: float) -> int:
+        """! Add jobs that aren't queued yet, returns the number of new jobs """
+        with self.lock:
+            cur = self.connection.cursor()
+            before = self.connection.total_changes
+            # one transaction, all jobs of a message are queued or none
+            cur.execute("BEGIN")
+            try:
+                cur.executemany(
+                    "INSERT OR IGNORE INTO jobs "
+                    "(key, founder, message_id, attachment_id, url, size, content_type, file_base, author_id, "
+                    "created_at, priority, next_attempt, enqueued_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(j.key, j.founder, j.message_id, j.attachment_id, j.url, j.size, j.content_type, j.file_base,
+                      j.author_id, j.created_at, j.priority, now, now) for j in jobs]
+                )
+                cur.execute("COMMIT")
+            except BaseException:
+                cur.execute("ROLLBACK")
+                raise
+            return self.connection.total_changes - before
+
+    def reset(self, now: float) -> list[str]:
+        """! Make all pending jobs due again, e.g. after a restart, returns their keys """
+        with self.lock:
+            self.connection.execute("UPDATE jobs SET next_attempt = ? WHERE state = 'pending'", (now,))
+            return [row[0] for row in self.connection.execute("SELECT key FROM jobs WHERE state = 'pending'")]
+
+    def claim(self, now: float, limit: int, max_backfill: int = None,
+              lease: float = LEASE_SECONDS) -> list[DownloadJob]:
+        """!
+        Take up to limit due jobs, live ones first, and hide them from other claims for lease seconds
+        @param max_backfill at most this many of them may be backfill jobs, None for no limit
+        """
+        with self.lock:
+            cur = self.connection.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                jobs = self.__select("WHERE state = 'pending' AND priority = ? AND next_attempt <= ? "
+                                     "ORDER BY next_attempt LIMIT ?", (LIVE, now, limit))
+                backfill = limit - len(jobs) if max_backfill is None else min(limit - len(jobs), max_backfill)
+                if backfill > 0:
+                    jobs += self.__select("WHERE state = 'pending' AND priority != ? AND next_attempt <= ? "
+                                          "ORDER BY priority, next_attempt LIMIT ?", (LIVE, now, backfill))
+                cur.executemany("UPDATE jobs SET next_attempt = ? WHERE key = ?", [(now + lease, j.key) for j in jobs])
+                cur.execute("COMMIT")
+            except BaseException:
+                cur.execute("ROLLBACK")
+                raise
+            return jobs
+
+    def next_due(self, live_only: bool = False) -> Optional[float]:
+        with self.lock:
+            return self.connection.execute(
+                "SELECT MIN(next_attempt) FROM jobs WHERE state = 'pending'"
+                + (" AND priority = ?" if live_only else ""), (LIVE,) if live_only else ()).fetchone()[0]
+
+    def finish(self, key: str, message_id: int) -> int:
+        """! Remove a done job, returns the number of jobs of its message that are left """
+        with self.lock:
+            self.connection.execute("DELETE FROM jobs WHERE key = ?", (key,))
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM jobs WHERE message_id = ?", (message_id,)).fetchone()[0]
+
+    def retry(self, key: str, attempts: int, next_attempt: float, error: str):
+        with self.lock:
+            self.connection.execute(
+                "UPDATE jobs SET attempts = ?, next_attempt = ?, last_error = ? WHERE key = ?",
+                (attempts, next_attempt, error, key))
+
+    def bury(self, key: str, attempts: int, error: str):
+        with self.lock:
+            self.connection.execute(
+                "UPDATE jobs SET state = 'dead', attempts = ?, last_error = ? WHERE key = ?", (attempts, error, key))
+
+    def queued(self, keys: list[str]) -> set[str]:
+        """! The ones of keys that have a job, pending or dead """
+        with self.lock:
+            found = set()
+            # sqlite limits the number of parameters of a statement
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                found.update(row[0] for row in self.connection.execute(
+                    f"SELECT key FROM jobs WHERE key IN ({', '.join('?' * len(chunk))})", chunk))
+            return found
+
+    def update_url(self, key: str, url: str):
+        with self.lock:
+            self.connection.execute("UPDATE jobs SET url = ? WHERE key = ?", (url, key))
+
+    def counts(self) -> dict[str, int]:
+        with self.lock:
+            return dict(self.connection.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+
+    def troubled(self, limit: int) -> list[DownloadJob]:
+        """! Dead jobs and jobs that failed at least once, oldest first """
+        with self.lock:
+            return self.__select("WHERE state = 'dead' OR attempts > 0 ORDER BY state, enqueued_at LIMIT ?", (limit,))
+
+    def requeue_dead(self, now: float) -> int:
+        with self.lock:
+            return self.connection.execute(
+                "UPDATE jobs SET state = 'pending', attempts = 0, next_attempt = ? WHERE state = 'dead'",
+                (now,)).rowcount
+
+    def drop_dead(self) -> int:
+        with self.lock:
+            return self.connection.execute("DELETE FROM jobs WHERE state = 'dead'").rowcount
+
+
+class DownloadQueue(metaclass=Singleton):
+    """!
+    Hands queued jobs to the download stage, at most window at once.
+    Only max_backfill of them may be backfill jobs, the download stage serves its slots in order of arrival.
+    So a live job never waits behind a window full of backfill, only behind the downloads that are running.
+    on_saved is called for every saved image, before its job is removed from the queue.
+    on_finished is called once a job is done, whether its image was saved, skipped, dropped or given up.
+    The cog sets both, so a reloaded cog gets the images.
+    """
+
+    def __init__(self, database: SingletonDatabase, downloads: DownloadPipeline, path: str = DOWNLOAD_QUEUE_PATH,
+                 window: int = DOWNLOAD_WINDOW, max_attempts: int = DOWNLOAD_MAX_ATTEMPTS,
+                 retry_seconds: float = DOWNLOAD_RETRY_SECONDS, max_backfill: int = DOWNLOAD_CONCURRENCY):
+        self.database = database
+        self.downloads = downloads
+        self.store = JobStore(path)
+        self.window = window
+        self.max_backfill = max_backfill
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+        self.on_saved: Callable[[TeamRecord, DownloadJob, SavedAttachment], None] = None
+        self.on_finished: Callable[[DownloadJob], None] = lambda job: None
+
+        # key to job and the time it was started
+        self.in_flight: dict[str, tuple[DownloadJob, float]] = {}
+        self.tasks: set[asyncio.Task] = set()
+        self.dispatcher: asyncio.Task = None
+        self.wakeup = asyncio.Event()
+        # set once every job that was pending on startup was started
+        self.resumed = asyncio.Event()
+        # set while nothing is due or running
+        self.idle = asyncio.Event()
+        self.enqueuing = 0
+
+        # counters for the admin command
+        self.completed = 0
+        self.retried = 0
+        self.dead = 0
+        self.dropped = 0
+
+    def ensure_started(self):
+        if self.dispatcher is None:
+            self.dispatcher = asyncio.create_task(self.__dispatch())
+
+    async def wait_until_resumed(self):
+        await self.resumed.wait()
+
+    async def wait_until_idle(self):
+        await self.idle.wait()
+
+    async def enqueue(self, jobs: list[DownloadJob]) -> int:
+        """!
+        Durably queue jobs, attachments that are queued already are skipped
+        @return number of new jobs
+        """
+        self.idle.clear()
+        self.enqueuing += 1
+        try:
+            return await asyncio.to_thread(self.store.add, jobs, time.time())
+        finally:
+            self.enqueuing -= 1
+            self.wakeup.set()
+
+    async def queued(self, keys: list[str]) -> set[str]:
+        """! The manifest keys of keys that are in the queue already """
+        return await asyncio.to_thread(self.store.queued, keys)
+
+    async def requeue_dead(self) -> int:
+        count = await asyncio.to_thread(self.store.requeue_dead, time.time())
+        self.idle.clear()
+        self.wakeup.set()
+        return count
+
+    async def drop_dead(self) -> int:
+        return await asyncio.to_thread(self.store.drop_dead)
+
+    async def stop(self):
+        """! Stop handing out jobs and cancel the running ones, they stay in the queue """
+        tasks = [t for t in (self.dispatcher, *self.tasks) if t is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.dispatcher = None
+
+    def close(self):
+        self.store.close()
+
+    def stuck(self, older_than: float = 60) -> list[tuple[DownloadJob, float]]:
+        """! Running jobs that take longer than older_than seconds, with the time they're running """
+        now = time.time()
+        return [(job, now - started) for job, started in self.in_flight.values() if now - started > older_than]
+
+    async def __dispatch(self):
+        await self.database.wait_until_ready()
+        startup: set[str] = None
+        backoff = 1.0
+        while True:
+            # a failing queue database must not end the dispatcher, downloads would stop for good
+            try:
+                if startup is None:
+                    startup = set(await asyncio.to_thread(self.store.reset, time.time()))
+                    if startup:
+                        logger.info(f"Resuming {len(startup)} queued downloads")
+                await self.__dispatch_round(startup)
+                backoff = 1.0
+            except Exception as e:
+                logger.exception(f"Failed to hand out downloads, trying again in {backoff:.0f}s: {e!r}")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+
+    async def __dispatch_round(self, startup: set[str]):
+        """! Start due jobs while there is room in the window, then wait until something changes """
+        self.wakeup.clear()
+        free = self.window - len(self.in_flight)
+        free_backfill = self.max_backfill - sum(1 for job, _ in self.in_flight.values() if job.priority != LIVE)
+        jobs = []
+        if free > 0:
+            jobs = await asyncio.to_thread(self.store.claim, time.time(), free, max(free_backfill, 0))
+            for job in jobs:
+                # a job that outlived its lease is claimed again, it's still running though
+                if job.key in self.in_flight:
+                    continue
+                self.in_flight[job.key] = (job, time.time())
+                task = asyncio.create_task(self.__run(job))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+                startup.discard(job.key)
+
+        if not startup:
+            self.resumed.set()
+        if free > 0 and len(jobs) == free:
+            # there might be more due jobs
+            return
+        if not jobs and not self.in_flight and not self.enqueuing and not self.wakeup.is_set():
+            self.idle.set()
+
+        timeout = None
+        if free > 0:
+            # with the backfill at its limit only a live job can be started before a running job finishes
+            next_due = await asyncio.to_thread(self.store.next_due, free_backfill <= 0)
+            if next_due is not None:
+                timeout = max(next_due - time.time(), 0.05)
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def __team_of(self, job: DownloadJob) -> TeamRecord | None:
+        """! The team the job was queued for, None if it was deleted or refounded in the meantime """
+        team_record = self.database.member_index.get(job.founder)
+        if team_record is None or team_record.founder.id != job.founder or team_record.data_folder != job.data_folder:
+            return None
+        return team_record
+
+    async def __refresh_url(self, team_record: TeamRecord, job: DownloadJob):
+        """! Fetch the message again, its attachments come with fresh links """
+        message = await team_record.dm_channel.fetch_message(job.message_id)
+        attachment = discord.utils.get(message.attachments, id=job.attachment_id)
+        if attachment is None:
+            raise AttachmentGone(f"Attachment {job.attachment_id} was removed from message {job.message_id}")
+        job.url = attachment.url
+        await asyncio.to_thread(self.store.update_url, job.key, job.url)
+
+    async def __download(self, team_record: TeamRecord, job: DownloadJob) -> SavedAttachment:
+        if url_expired(job.url):
+            logger.debug("Link of attachment %s expired, fetching the message again", job.key,
+                         extra={"team": team_record.team_name, "message_id": job.message_id})
+            await self.__refresh_url(team_record, job)
+            return await self.downloads.download(team_record, job.attachment, job.file_base)
+
+        try:
+            return await self.downloads.download(team_record, job.attachment, job.file_base)
+        except aiohttp.ClientResponseError as e:
+            if e.status not in EXPIRED_STATUS:
+                raise
+        await self.__refresh_url(team_record, job)
+        return await self.downloads.download(team_record, job.attachment, job.file_base)
+
+    async def __acknowledge(self, team_record: TeamRecord, job: DownloadJob):
+        """! React to the message once all of its images are saved """
+        try:
+            await team_record.dm_channel.get_partial_message(job.message_id).add_reaction("\u2705")
+        except discord.HTTPException as e:
+            logger.warning("Failed to acknowledge message %s: %r", job.message_id, e,
+                           extra={"team": team_record.team_name, "message_id": job.message_id})
+            return
+        if job.priority == LIVE:
+            metrics.ack_seconds.observe(time.time() - job.created_at)
+
+    async def __fail(self, job: DownloadJob, e: Exception, permanent: bool) -> bool:
+        """! @return True if the job was given up """
+        attempts = job.attempts + 1
+        error = describe(e)
+        extra = {"message_id": job.message_id}
+        if permanent or attempts >= self.max_attempts:
+            await asyncio.to_thread(self.store.bury, job.key, attempts, error)
+            self.dead += 1
+            metrics.download_retries.inc(result="dead")
+            logger.error("Gave up on attachment %s after %d attempts: %s", job.key, attempts, error, extra=extra)
+            return True
+
+        delay = min(self.retry_seconds * 2 ** (attempts - 1), MAX_BACKOFF_SECONDS) * random.uniform(0.8, 1.2)
+        await asyncio.to_thread(self.store.retry, job.key, attempts, time.time() + delay, error)
+        self.retried += 1
+        metrics.download_retries.inc(result="retry")
+        logger.warning("Download of attachment %s failed (attempt %d), retrying in %.0fs: %s",
+                       job.key, attempts, delay, error, extra=extra)
+        return False
+
+    async def __run(self, job: DownloadJob):
+        try:
+            team_record = self.__team_of(job)
+            if team_record is None:
+                logger.warning("Dropping download of attachment %s, its team doesn't exist anymore", job.key)
+                self.dropped += 1
+                await asyncio.to_thread(self.store.finish, job.key, job.message_id)
+                self.on_finished(job)
+                return
+
+            # the image might have been recorded right before a crash, before its job was removed
+            if not team_record.knows_attachment(job.message_id, job.attachment_id):
+                try:
+                    saved = await self.__download(team_record, job)
+                except NotAnImage as e:
+                    # nothing the founder can fix by sending it again, the job is done
+                    logger.warning(f"Skipped attachment: {e}")
+                    left = await asyncio.to_thread(self.store.finish, job.key, job.message_id)
+                    self.on_finished(job)
+                    # the other attachments of the message might be saved already
+                    prefix = f"{job.message_id}_"
+                    if left == 0 and any(key.startswith(prefix) for key in team_record.manifest):
+                        await self.__acknowledge(team_record, job)
+                    return
+                except (AttachmentTooLarge, AttachmentGone, discord.NotFound, discord.Forbidden) as e:
+                    await self.__fail(job, e, permanent=True)
+                    self.on_finished(job)
+                    return
+                except Exception as e:
+                    if await self.__fail(job, e, permanent=False):
+                        self.on_finished(job)
+                    return
+
+                self.on_saved(team_record, job, saved)
+            # no await in between, the image counts as stored when its reservation ends
+            self.on_finished(job)
+
+            self.completed += 1
+            left = await asyncio.to_thread(self.store.finish, job.key, job.message_id)
+            if left == 0:
+                await self.__acknowledge(team_record, job)
+
+        except Exception as e:
+            # the job stays in the queue and is claimed again once its lease ran out
+            logger.exception(f"Unexpected error while handling download of attachment {job.key}: {e!r}")
+        finally:
+            self.in_flight.pop(job.key, None)
+            self.wakeup.set()
+
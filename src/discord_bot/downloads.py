@@ -0,0 +1,195 @@
+import asyncio
+import hashlib
+import time
+from dataclasses import dataclass
+
+import aiohttp
+import discord
+
+from discord_bot import metrics
+from discord_bot.database import Singleton, TeamRecord
+from discord_bot.environment import DOWNLOAD_CONCURRENCY, DOWNLOAD_TEAM_CONCURRENCY, MAX_ATTACHMENT_BYTES
+from discord_bot.images import sniff_extension, SNIFF_BYTES
+from discord_bot.log_setup import logger
+from discord_bot.storage import BlobStore
+from discord_bot.utils import files
+
+
+### @package downloads
+#
+# Bounded, concurrent download stage for submitted attachments.
+# Lives outside the cog module, so that a hot reload doesn't reset the limits or counters.
+# Attachments are streamed to a temp file in chunks and only renamed to their final name once complete.
+# Chunks are collected and written in batches by a worker thread, so a slow disk never blocks the event loop.
+# The content is hashed while streaming and handed to the BlobStore, which skips duplicates.
+# The file extension is taken from the magic bytes of the content, not from what the uploader claims.
+#
+
+CHUNK_SIZE = 64 * 1024
+# received bytes are written to the temp file once this much is collected
+WRITE_BATCH = 1024 * 1024
+
+
+class AttachmentTooLarge(ValueError):
+    pass
+
+
+class NotAnImage(ValueError):
+    pass
+
+
+@dataclass
+class SavedAttachment:
+    file_name: str
+    extension: str
+    sha256: str
+    size: int
+    deduplicated: bool
+
+
+class DownloadPipeline(metaclass=Singleton):
+    """!
+    Downloads attachments in parallel.
+    Concurrency is limited globally and per team, so that one team can't starve all others.
+    """
+
+    def __init__(self,
+                 max_concurrent: int = DOWNLOAD_CONCURRENCY,
+                 max_per_team: int = DOWNLOAD_TEAM_CONCURRENCY,
+                 max_bytes: int = MAX_ATTACHMENT_BYTES,
+                 blob_store: BlobStore = None):
+        self.max_concurrent = max_concurrent
+        self.max_per_team = max_per_team
+        self.max_bytes = max_bytes
+        self.session: aiohttp.ClientSession = None
+        self.blobs = blob_store if blob_store is not None else BlobStore()
+        self.global_limit = asyncio.Semaphore(max_concurrent)
+        self.team_limits: dict[str, asyncio.Semaphore] = {}
+
+        # counters to size the limits
+        self.queued = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.deduplicated = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "queued": self.queued,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "deduplicated": self.deduplicated,
+        }
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def __stream_to_disk(self, attachment: discord.Attachment, file_base: str) -> SavedAttachment:
+        """!
+        Stream the attachment in chunks into a temp file while hashing it,
+        then move it into the blob store and link it to file_base plus the detected extension.
+        A failed download never leaves a file in the team folder
+        """
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession()
+
+        f, tmp_path = files.open_temp_file(file_base)
+        try:
+            async with self.session.get(attachment.url) as resp:
+                resp.raise_for_status()
+                received = 0
+                head = b""
+                digest = hashlib.sha256()
+                batch = bytearray()
+                async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                    received += len(chunk)
+                    # the announced size might be wrong
+                    if received > self.max_bytes:
+                        raise AttachmentTooLarge(f"Attachment {attachment.id} exceeds {self.max_bytes} bytes")
+                    if len(head) < SNIFF_BYTES:
+                        head += chunk[:SNIFF_BYTES - len(head)]
+                    digest.update(chunk)
+                    batch += chunk
+                    if len(batch) >= WRITE_BATCH:
+                        await asyncio.to_thread(f.write, bytes(batch))
+                        batch.clear()
+                if batch:
+                    await asyncio.to_thread(f.write, bytes(batch))
+
+            extension = sniff_extension(head)
+            if extension is None:
+                raise NotAnImage(f"Attachment {attachment.id} ({attachment.content_type}) isn't a known image format")
+
+            sha256 = digest.hexdigest()
+            file_name = f"{file_base}.{extension}"
+            is_new = await asyncio.to_thread(self.blobs.store, f, tmp_path, sha256, file_name)
+            return SavedAttachment(file_name=file_name, extension=extension, sha256=sha256, size=received,
+                                   deduplicated=not is_new)
+
+        except BaseException:
+            files.discard_temp_file(f, tmp_path)
+            raise
+
+    def __team_limit(self, team_record: TeamRecord) -> asyncio.Semaphore:
+        key = team_record.data_folder
+        if key not in self.team_limits:
+            self.team_limits[key] = asyncio.Semaphore(self.max_per_team)
+        return self.team_limits[key]
+
+    async def download(self, team_record: TeamRecord, attachment: discord.Attachment, file_base: str) -> SavedAttachment:
+        """!
+        Download a single attachment as soon as there is a free slot for the team and globally
+        @param team_record team the attachment belongs to
+        @param attachment attachment to fetch, anything with id, url, size and content_type
+        @param file_base path to store the attachment in, without extension
+        @return information about the stored file
+        @raises AttachmentTooLarge if the attachment exceeds the configured size, nothing is fetched in this case
+        @raises NotAnImage if the content isn't an image, nothing is stored in this case
+        """
+        if attachment.size > self.max_bytes:
+            self.rejected += 1
+            metrics.attachments_downloaded.inc(result="rejected")
+            raise AttachmentTooLarge(
+                f"Attachment {attachment.id} has {attachment.size} bytes, limit is {self.max_bytes} bytes")
+
+        self.queued += 1
+        waiting = True
+        try:
+            async with self.__team_limit(team_record), self.global_limit:
+                self.queued -= 1
+                waiting = False
+                self.in_flight += 1
+                start = time.perf_counter()
+                try:
+                    saved = await self.__stream_to_disk(attachment, file_base)
+                finally:
+                    self.in_flight -= 1
+                metrics.download_seconds.observe(time.perf_counter() - start)
+
+        except NotAnImage:
+            self.rejected += 1
+            metrics.attachments_downloaded.inc(result="rejected")
+            raise
+        except BaseException:
+            # we might have been cancelled while still waiting for a slot
+            if waiting:
+                self.queued -= 1
+            self.failed += 1
+            metrics.attachments_downloaded.inc(result="failed")
+            raise
+
+        self.completed += 1
+        metrics.attachments_downloaded.inc(result="deduplicated" if saved.deduplicated else "saved")
+        metrics.attachment_bytes.inc(saved.size)
+        if saved.deduplicated:
+            self.deduplicated += 1
+            logger.info("Found new file - already stored as %s, linked to: %s", saved.sha256, saved.file_name,
+                        extra={"team": team_record.team_name})
+        else:
+            logger.info("Found new file - saving in: %s", saved.file_name, extra={"team": team_record.team_name})
+        return saved
@@ -95,3 +95,43 @@ OWNER_NAME = load_env("OWNER_NAME", "unknown", config_dict=cfg_dict)  # owner na
 OWNER_ID = int(load_env("OWNER_ID", "100000000000000000", config_dict=cfg_dict))  # discord id of the owner
 ACTIVITY_NAME = load_env("ACTIVITY_NAME", f"{PREFIX}help", config_dict=cfg_dict)  # activity bot plays
 BASE_GUILD = int(load_env("BASE_GUILD", f"760421261649248296", config_dict=cfg_dict))  # guild to reference to
+COMMAND_SYNC_CONCURRENCY = int(load_env("COMMAND_SYNC_CONCURRENCY", "4", config_dict=cfg_dict))  # guilds synced at once
+
+# download stage for submitted attachments
+DOWNLOAD_CONCURRENCY = int(load_env("DOWNLOAD_CONCURRENCY", "8", config_dict=cfg_dict))  # parallel downloads overall
+DOWNLOAD_TEAM_CONCURRENCY = int(load_env("DOWNLOAD_TEAM_CONCURRENCY", "4", config_dict=cfg_dict))  # per team
+MAX_ATTACHMENT_BYTES = int(load_env("MAX_ATTACHMENT_BYTES", "26214400", config_dict=cfg_dict))  # 25 MiB
+BACKFILL_CONCURRENCY = int(load_env("BACKFILL_CONCURRENCY", "4", config_dict=cfg_dict))  # dm channels walked at once
+DOWNLOAD_QUEUE_PATH = load_env("DOWNLOAD_QUEUE_PATH", "data/download_queue.sqlite3", config_dict=cfg_dict)
+DOWNLOAD_WINDOW = int(load_env("DOWNLOAD_WINDOW", "64", config_dict=cfg_dict))  # queued downloads held in memory
+DOWNLOAD_MAX_ATTEMPTS = int(load_env("DOWNLOAD_MAX_ATTEMPTS", "8", config_dict=cfg_dict))  # until a job is dead
+DOWNLOAD_RETRY_SECONDS = float(load_env("DOWNLOAD_RETRY_SECONDS", "5", config_dict=cfg_dict))  # first retry delay
+
+# per team limits of submissions, 0 disables a limit
+TEAM_RATE_WINDOW = float(load_env("TEAM_RATE_WINDOW", "60", config_dict=cfg_dict))  # seconds
+TEAM_RATE_ATTACHMENTS = int(load_env("TEAM_RATE_ATTACHMENTS", "30", config_dict=cfg_dict))  # images per window
+TEAM_RATE_BYTES = int(load_env("TEAM_RATE_BYTES", "262144000", config_dict=cfg_dict))  # 250 MiB per window
+TEAM_QUOTA_BYTES = int(load_env("TEAM_QUOTA_BYTES", "10737418240", config_dict=cfg_dict))  # 10 GiB stored per team
+
+# storage of team records: 'json' (files in the team folders) or 'sqlite'
+STORAGE_BACKEND = load_env("STORAGE_BACKEND", "json", config_dict=cfg_dict)
+SQLITE_PATH = load_env("SQLITE_PATH", "data/database.sqlite3", config_dict=cfg_dict)
+JOURNAL_SYNC_MS = int(load_env("JOURNAL_SYNC_MS", "100", config_dict=cfg_dict))  # max. time until a change is fsynced
+# rebuild data/teams_index.json by scanning the team folders on startup (json backend only)
+REBUILD_TEAM_INDEX = load_env("REBUILD_TEAM_INDEX", "false", config_dict=cfg_dict).lower() in ("1", "true", "yes")
+
+# image processing
+IMAGE_WORKERS = int(load_env("IMAGE_WORKERS", "0", config_dict=cfg_dict))  # worker processes, 0 = one per cpu
+TRANSCODE_FORMAT = load_env("TRANSCODE_FORMAT", "", config_dict=cfg_dict)  # e.g. 'webp' or 'jpg', empty = off
+TRANSCODE_QUALITY = int(load_env("TRANSCODE_QUALITY", "82", config_dict=cfg_dict))
+TRANSCODE_MIN_BYTES = int(load_env("TRANSCODE_MIN_BYTES", "1048576", config_dict=cfg_dict))  # only re-encode larger
+PREVIEW_THUMB_SIZE = int(load_env("PREVIEW_THUMB_SIZE", "256", config_dict=cfg_dict))  # px, longest edge
+PREVIEW_SIZE = int(load_env("PREVIEW_SIZE", "1280", config_dict=cfg_dict))  # px, longest edge
+PREVIEW_QUEUE_SIZE = int(load_env("PREVIEW_QUEUE_SIZE", "1000", config_dict=cfg_dict))  # images waiting for previews
+DUPLICATE_DISTANCE = int(load_env("DUPLICATE_DISTANCE", "6", config_dict=cfg_dict))  # max. bits two hashes may differ
+
+# monitoring
+METRICS_HOST = load_env("METRICS_HOST", "127.0.0.1", config_dict=cfg_dict)  # interface of the metrics endpoint
+METRICS_PORT = int(load_env("METRICS_PORT", "0", config_dict=cfg_dict))  # 0 disables the metrics endpoint
+RECORD_EVENTS = load_env("RECORD_EVENTS", "", config_dict=cfg_dict)  # file to record DMs and commands to, empty = off
+LOOP_STALL_MS = int(load_env("LOOP_STALL_MS", "250", config_dict=cfg_dict))  # log blocking calls, 0 = off
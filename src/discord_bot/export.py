@@ -0,0 +1,242 @@
+import argparse
+import datetime as dt
+import io
+import json
+import os
+import re
+import tarfile
+import threading
+import time
+import zipfile
+from dataclasses import dataclass
+from typing import Iterable
+
+from discord_bot.log_setup import logger, start_logging
+from discord_bot.persistence import JsonBackend, LoadedRecord
+from discord_bot.utils import files
+
+### @package export
+#
+# Archives of the team submissions, written straight to disk.
+# Images are streamed from their files into the archive, nothing is held in memory.
+# Each archive contains an export_manifest.json with submitter, timestamps and hashes of every image.
+# The keys of all exported images are remembered in data/exports/export_state.json,
+# so an incremental export only contains what was added since the previous one.
+#
+
+ARCHIVE_MANIFEST = "export_manifest.json"
+STATE_FILE = "export_state.json"
+formats = ("zip", "tar")
+
+# exports write the state file, only one may run at a time
+_export_lock = threading.Lock()
+
+
+@dataclass
+class ExportResult:
+    path: str | None
+    teams: int
+    images: int
+    bytes: int
+    missing: int
+
+
+def safe_name(name: str) -> str:
+    """! Make a team name usable as folder name in an archive """
+    return re.sub(r"[^\w\-. ]", "_", name).strip(" .") or "team"
+
+
+class Exporter:
+    """!
+    Writes zip or tar archives of team submissions
+    """
+
+    def __init__(self, folder: str = "data/exports"):
+        self.folder = folder
+        self.state_path = f"{folder}/{STATE_FILE}"
+
+    def __load_state(self) -> dict[str, set[str]]:
+        try:
+            with open(self.state_path, "r") as f:
+                return {team: set(keys) for team, keys in json.load(f).items()}
+        except FileNotFoundError:
+            return {}
+
+    def __save_state(self, state: dict[str, set[str]]):
+        files.write_json_atomic(self.state_path, {team: sorted(keys) for team, keys in state.items()})
+
+    def export(self, teams: Iterable[LoadedRecord], archive_format: str = "zip", incremental: bool = True,
+               label: str = "all") -> ExportResult:
+        """!
+        Write an archive of the given teams.
+        This is blocking, call it from a worker thread when running on the event loop.
+
+        @param teams team data and manifest of every team to export
+        @param archive_format 'zip' or 'tar'
+        @param incremental only export images that weren't part of a previous export
+        @param label part of the archive name, e.g. the team name
+        @return where the archive was written to and what it contains, path is None if there was nothing to export
+        """
+        if archive_format not in formats:
+            raise ValueError(f"Unknown archive format '{archive_format}', use one of {formats}")
+
+        with _export_lock:
+            os.makedirs(self.folder, exist_ok=True)
+            state = self.__load_state()
+
+            # decide on the content first, so an empty export doesn't create an archive
+            selected = []
+            for data, manifest in teams:
+                exported = state.get(JsonBackend.index_key(data), set()) if incremental else set()
+                entries = sorted((key, entry) for key, entry in (manifest or {}).items() if key not in exported)
+                if entries:
+                    selected.append((data, entries))
+
+            if not selected:
+                return ExportResult(None, 0, 0, 0, 0)
+
+            stamp = dt.datetime.now(tz=dt.timezone.utc).strftime("%Y%m%d-%H%M%S")
+            target = f"{self.folder}/export_{safe_name(label)}_{stamp}{'_incremental' if incremental else ''}.{archive_format}"
+            f, tmp_path = files.open_temp_file(target)
+            try:
+                result, exported_keys = self.__write(f, archive_format, selected)
+            except BaseException:
+                files.discard_temp_file(f, tmp_path)
+                raise
+
+            # only missing files, they'll be tried again next time
+            if not result.images:
+                files.discard_temp_file(f, tmp_path)
+                return result
+            files.commit_temp_file(f, tmp_path, target)
+
+            # a previous full export doesn't matter for the state, it's always the union
+            for team, keys in exported_keys.items():
+                state.setdefault(team, set()).update(keys)
+            self.__save_state(state)
+
+        result.path = target
+        logger.info(f"Exported {result.images} images ({result.bytes} bytes) of {result.teams} teams to '{target}'")
+        return result
+
+    @staticmethod
+    def __write(f, archive_format: str, selected: list[tuple[dict, list[tuple[str, dict]]]]
+                ) -> tuple[ExportResult, dict[str, set[str]]]:
+        result = ExportResult(None, 0, 0, 0, 0)
+        exported_keys: dict[str, set[str]] = {}
+        manifest = {"exported_at": time.time(), "teams": []}
+
+        if archive_format == "zip":
+            # images are compressed already, storing them is much faster
+            archive = zipfile.ZipFile(f, "w", compression=zipfile.ZIP_STORED, allowZip64=True)
+            add_file = archive.write
+        else:
+            archive = tarfile.open(fileobj=f, mode="w|")
+            add_file = archive.add
+
+        with archive:
+            for data, entries in selected:
+                folder = f"{safe_name(data['team_name'])}_{data['founder']}"
+                team_manifest = {
+                    "team_name": data["team_name"],
+                    "founder": data["founder"],
+                    "members": [data["founder"], *data["other_members"]],
+                    "creation_time": data["creation_time"],
+                    "folder": folder,
+                    "images": [],
+                }
+
+                for key, entry in entries:
+                    source = f"{data['data_folder']}/{entry['file']}"
+                    if not os.path.isfile(source):
+                        logger.warning(f"Can't export '{source}', the file is missing")
+                        result.missing += 1
+                        continue
+
+                    # streams the file in chunks
+                    add_file(source, f"{folder}/{entry['file']}")
+                    message_id, _, attachment_id = key.partition("_")
+                    team_manifest["images"].append({
+                        "file": f"{folder}/{entry['file']}",
+                        "message_id": message_id,
+                        "attachment_id": attachment_id,
+                        "submitter": entry.get("author"),
+                        "created_at": entry.get("created_at"),
+                        "saved_at": entry.get("saved_at"),
+                        "size": entry.get("size"),
+                        "sha256": entry.get("sha256"),
+                        "original_sha256": entry.get("original_sha256"),
+                    })
+                    exported_keys.setdefault(JsonBackend.index_key(data), set()).add(key)
+                    result.images += 1
+                    result.bytes += entry.get("size") or 0
+
+                if team_manifest["images"]:
+                    manifest["teams"].append(team_manifest)
+                    result.teams += 1
+
+            raw_manifest = json.dumps(manifest, indent=2).encode()
+            if archive_format == "zip":
+                archive.writestr(ARCHIVE_MANIFEST, raw_manifest)
+            else:
+                info = tarfile.TarInfo(ARCHIVE_MANIFEST)
+                info.size = len(raw_manifest)
+                info.mtime = int(manifest["exported_at"])
+                archive.addfile(info, io.BytesIO(raw_manifest))
+
+        return result, exported_keys
+
+
+def load_teams(data_folder: str = "data") -> list[LoadedRecord]:
+    """!
+    Read all active teams from the configured backend, including what's only in the journal yet.
+    Nothing is written, so this is safe while the bot is running.
+    """
+    from discord_bot.database import TeamRecord
+    from discord_bot.environment import STORAGE_BACKEND, SQLITE_PATH
+    from discord_bot.journal import read_entries, replay
+    from discord_bot.persistence import SqliteBackend
+
+    if STORAGE_BACKEND == "sqlite":
+        backend = SqliteBackend(SQLITE_PATH, read_only=True)
+    else:
+        backend = JsonBackend(root=data_folder, read_only=True)
+
+    # a flush of the bot might delete journal segments while they're read, the newer snapshot has them then
+    for attempt in range(3):
+        skipped = []
+        loaded, _, _ = replay(backend.load(), read_entries(f"{data_folder}/journal", skipped))
+        if not skipped:
+            break
+        logger.info("The journal was compacted while reading it, loading the teams again")
+    # teams from before manifests existed
+    return [(data, manifest if manifest is not None else TeamRecord.manifest_from_folder(data["data_folder"]))
+            for data, manifest in loaded]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the submissions of the image submission bot")
+    parser.add_argument("--team", help="only export the team with this name")
+    parser.add_argument("--format", choices=formats, default="zip", help="archive format")
+    parser.add_argument("--full", action="store_true", help="export everything, not just what's new since the last export")
+    parser.add_argument("--data", default="data", help="folder containing the team folders")
+    parser.add_argument("--out", default="data/exports", help="folder to write the archive to")
+    args = parser.parse_args()
+    start_logging(to_file=False)
+
+    teams = load_teams(args.data)
+    if args.team is not None:
+        teams = [(data, manifest) for data, manifest in teams if data["team_name"] == args.team]
+        if not teams:
+            parser.error(f"There is no active team named '{args.team}'")
+
+    result = Exporter(args.out).export(teams, args.format, incremental=not args.full, label=args.team or "all")
+    if result.path is None:
+        print("Nothing new to export")
+        return
+    print(f"Wrote {result.images} images ({result.bytes} bytes) of {result.teams} teams to '{result.path}'"
+          + (f", {result.missing} files were missing" if result.missing else ""))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+import argparse
+import datetime as dt
+import hashlib
+import html
+import json
+import os
+import shutil
+import time
+from urllib.parse import quote
+
+from discord_bot.export import load_teams, safe_name
+from discord_bot.images import preview_path
+from discord_bot.log_setup import logger, start_logging
+from discord_bot.persistence import JsonBackend, LoadedRecord
+from discord_bot.utils import files
+
+### @package gallery
+#
+# Static, paginated HTML gallery of all active teams for the judges.
+# Pages link the images in the team folders, thumbnails are used where they were rendered already.
+# A fingerprint of every team's images is kept in gallery_state.json,
+# only teams whose fingerprint changed are rendered again. So it's cheap to run every minute.
+#
+
+STATE_FILE = "gallery_state.json"
+
+page_template = """<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+body {{ font-family: sans-serif; margin: 1em 2em; }}
+.grid {{ display: flex; flex-wrap: wrap; gap: 8px; }}
+.grid figure {{ margin: 0; width: 256px; }}
+.grid img {{ width: 256px; height: 256px; object-fit: cover; background: #eee; }}
+figcaption {{ font-size: 0.8em; color: #555; }}
+nav {{ margin: 1em 0; }}
+</style>
+</head>
+<body>
+<h1>{title}</h1>
+{body}
+<p><small>Generated {generated}</small></p>
+</body>
+</html>
+"""
+
+
+def team_slug(data: dict) -> str:
+    return f"{safe_name(data['team_name'])}_{data['founder']}"
+
+
+def format_timestamp(timestamp: float | None) -> str:
+    if timestamp is None:
+        return "unknown"
+    return dt.datetime.fromtimestamp(timestamp, tz=dt.timezone.utc).strftime("%Y-%m-%d %H:%M UTC")
+
+
+class GalleryBuilder:
+    """!
+    Renders the gallery incrementally
+    """
+
+    def __init__(self, folder: str = "data/gallery", previews_folder: str = "data/previews", page_size: int = 60):
+        self.folder = folder
+        self.previews_folder = previews_folder
+        self.page_size = page_size
+        self.state_path = f"{folder}/{STATE_FILE}"
+
+    def __load_state(self) -> dict[str, dict]:
+        try:
+            with open(self.state_path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def __link(self, path: str) -> str:
+        """! URL of a file relative to the team pages, they're all one level below the gallery folder """
+        relative = os.path.relpath(path, f"{self.folder}/team")
+        return html.escape(quote(relative.replace(os.sep, "/")), quote=True)
+
+    def __thumbnail(self, entry: dict) -> str | None:
+        if entry.get("sha256") is None:
+            return None
+        thumb = preview_path(self.previews_folder, entry["sha256"], "thumb")
+        return thumb if os.path.isfile(thumb) else None
+
+    def __fingerprint(self, data: dict, images: list[tuple[str, dict, str | None]]) -> str:
+        digest = hashlib.sha256()
+        digest.update(json.dumps([data["team_name"], self.page_size]).encode())
+        for key, entry, thumb in images:
+            digest.update(json.dumps([key, entry["file"], entry.get("sha256"), thumb is not None]).encode())
+        return digest.hexdigest()
+
+    @staticmethod
+    def __write(path: str, content: str):
+        f, tmp_path = files.open_temp_file(path)
+        try:
+            f.write(content.encode())
+            files.commit_temp_file(f, tmp_path, path)
+        except BaseException:
+            files.discard_temp_file(f, tmp_path)
+            raise
+
+    def __render_team(self, data: dict, images: list[tuple[str, dict, str | None]], slug: str) -> int:
+        folder = f"{self.folder}/{slug}"
+        os.makedirs(folder, exist_ok=True)
+        pages = max(1, -(-len(images) // self.page_size))
+        title = html.escape(data["team_name"])
+        generated = format_timestamp(time.time())
+
+        for page in range(pages):
+            figures = []
+            for key, entry, thumb in images[page * self.page_size:(page + 1) * self.page_size]:
+                full = self.__link(f"{data['data_folder']}/{entry['file']}")
+                figures.append(
+                    f'<figure><a href="{full}"><img loading="lazy" decoding="async" '
+                    f'src="{self.__link(thumb) if thumb else full}" alt="{html.escape(entry["file"])}"></a>'
+                    f'<figcaption>{format_timestamp(entry.get("created_at"))}</figcaption></figure>'
+                )
+
+            nav = ['<a href="../index.html">All teams</a>']
+            if page > 0:
+                nav.append(f'<a href="page-{page}.html">&larr; previous</a>')
+            nav.append(f"page {page + 1} of {pages}")
+            if page + 1 < pages:
+                nav.append(f'<a href="page-{page + 2}.html">next &rarr;</a>')
+
+            body = (f"<nav>{' | '.join(nav)}</nav>\n<p>{len(images)} images</p>\n"
+                    f"<div class=\"grid\">\n{chr(10).join(figures)}\n</div>\n<nav>{' | '.join(nav)}</nav>")
+            self.__write(f"{folder}/page-{page + 1}.html",
+                         page_template.format(title=title, body=body, generated=generated))
+
+        # the team might have had more pages before
+        for name in os.listdir(folder):
+            if name.startswith("page-") and name.endswith(".html") and int(name[5:-5]) > pages:
+                os.remove(f"{folder}/{name}")
+        return pages
+
+    def __render_index(self, teams: list[tuple[str, str, int]]):
+        rows = [f'<li><a href="{html.escape(quote(slug))}/page-1.html">{html.escape(name)}</a> ({count} images)</li>'
+                for name, slug, count in sorted(teams, key=lambda team: team[0].lower())]
+        body = f"<p>{len(teams)} teams</p>\n<ul>\n{chr(10).join(rows)}\n</ul>"
+        self.__write(f"{self.folder}/index.html",
+                     page_template.format(title="Submissions", body=body, generated=format_timestamp(time.time())))
+
+    def build(self, teams: list[LoadedRecord], force: bool = False) -> int:
+        """!
+        Render the pages of all teams that changed since the last run and the index.
+        This is blocking, call it from a worker thread when running on the event loop.
+
+        @param teams team data and manifest of all active teams
+        @param force render every team
+        @return number of rendered teams
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        old_state = self.__load_state()
+        state = {}
+        index = []
+        rendered = 0
+
+        for data, manifest in teams:
+            key = JsonBackend.index_key(data)
+            slug = team_slug(data)
+            images = [(image_key, entry, self.__thumbnail(entry))
+                      for image_key, entry in sorted((manifest or {}).items(),
+                                                     key=lambda item: (item[1].get("created_at") or 0, item[0]))]
+            fingerprint = self.__fingerprint(data, images)
+
+            previous = old_state.get(key)
+            if force or previous is None or previous["fingerprint"] != fingerprint or previous["slug"] != slug:
+                self.__render_team(data, images, slug)
+                rendered += 1
+                if previous is not None and previous["slug"] != slug:
+                    shutil.rmtree(f"{self.folder}/{previous['slug']}", ignore_errors=True)
+
+            state[key] = {"fingerprint": fingerprint, "slug": slug}
+            index.append((data["team_name"], slug, len(images)))
+
+        # teams that were closed
+        for key, previous in old_state.items():
+            if key not in state:
+                shutil.rmtree(f"{self.folder}/{previous['slug']}", ignore_errors=True)
+
+        if rendered or state.keys() != old_state.keys() or not os.path.isfile(f"{self.folder}/index.html"):
+            self.__render_index(index)
+        files.write_json_atomic(self.state_path, state)
+
+        logger.info(f"Rendered the gallery of {rendered} of {len(state)} teams")
+        return rendered
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render a static HTML gallery of all submissions")
+    parser.add_argument("--data", default="data", help="folder containing the team folders")
+    parser.add_argument("--out", default="data/gallery", help="folder to write the gallery to")
+    parser.add_argument("--previews", default="data/previews", help="folder containing the rendered previews")
+    parser.add_argument("--page-size", type=int, default=60, help="images per page")
+    parser.add_argument("--force", action="store_true", help="render all teams, not only the changed ones")
+    args = parser.parse_args()
+    start_logging(to_file=False)
+
+    builder = GalleryBuilder(args.out, args.previews, args.page_size)
+    rendered = builder.build(load_teams(args.data), force=args.force)
+    print(f"Rendered {rendered} teams to '{args.out}/index.html'")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+import hashlib
+import os
+
+from discord_bot.utils import files
+
+### @package images
+#
+# Image format detection and the image work that runs in worker processes.
+# Pillow is optional, everything that needs it raises a RuntimeError if it's not installed.
+# HEIC/AVIF decoding additionally needs the pillow-heif plugin.
+#
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # pragma: no cover - depends on the installation
+    Image = None
+    ImageOps = None
+
+try:
+    import pillow_heif
+    pillow_heif.register_heif_opener()
+except ImportError:  # pragma: no cover - depends on the installation
+    pillow_heif = None
+
+# bytes needed to detect all formats below
+SNIFF_BYTES = 32
+
+# ISO base media file brands
+heic_brands = {b"heic", b"heix", b"hevc", b"hevx", b"heim", b"heis", b"mif1", b"msf1"}
+avif_brands = {b"avif", b"avis"}
+
+# extension to the name Pillow uses for saving
+pillow_formats = {"jpg": "JPEG", "jpeg": "JPEG", "png": "PNG", "webp": "WEBP", "avif": "AVIF", "heic": "HEIF"}
+
+
+def has_pillow() -> bool:
+    return Image is not None
+
+
+def sniff_extension(head: bytes) -> str | None:
+    """!
+    Detect the image format by its magic bytes
+    @param head at least the first SNIFF_BYTES bytes of the file
+    @return file extension without dot, None if it's not a known image format
+    """
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpg"
+    if head.startswith((b"GIF87a", b"GIF89a")):
+        return "gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    if head[4:8] == b"ftyp":
+        brand = head[8:12]
+        if brand in heic_brands:
+            return "heic"
+        if brand in avif_brands:
+            return "avif"
+    if head.startswith((b"II*\x00", b"MM\x00*")):
+        return "tiff"
+    if head.startswith(b"BM"):
+        return "bmp"
+    return None
+
+
+def sha256_of_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def transcode(source: str, target_folder: str, extension: str, quality: int) -> tuple[str, str, int]:
+    """!
+    Re-encode an image, runs in a worker process.
+    The orientation from the EXIF data is applied, since the metadata isn't kept.
+
+    @param source path of the image to read
+    @param target_folder folder to write the result to, as hidden temp file
+    @param extension target format as file extension
+    @param quality encoder quality (1-100)
+    @return path of the written temp file, its sha256 and size
+    """
+    if not has_pillow():
+        raise RuntimeError("Transcoding needs Pillow to be installed")
+
+    f, tmp_path = files.open_temp_file(f"{target_folder}/transcoded.{extension}")
+    try:
+        with Image.open(source) as img:
+            img = ImageOps.exif_transpose(img)
+            if pillow_formats[extension] == "JPEG" and img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            img.save(f, format=pillow_formats[extension], quality=quality)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+    except BaseException:
+        files.discard_temp_file(f, tmp_path)
+        raise
+
+    return tmp_path, sha256_of_file(tmp_path), os.path.getsize(tmp_path)
+
+
+def preview_path(folder: str, sha256: str, name: str) -> str:
+    """! Where the preview 'name' (e.g. thumb) of an image with the given content hash is stored """
+    return f"{folder}/{sha256[:2]}/{sha256}_{name}.jpg"
+
+
+def make_previews(source: str, sha256: str | None, folder: str, sizes: dict[str, int], quality: int) -> str:
+    """!
+    Render downscaled JPEG previews of an image, runs in a worker process.
+    Previews are stored by content hash, existing previews are not rendered again.
+
+    @param source path of the image
+    @param sha256 content hash of the image, computed here if None
+    @param folder root folder of the previews
+    @param sizes name of the preview to its max. edge length in pixels
+    @param quality JPEG quality
+    @return content hash of the image
+    """
+    if not has_pillow():
+        raise RuntimeError("Previews need Pillow to be installed")
+
+    if sha256 is None:
+        sha256 = sha256_of_file(source)
+
+    missing = {name: size for name, size in sizes.items() if not os.path.isfile(preview_path(folder, sha256, name))}
+    if not missing:
+        return sha256
+
+    os.makedirs(f"{folder}/{sha256[:2]}", exist_ok=True)
+    with Image.open(source) as img:
+        img = ImageOps.exif_transpose(img).convert("RGB")
+        # render the largest first, every smaller one is made from the previous one
+        for name, size in sorted(missing.items(), key=lambda item: item[1], reverse=True):
+            img.thumbnail((size, size))
+            f, tmp_path = files.open_temp_file(preview_path(folder, sha256, name))
+            try:
+                img.save(f, format="JPEG", quality=quality)
+                files.commit_temp_file(f, tmp_path, preview_path(folder, sha256, name))
+            except BaseException:
+                files.discard_temp_file(f, tmp_path)
+                raise
+
+    return sha256
+
+
+def perceptual_hash(source: str) -> int:
+    """!
+    64 bit difference hash (dHash) of an image, runs in a worker process.
+    Resized, recompressed or slightly cropped versions of an image have hashes with a small hamming distance.
+    """
+    if not has_pillow():
+        raise RuntimeError("Perceptual hashing needs Pillow to be installed")
+
+    with Image.open(source) as img:
+        # let the JPEG decoder skip most of the work
+        img.draft("L", (64, 64))
+        img = ImageOps.exif_transpose(img)
+        small = img.convert("L").resize((9, 8), Image.LANCZOS)
+
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
@@ -0,0 +1,247 @@
+import glob
+import json
+import os
+import re
+import threading
+import time
+from typing import Iterator, NamedTuple, TextIO
+
+from discord_bot.log_setup import logger
+from discord_bot.persistence import LoadedRecord, RecordSnapshot
+
+### @package journal
+#
+# Append-only journal of all database mutations.
+# Every mutation is appended as one json line, a background thread fsyncs the journal in small batches.
+# On startup the journal is replayed over the last snapshot of the storage backend.
+# Each flush of the database starts a new journal segment and deletes the old segments once the snapshot is written,
+# so the journal never grows beyond what happened since the last flush.
+#
+
+
+class Rotation(NamedTuple):
+    """! The file of the segment a rotation ended and the number of the segment it started """
+    file: TextIO
+    segment: int
+
+
+class Journal:
+    """!
+    Segmented, fsync batched journal file.
+    Segments are named journal.<n>.jsonl, they are replayed in order.
+    """
+
+    segment_pattern = re.compile(r"journal\.(\d+)\.jsonl$")
+
+    def __init__(self, folder: str = "data/journal", sync_interval: float = 0.1):
+        self.folder = folder
+        self.sync_interval = sync_interval
+        os.makedirs(folder, exist_ok=True)
+
+        # appending only takes 'lock', so the event loop never waits for an fsync
+        # 'file_lock' keeps the file open while it's synced
+        self.lock = threading.Lock()
+        self.file_lock = threading.Lock()
+        self.segment = max(self.segments(), default=0) + 1
+        self.file = open(self.__segment_path(self.segment), "a")
+        self.unsynced = False
+        self.appended = 0
+
+        self.__stop = threading.Event()
+        self.__sync_thread = threading.Thread(target=self.__sync_loop, name="journal-sync", daemon=True)
+        self.__sync_thread.start()
+
+    def __segment_path(self, segment: int) -> str:
+        return f"{self.folder}/journal.{segment:08d}.jsonl"
+
+    def segments(self) -> list[int]:
+        """! Numbers of all segments on disk, oldest first """
+        found = []
+        for path in glob.glob(f"{self.folder}/journal.*.jsonl"):
+            match = self.segment_pattern.search(path)
+            if match:
+                found.append(int(match.group(1)))
+        return sorted(found)
+
+    def append(self, op: str, **payload):
+        """! Append a mutation, it's on disk at latest after sync_interval """
+        line = json.dumps({"op": op, "t": time.time(), **payload}, separators=(",", ":"))
+        with self.lock:
+            self.file.write(line + "\n")
+            self.unsynced = True
+            self.appended += 1
+
+    def sync(self):
+        """! Push everything appended so far to disk. This is blocking. """
+        with self.file_lock:
+            with self.lock:
+                if not self.unsynced:
+                    return
+                self.file.flush()
+                fd = self.file.fileno()
+                self.unsynced = False
+            os.fsync(fd)
+
+    def __sync_loop(self):
+        while not self.__stop.wait(self.sync_interval):
+            try:
+                self.sync()
+            except (OSError, ValueError) as e:
+                logger.error(f"Failed to sync journal: {e!r}")
+
+    def rotate(self) -> Rotation:
+        """!
+        Start a new segment, later appends go to it.
+        Only takes 'lock', so it's fine on the event loop: the old segment is synced and closed by seal.
+        """
+        with self.lock:
+            old = self.file
+            self.segment += 1
+            self.file = open(self.__segment_path(self.segment), "a")
+            self.unsynced = False
+            return Rotation(old, self.segment)
+
+    def seal(self, rotation: Rotation) -> list[int]:
+        """!
+        Sync and close the segment a rotation ended. This is blocking.
+        @return numbers of all segments before the rotation, everything appended before it is in them
+        """
+        # the sync thread might still be syncing the old file
+        with self.file_lock:
+            try:
+                rotation.file.flush()
+                os.fsync(rotation.file.fileno())
+            finally:
+                rotation.file.close()
+        return [segment for segment in self.segments() if segment < rotation.segment]
+
+    def compact(self, segments: list[int]):
+        """! Delete the given segments, their content must be part of a written snapshot """
+        for segment in segments:
+            try:
+                os.remove(self.__segment_path(segment))
+            except FileNotFoundError:
+                pass
+
+    def entries(self) -> Iterator[dict]:
+        """! All entries on disk, oldest first. A torn last line from a crash is skipped """
+        return read_entries(self.folder)
+
+    def close(self):
+        self.__stop.set()
+        self.sync()
+        with self.file_lock, self.lock:
+            self.file.close()
+
+
+def read_entries(folder: str = "data/journal", skipped: list[int] = None) -> Iterator[dict]:
+    """!
+    Read all entries of a journal folder without opening the journal for writing, oldest first.
+    A torn last line from a crash is skipped.
+    @param skipped gets the numbers of segments that were deleted while reading, by a flush of the running bot
+    """
+    segments = []
+    for path in glob.glob(f"{folder}/journal.*.jsonl"):
+        match = Journal.segment_pattern.search(path)
+        if match:
+            segments.append((int(match.group(1)), path))
+
+    for segment, path in sorted(segments):
+        try:
+            f = open(path, "r")
+        except FileNotFoundError:
+            # compacted in the meantime, its entries are in a snapshot that's newer than the one the reader has
+            if skipped is not None:
+                skipped.append(segment)
+            continue
+        with f:
+            for line_no, line in enumerate(f, 1):
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f"Skipping broken journal line {line_no} in segment {segment}")
+
+
+def team_key(record: dict) -> tuple[int, float]:
+    """! A founder can have several teams over time, only one of them active, the creation time tells them apart """
+    return record["founder"], record["creation_time"]
+
+
+def replay(loaded: list[LoadedRecord], entries: Iterator[dict]) -> tuple[list[LoadedRecord], list[RecordSnapshot], set[tuple[int, float]]]:
+    """!
+    Apply journal entries to what the storage backend loaded.
+    Entries might already be part of the snapshot, so every operation is idempotent.
+    Teams are identified by founder and creation time, so entries of an earlier team of the same founder
+    never touch the current one.
+
+    @param loaded active teams as loaded by the backend
+    @param entries journal entries, oldest first
+    @return active teams, snapshots of teams that were closed and keys (see team_key) of all changed teams
+    """
+    teams: dict[tuple[int, float], LoadedRecord] = {team_key(data): (data, manifest) for data, manifest in loaded}
+    retired: list[RecordSnapshot] = []
+    changed: set[tuple[int, float]] = set()
+    count = 0
+
+    def find(entry: dict) -> tuple[int, float] | None:
+        if "creation_time" in entry:
+            key = (entry["founder"], entry["creation_time"])
+            return key if key in teams else None
+        # written before the creation time was journaled, it belongs to the active team of the founder
+        return next((key for key in teams if key[0] == entry.get("founder")), None)
+
+    def close(key: tuple[int, float], data_folder: str):
+        data, manifest = teams.pop(key)
+        data["data_folder"] = data_folder
+        retired.append((data_folder, data, manifest or {}))
+
+    for entry in entries:
+        count += 1
+        op = entry["op"]
+
+        if op == "add_team":
+            record = entry["record"]
+            key = team_key(record)
+            if key not in teams:
+                teams[key] = (record, {})
+            changed.add(key)
+            continue
+
+        key = find(entry)
+        if key is None:
+            # team is already gone in the snapshot
+            continue
+
+        data, manifest = teams[key]
+        founder = key[0]
+        changed.add(key)
+
+        if op == "delete_team":
+            close(key, entry["data_folder"])
+
+        elif op == "remove_member":
+            member = entry["member"]
+            if member == founder:
+                close(key, entry["data_folder"])
+            else:
+                if member in data["other_members"]:
+                    data["other_members"].remove(member)
+                if member not in data["old_members"]:
+                    data["old_members"].append(member)
+
+        elif op == "image_saved":
+            # without a manifest it's built from the folder on load, the saved image is part of it
+            if manifest is not None:
+                manifest[entry["key"]] = entry["entry"]
+
+        elif op == "checkpoint":
+            if data.get("last_message_id") is None or entry["message_id"] > data["last_message_id"]:
+                data["last_message_id"] = entry["message_id"]
+
+        else:
+            logger.warning(f"Unknown journal operation '{op}', skipping")
+
+    if count:
+        logger.info(f"Replayed {count} journal entries, {len(changed)} teams changed, {len(retired)} closed")
+
+    return list(teams.values()), retired, changed
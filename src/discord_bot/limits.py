@@ -0,0 +1,176 @@
+import time
+from dataclasses import dataclass, field
+
+import discord
+
+from discord_bot import metrics
+from discord_bot.database import Singleton, TeamRecord
+from discord_bot.environment import TEAM_QUOTA_BYTES, TEAM_RATE_ATTACHMENTS, TEAM_RATE_BYTES, TEAM_RATE_WINDOW
+
+### @package limits
+#
+# Per team limits for submissions, checked before anything is downloaded.
+# - rate: token buckets for attachments and bytes, each refills its full size within one window
+# - quota: bytes a team may store in total, that's the cached total of its manifest (TeamRecord.stored_bytes)
+#   plus the announced size of every accepted attachment whose download isn't finished yet
+# A limit of 0 disables it.
+# Lives outside the cog module, so that a hot reload doesn't reset the buckets.
+#
+
+
+def human_size(size: int) -> str:
+    if size >= 1024 ** 3:
+        return f"{size / 1024 ** 3:.1f} GB"
+    return f"{size / 1024 ** 2:.1f} MB"
+
+
+class TokenBucket:
+    def __init__(self, capacity: float, window: float):
+        self.capacity = capacity
+        self.rate = capacity / window
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def __refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """! Seconds until amount tokens are available, 0 if they're available now """
+        self.__refill(now)
+        # a single request larger than the bucket passes once the bucket is full
+        missing = min(amount, self.capacity) - self.tokens
+        return max(missing, 0) / self.rate
+
+    def take(self, amount: float):
+        self.tokens -= min(amount, self.capacity)
+
+
+@dataclass
+class Admission:
+    """! What happens to the attachments of a message """
+    accepted: list = field(default_factory=list)
+    rate_limited: list = field(default_factory=list)
+    over_quota: list = field(default_factory=list)
+    # larger than the download stage accepts, filled in by the caller before admit
+    too_large: list = field(default_factory=list)
+    # seconds until the rate limited attachments would pass
+    retry_after: float = 0
+
+
+class TeamLimiter(metaclass=Singleton):
+    """!
+    Decides which attachments of a team are downloaded.
+    Accepted bytes are reserved right away, so a burst of messages can't overshoot the quota.
+    A reservation ends with the download job (see release), saved images count by their stored size then.
+    """
+
+    def __init__(self,
+                 window: float = TEAM_RATE_WINDOW,
+                 max_attachments: int = TEAM_RATE_ATTACHMENTS,
+                 max_bytes: int = TEAM_RATE_BYTES,
+                 quota_bytes: int = TEAM_QUOTA_BYTES):
+        self.window = window
+        self.max_attachments = max_attachments
+        self.max_bytes = max_bytes
+        self.quota_bytes = quota_bytes
+        # data folder to buckets and to the reserved bytes per manifest key
+        self.attachment_buckets: dict[str, TokenBucket] = {}
+        self.byte_buckets: dict[str, TokenBucket] = {}
+        self.reserved: dict[str, dict[str, int]] = {}
+
+    def usage(self, team_record: TeamRecord) -> int:
+        """! Bytes stored by a team plus the bytes of its accepted, not yet finished downloads """
+        return team_record.stored_bytes + sum(self.reserved.get(team_record.data_folder, {}).values())
+
+    def __buckets(self, team_record: TeamRecord) -> tuple[TokenBucket | None, TokenBucket | None]:
+        key = team_record.data_folder
+        if self.max_attachments and key not in self.attachment_buckets:
+            self.attachment_buckets[key] = TokenBucket(self.max_attachments, self.window)
+        if self.max_bytes and key not in self.byte_buckets:
+            self.byte_buckets[key] = TokenBucket(self.max_bytes, self.window)
+        return self.attachment_buckets.get(key), self.byte_buckets.get(key)
+
+    def admit(self, team_record: TeamRecord, message_id: int, attachments: list[discord.Attachment],
+              live: bool = True) -> Admission:
+        """!
+        Split attachments into the ones that may be downloaded and the ones that exceed a limit
+        @param team_record team that sent the attachments
+        @param message_id message the attachments belong to
+        @param attachments new attachments of the message, in order. Ones that are accepted already are skipped
+        @param live False for the backfill, which is paced by the download queue and only checked against the quota
+        """
+        admission = Admission()
+        attachment_bucket, byte_bucket = self.__buckets(team_record) if live else (None, None)
+        reserved = self.reserved.setdefault(team_record.data_folder, {})
+        used = self.usage(team_record)
+        now = time.monotonic()
+
+        for attachment in attachments:
+            key = TeamRecord.manifest_key(message_id, attachment.id)
+            # delivered twice, the first delivery was accepted and is still being downloaded
+            if key in reserved:
+                continue
+
+            if self.quota_bytes and used + attachment.size > self.quota_bytes:
+                admission.over_quota.append(attachment)
+                continue
+
+            wait = max(attachment_bucket.wait_time(1, now) if attachment_bucket else 0,
+                       byte_bucket.wait_time(attachment.size, now) if byte_bucket else 0)
+            if wait > 0:
+                admission.rate_limited.append(attachment)
+                admission.retry_after = max(admission.retry_after, wait)
+                continue
+
+            if attachment_bucket:
+                attachment_bucket.take(1)
+            if byte_bucket:
+                byte_bucket.take(attachment.size)
+            used += attachment.size
+            reserved[key] = attachment.size
+            admission.accepted.append(attachment)
+
+        if not reserved:
+            del self.reserved[team_record.data_folder]
+        if admission.rate_limited:
+            metrics.submissions_limited.inc(len(admission.rate_limited), reason="rate")
+        if admission.over_quota:
+            metrics.submissions_limited.inc(len(admission.over_quota), reason="quota")
+        return admission
+
+    def release(self, data_folder: str, key: str):
+        """!
+        End the reservation of an accepted attachment, when its download job is done whatever the outcome.
+        A saved image is part of the team's stored bytes by then.
+        """
+        reserved = self.reserved.get(data_folder)
+        if reserved is not None:
+            reserved.pop(key, None)
+            if not reserved:
+                del self.reserved[data_folder]
+
+    def describe(self, admission: Admission, team_record: TeamRecord, max_attachment_bytes: int = 0) -> str:
+        """!
+        DM text that explains why attachments were not saved
+        @param max_attachment_bytes size limit of a single attachment, for admission.too_large
+        """
+        lines = []
+        if admission.too_large:
+            lines.append(
+                f"{len(admission.too_large)} image(s) were **not** saved, "
+                f"files may be at most {human_size(max_attachment_bytes)}.")
+        if admission.over_quota:
+            lines.append(
+                f"Your team reached its storage limit of {human_size(self.quota_bytes)} "
+                f"({human_size(self.usage(team_record))} used), {len(admission.over_quota)} image(s) were **not** saved. "
+                f"Please contact the organizers.")
+        if admission.rate_limited:
+            allowed = " and ".join(part for part in (
+                f"{self.max_attachments} images" if self.max_attachments else "",
+                human_size(self.max_bytes) if self.max_bytes else "") if part)
+            lines.append(
+                f"Slow down - your team may send {allowed} every {self.window:.0f} seconds. "
+                f"{len(admission.rate_limited)} image(s) were **not** saved, "
+                f"please send them again in {admission.retry_after + 1:.0f} seconds.")
+        return "\n".join(lines)
@@ -1,30 +1,163 @@
+import atexit
+import json
 import os
 import logging
+import logging.handlers
+import queue
+import sys
+import time
 
 ### @package log_setup
 #
 # Setup of logging
 #
+# Log calls only put the record into a queue, unformatted. A background thread formats and writes it.
+# So a slow disk never blocks the event loop.
+# Records are only written once the entry point calls start_logging, until then they wait in the queue.
+# The command line tools run next to the bot and only log to the console,
+# the bot's log file is neither written nor rotated by them.
+# Only the bot writes the log file: a process that never starts logging, like the tests, prints the records on exit.
+# The log file is rotated by size and by age, it can be written as json lines for log tooling.
+# This module is loaded before environment, so its settings are read with os.getenv directly:
+#
+# LOG_LEVEL       level of the bot's logger (INFO)
+# LOG_FILE        path of the log file (data/events.log)
+# LOG_FORMAT      'text' or 'json' for the log file, the console always gets text (text)
+# LOG_MAX_BYTES   rotate when the file gets larger, 0 = never (10485760)
+# LOG_ROTATE_HOURS rotate when the file gets older, 0 = never (24)
+# LOG_BACKUPS     number of rotated files to keep (10)
+#
 
 # path for databases or config files
 if not os.path.exists('data/'):
     os.mkdir('data/')
 
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FILE = os.getenv("LOG_FILE", "data/events.log")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_ROTATE_HOURS = float(os.getenv("LOG_ROTATE_HOURS", "24"))
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", "10"))
+
+# fields that can be passed via extra={...} and are written as their own keys in the json format
+context_fields = ("team", "channel", "message_id", "member")
+
+
+class JsonFormatter(logging.Formatter):
+    """!
+    One json object per line, context passed via extra= becomes a field
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "where": f"{record.module}.{record.funcName}",
+            "message": record.getMessage(),
+        }
+        for name in context_fields:
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class RotatingLogFile(logging.handlers.RotatingFileHandler):
+    """!
+    Rotates when the file exceeds max_bytes or is older than max_age seconds, whatever comes first.
+    Rotated files are numbered like events.log.1 (newest) to events.log.<backups>.
+    """
+
+    def __init__(self, filename: str, max_bytes: int, max_age: float, backups: int):
+        # opened with the first record, a process that never logs to the file doesn't touch it
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backups, encoding="utf-8", delay=True)
+        self.max_age = max_age
+        # an existing file counts from its last write, so restarts don't postpone the rotation forever
+        exists = os.path.isfile(filename) and os.path.getsize(filename)
+        opened = os.path.getmtime(filename) if exists else time.time()
+        self.rollover_at = opened + max_age if max_age else None
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if self.rollover_at is not None and time.time() >= self.rollover_at:
+            return True
+        return bool(super().shouldRollover(record))
+
+    def doRollover(self):
+        super().doRollover()
+        if self.max_age:
+            self.rollover_at = time.time() + self.max_age
+
+
+class UnformattedQueueHandler(logging.handlers.QueueHandler):
+    """!
+    Puts the record into the queue as it is.
+    The default prepare formats the message in the calling thread and drops args and exc_info,
+    the handlers of the listener couldn't format them on their own then, e.g. the json exception field.
+    The queue never leaves the process, so the record doesn't have to be picklable.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
 # set logging format
 formatter = logging.Formatter("[{asctime}] [{levelname}] [{module}.{funcName}] {message}", style="{")
 
 # logger for writing to file
-file_logger = logging.FileHandler('data/events.log')
-file_logger.setFormatter(formatter)
+file_logger = RotatingLogFile(LOG_FILE, max_bytes=LOG_MAX_BYTES, max_age=LOG_ROTATE_HOURS * 3600, backups=LOG_BACKUPS)
+file_logger.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else formatter)
 
 # logger for console prints
 console_logger = logging.StreamHandler()
 console_logger.setFormatter(formatter)
 
+# records are handed to a writer thread, the queue is unbounded so logging never blocks
+log_queue = queue.SimpleQueue()
+queue_handler = UnformattedQueueHandler(log_queue)
+log_listener = logging.handlers.QueueListener(log_queue, file_logger, console_logger, respect_handler_level=True)
+listener_started = False
+
 # get new logger
 logger = logging.getLogger('my-bot')
-logger.setLevel(logging.INFO)
+logger.setLevel(LOG_LEVEL)
 
 # register loggers
-logger.addHandler(file_logger)
-logger.addHandler(console_logger)  # discord handles this logger
+logger.addHandler(queue_handler)
+
+
+def start_logging(to_file: bool = True):
+    """!
+    Start writing the queued records, also the ones logged while the modules were imported
+    @param to_file False for the command line tools, they must not write or rotate the log file of the bot
+    """
+    global listener_started
+    if listener_started:
+        return
+    if not to_file:
+        log_listener.handlers = (console_logger,)
+    log_listener.start()
+    listener_started = True
+
+
+def stop_logging():
+    """!
+    Write everything that's still queued on exit.
+    If the entry point never started logging, e.g. tests or a script, the records only go to the console.
+    """
+    if listener_started:
+        log_listener.stop()
+        return
+    # the stream console_logger was created with might be closed by now, e.g. pytest's capture
+    console = logging.StreamHandler(sys.stderr)
+    console.setFormatter(formatter)
+    while True:
+        try:
+            record = log_queue.get_nowait()
+        except queue.Empty:
+            break
+        console.handle(record)
+
+
+atexit.register(stop_logging)
@@ -1,12 +1,17 @@
 #!/bin/env python
 
+import atexit
+
 import discord
 from discord.ext import commands
 
 # setup of logging and env-vars
 # logging must be initialized before environment, to enable logging in environment
-from .log_setup import logger, formatter, console_logger
-from .environment import PREFIX, TOKEN, ACTIVITY_NAME, OWNER_ID
+from .log_setup import logger, formatter, console_logger, start_logging
+from .environment import PREFIX, TOKEN, ACTIVITY_NAME, OWNER_ID, METRICS_HOST, METRICS_PORT, LOOP_STALL_MS
+from . import metrics
+from .command_sync import CommandSyncer
+from .watchdog import LoopWatchdog
 
 """
 This bot is based on a template by nonchris
@@ -29,6 +34,25 @@ class MyBot(commands.Bot):
     def __init__(self, intents: discord.Intents = discord.Intents.all()):
         """ Initialize bot with intents and init super """
         super().__init__(command_prefix=self._prefix_callable, intents=intents)
+        self.command_syncer = CommandSyncer(self.tree)
+        # registered once, cogs are reloaded by /z
+        atexit.register(self.shutdown_cogs)
+
+    def shutdown_cogs(self):
+        """! Let the loaded picture processor write its data on exit, if the bot didn't close before """
+        cog = self.get_cog("PictureProcessor")
+        if cog is not None:
+            cog.shutdown_procedure()
+
+    async def close(self):
+        """! Shut the picture processor down while the event loop still runs, closing unloads all cogs """
+        cog = self.get_cog("PictureProcessor")
+        if cog is not None:
+            try:
+                await cog.shutdown()
+            except Exception as e:
+                logger.error(f"Failed to shut down the picture processor: {e!r}")
+        await super().close()
 
     async def setup_hook(self):
         """!
@@ -36,6 +60,13 @@ class MyBot(commands.Bot):
         This performs an asynchronous setup after the bot is logged in,
         but before it has connected to the Websocket (quoted from d.py docs)
         """
+        metrics.gateway_latency.set_function(lambda: self.latency)
+        if METRICS_PORT:
+            self.metrics_server = metrics.MetricsServer(METRICS_HOST, METRICS_PORT)
+            await self.metrics_server.start()
+        if LOOP_STALL_MS:
+            self.watchdog = LoopWatchdog(threshold=LOOP_STALL_MS / 1000)
+            self.watchdog.start()
 
     # login message
     async def on_ready(self):
@@ -55,19 +86,22 @@ class MyBot(commands.Bot):
         ]
 
         for extension in initial_extensions:
-            await self.load_extension(extension, package=__package__)
+            # on_ready is called again after every reconnect
+            try:
+                await self.load_extension(extension, package=__package__)
+            except commands.ExtensionAlreadyLoaded:
+                pass
 
-        # Walk all guilds, report connected guilds and push commands to guilds
+        # Walk all guilds, report connected guilds
         member_count = 0
         guild_string = ""
         for g in self.guilds:
             guild_string += f"{g.name} - {g.id} - Members: {g.member_count}\n"
             member_count += g.member_count
 
-            # PUSHING Commands
-            # copy all commands to all guilds one after an other
-            # this is inefficient, but a fast way to push new commands to all guilds
-            await self.__sync_commands_to_guild(g)
+        # PUSHING Commands
+        # only to guilds whose commands changed since the last push
+        await self.command_syncer.sync(self.guilds)
 
         logger.info(f"\n---\n"
                     f"Bot '{self.user.name}' has connected, active on {len(self.guilds)} guilds:\n{guild_string}"
@@ -82,24 +116,12 @@ class MyBot(commands.Bot):
         Function called when bot is invited onto a new server
         """
         logger.info(f"Bot joined guild: '{guild.name}'")
-        # try to push slash commands to new server
-        await self.__sync_commands_to_guild(guild)
-
-    async def resync_commands(self):
-        for g in self.guilds:
-            await self.__sync_commands_to_guild(g)
+        # try to push slash commands to new server, it might have been joined before with other commands
+        await self.command_syncer.sync([guild], force=True)
 
-    async def __sync_commands_to_guild(self, guild: discord.Guild):
-        """!
-        Function to push all commands to a guild
-        Doing this for all guilds on startup is is inefficient, but a fast way to push new commands to all guilds
-        """
-        try:
-            self.tree.copy_global_to(guild=guild)
-            await self.tree.sync(guild=guild)
-            logger.info(f"Pushed commands to: {guild.name}")
-        except discord.errors.Forbidden:
-            logger.warning(f"Don't have the permissions to push slash commands to: '{guild.name}'")
+    async def resync_commands(self, force: bool = False):
+        """! Push the commands to all guilds where they changed, or to all guilds with force """
+        await self.command_syncer.sync(self.guilds, force=force)
 
     # inspired by https://github.com/Rapptz/RoboDanny
     # This function will be evaluated for each message
@@ -130,8 +152,8 @@ class MyBot(commands.Bot):
 bot = MyBot()
 
 @bot.tree.command(name="z")
-async def hello(interaction: discord.Interaction, resync: bool = False):
-    """ Admin only. """
+async def hello(interaction: discord.Interaction, resync: bool = False, force_sync: bool = False):
+    """ Admin only. resync pushes changed commands, force_sync pushes them to every guild """
     if interaction.user.id != OWNER_ID:
         logger.warning(f"User {interaction.user} tried /z (unauthorized)")
         return
@@ -146,13 +168,14 @@ async def hello(interaction: discord.Interaction, resync: bool = False):
         await interaction.response.send_message("Done")
         logger.info(f"Reloaded module {module}")
 
-    if resync:
-        await bot.resync_commands()
+    if resync or force_sync:
+        await bot.resync_commands(force=force_sync)
 
 
 # Entrypoint function called from __init__.py
 def start_bot(token=None, log_handler=console_logger, log_formatter=formatter, root_logger=False):
     """ Start the bot, takes token, uses token from env if none is given """
+    start_logging()
     # TODO: Logs from d.py don't appear in the log file (note for the dev, not the template user)
     if token is not None:
         bot.run(token, log_handler=log_handler, log_formatter=log_formatter, root_logger=root_logger)
@@ -0,0 +1,238 @@
+import asyncio
+import bisect
+import math
+import time
+from typing import Callable, Iterable
+
+from discord_bot.log_setup import logger
+
+### @package metrics
+#
+# Counters, gauges and histograms in the Prometheus text format.
+# The instruments are module level, so they keep their values when the cogs are reloaded.
+# If METRICS_PORT is set, a minimal HTTP server on the bot's event loop serves them under /metrics.
+# Everything here is meant to be used from the event loop only.
+#
+
+LabelValues = tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Iterable[str], values: LabelValues, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+
+    def _key(self, labels: dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labels):
+            raise ValueError(f"Metric '{self.name}' needs the labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return "\n".join([f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}",
+                          *self.samples()])
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = ()):
+        super().__init__(name, documentation, labels)
+        self.values: dict[LabelValues, float] = {} if self.labels else {(): 0}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> Iterable[str]:
+        for key, value in self.values.items():
+            yield f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = ()):
+        super().__init__(name, documentation, labels)
+        self.values: dict[LabelValues, float] = {} if self.labels else {(): 0}
+        self.functions: dict[LabelValues, Callable[[], float]] = {}
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def set_function(self, function: Callable[[], float], **labels):
+        """! Read the value when scraped, replaces a previously set function """
+        self.functions[self._key(labels)] = function
+
+    def samples(self) -> Iterable[str]:
+        values = dict(self.values)
+        for key, function in self.functions.items():
+            try:
+                values[key] = function()
+            except Exception as e:
+                logger.debug(f"Can't read gauge '{self.name}': {e!r}")
+        for key, value in values.items():
+            if value is None or (isinstance(value, float) and math.isnan(value)):
+                continue
+            yield f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = (), buckets: Iterable[float] = None):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets if buckets is not None else self.default_buckets)) + (math.inf,)
+        # per label set: count per bucket (not cumulative), sum and count
+        self.values: dict[LabelValues, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        if key not in self.values:
+            self.values[key] = ([0] * len(self.buckets), [0.0, 0])
+        counts, totals = self.values[key]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        totals[0] += value
+        totals[1] += 1
+
+    def samples(self) -> Iterable[str]:
+        for key, (counts, (total, count)) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = 'le="' + _format_value(bound) + '"'
+                yield f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}"
+            yield f"{self.name}_count{_format_labels(self.labels, key)} {count}"
+
+
+class Registry:
+    """!
+    All metrics of the process
+    """
+
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+
+    def __register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric '{metric.name}' is registered already")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: Iterable[str] = ()) -> Counter:
+        return self.__register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: Iterable[str] = ()) -> Gauge:
+        return self.__register(Gauge(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: Iterable[str] = (),
+                  buckets: Iterable[float] = None) -> Histogram:
+        return self.__register(Histogram(name, documentation, labels, buckets))
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics.values()) + "\n"
+
+
+registry = Registry()
+
+messages_received = registry.counter(
+    "bot_messages_received_total", "Messages seen by the bot", ["channel"])
+attachments_downloaded = registry.counter(
+    "bot_attachments_downloaded_total", "Finished attachment downloads", ["result"])
+attachment_bytes = registry.counter(
+    "bot_attachment_bytes_total", "Bytes of saved attachments")
+download_seconds = registry.histogram(
+    "bot_attachment_download_seconds", "Time to stream an attachment to disk, without waiting for a slot")
+download_retries = registry.counter(
+    "bot_download_retries_total", "Failed attempts of queued downloads, by what happened to the job", ["result"])
+submissions_limited = registry.counter(
+    "bot_submissions_limited_total", "Attachments that were not downloaded because of a per team or size limit", ["reason"])
+ack_seconds = registry.histogram(
+    "bot_message_ack_seconds", "Time from a message being sent to its images being saved and acknowledged",
+    buckets=(0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600))
+flush_seconds = registry.histogram(
+    "bot_flush_seconds", "Duration of writing the changed team records")
+backfill_teams = registry.gauge(
+    "bot_backfill_teams", "Teams of the current history walk", ["state"])
+backfill_messages = registry.counter(
+    "bot_backfill_messages_total", "Messages scanned by history walks")
+gateway_latency = registry.gauge(
+    "bot_gateway_latency_seconds", "Latency between a heartbeat and its acknowledgement")
+pipeline_jobs = registry.gauge(
+    "bot_pipeline_jobs", "Jobs waiting in or running through the background stages", ["stage"])
+process_start = registry.gauge(
+    "process_start_time_seconds", "Start time of the process since the epoch")
+process_start.set(time.time())
+
+
+class MetricsServer:
+    """!
+    Serves GET /metrics, runs on the bot's event loop
+    """
+
+    def __init__(self, host: str, port: int, metrics: Registry = registry):
+        self.host = host
+        self.port = port
+        self.metrics = metrics
+        self.server: asyncio.AbstractServer = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.__handle, self.host, self.port)
+        logger.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def __handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # skip the headers, there is no body in a GET
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+                pass
+
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", self.metrics.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not found, try /metrics\n"
+
+            writer.write(f"HTTP/1.1 {status}\r\n"
+                         f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         f"Content-Length: {len(body)}\r\n"
+                         f"Connection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            logger.debug(f"Metrics request failed: {e!r}")
+        finally:
+            writer.close()
@@ -0,0 +1,404 @@
+import argparse
+import glob
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Protocol
+
+from discord_bot.log_setup import logger, start_logging
+from discord_bot.utils import files
+
+### @package persistence
+#
+# Storage backends for the SingletonDatabase.
+# A backend reads and writes plain snapshots of team records (see TeamRecord.snapshot()),
+# it doesn't know anything about discord objects.
+# All methods are blocking, the database calls them from worker threads where it matters.
+#
+# Usage of the one-shot importer from the json layout into sqlite:
+# `python -m discord_bot.persistence import-json --db data/database.sqlite3`
+#
+
+# data folder, content of team_record.json and content of manifest.json
+RecordSnapshot = tuple[str, dict, dict]
+# content of team_record.json and manifest.json, manifest is None if it wasn't stored yet
+LoadedRecord = tuple[dict, dict | None]
+
+CLOSE_PREFIX = "closed_"
+MANIFEST_FILE = "manifest.json"
+
+
+def is_closed(data_folder: str) -> bool:
+    return os.path.basename(data_folder.rstrip("/")).startswith(CLOSE_PREFIX)
+
+
+class Backend(Protocol):
+    def load(self) -> list[LoadedRecord]:
+        """! Load all active teams """
+        ...
+
+    def write(self, snapshots: Iterable[RecordSnapshot]):
+        """! Persist the given snapshots, teams in closed folders are stored as closed """
+        ...
+
+
+class JsonBackend:
+    """!
+    The original layout: one team_record.json and manifest.json per team folder.
+    All active teams are listed in data/teams_index.json, so startup reads one file instead of walking the image folders.
+    """
+
+    index_file = "teams_index.json"
+
+    def __init__(self, root: str = "data", file_name: str = "team_record.json", read_workers: int = 8,
+                 rebuild_index: bool = False, read_only: bool = False):
+        self.root = root
+        self.file_name = file_name
+        self.read_workers = read_workers
+        self.rebuild_index = rebuild_index
+        # for tools that read next to the running bot, a rebuilt index is used but not saved
+        self.read_only = read_only
+        # "<founder>_<creation_time>" to data folder of all active teams
+        self.index: dict[str, str] = None
+
+    @staticmethod
+    def index_key(record: dict) -> str:
+        return f"{record['founder']}_{record['creation_time']}"
+
+    @property
+    def index_path(self) -> str:
+        return f"{self.root}/{self.index_file}"
+
+    def record_files(self, include_closed=False) -> list[str]:
+        """! Find team records by walking the whole data folder, this is slow for many images """
+        paths = []
+        for file_path in glob.glob(f"{self.root}/**/{self.file_name}", recursive=True):
+            # ignore closed teams
+            if not include_closed and CLOSE_PREFIX in file_path:
+                continue
+            paths.append(file_path)
+        return paths
+
+    def scan_index(self) -> dict[str, str]:
+        """!
+        Rebuild the index from the team folders, used for recovery if the index is missing or broken.
+        Team folders are direct children of the data folder, so only those are checked.
+        """
+        index = {}
+        for entry in os.scandir(self.root):
+            if not entry.is_dir() or entry.name.startswith(CLOSE_PREFIX):
+                continue
+            file_path = f"{entry.path}/{self.file_name}"
+            if not os.path.isfile(file_path):
+                continue
+            with open(file_path, "r") as f:
+                record = json.load(f)
+            index[self.index_key(record)] = entry.path
+
+        logger.warning(f"Rebuilt team index from the data folder, found {len(index)} active teams")
+        if not self.read_only:
+            files.write_json_atomic(self.index_path, index, indent=4)
+        return index
+
+    def __load_index(self) -> dict[str, str]:
+        if not self.rebuild_index and os.path.isfile(self.index_path):
+            try:
+                with open(self.index_path, "r") as f:
+                    return json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                logger.error(f"Can't read team index '{self.index_path}', rebuilding it: {e!r}")
+
+        return self.scan_index()
+
+    @staticmethod
+    def read(file_path: str) -> LoadedRecord:
+        with open(file_path, "r") as f:
+            data = json.load(f)
+
+        manifest_path = f"{os.path.dirname(file_path)}/{MANIFEST_FILE}"
+        manifest = None
+        if os.path.isfile(manifest_path):
+            with open(manifest_path, "r") as f:
+                manifest = json.load(f)
+
+        return data, manifest
+
+    def __read_folder(self, data_folder: str) -> LoadedRecord | None:
+        try:
+            return self.read(f"{data_folder}/{self.file_name}")
+        except FileNotFoundError:
+            logger.error(f"Team folder '{data_folder}' is listed in the index but has no record, "
+                         f"rebuild the index if this is unexpected")
+            return None
+
+    def load(self) -> list[LoadedRecord]:
+        self.index = self.__load_index()
+        # mostly waiting for the filesystem, so threads help on network storage
+        with ThreadPoolExecutor(max_workers=self.read_workers) as pool:
+            return [loaded for loaded in pool.map(self.__read_folder, self.index.values()) if loaded is not None]
+
+    def write(self, snapshots: Iterable[RecordSnapshot]):
+        if self.index is None:
+            self.index = self.__load_index()
+
+        index_changed = False
+        for data_folder, record, manifest in snapshots:
+            files.write_json_atomic(f"{data_folder}/{self.file_name}", record, indent=4)
+            files.write_json_atomic(f"{data_folder}/{MANIFEST_FILE}", manifest)
+
+            key = self.index_key(record)
+            if is_closed(data_folder):
+                index_changed |= self.index.pop(key, None) is not None
+            elif self.index.get(key) != data_folder:
+                self.index[key] = data_folder
+                index_changed = True
+
+        if index_changed:
+            files.write_json_atomic(self.index_path, self.index, indent=4)
+
+
+class SqliteBackend:
+    """!
+    All teams in one sqlite database in WAL mode.
+    Each write is a single transaction, so a flush is atomic across all teams.
+    Teams are identified by founder and creation time, the team name is only unique among active teams.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS teams (
+            team_id INTEGER PRIMARY KEY,
+            founder INTEGER NOT NULL,
+            creation_time REAL NOT NULL,
+            team_name TEXT NOT NULL,
+            guild INTEGER NOT NULL,
+            dm_channel INTEGER,
+            data_folder TEXT NOT NULL,
+            last_message_id INTEGER,
+            closed INTEGER NOT NULL DEFAULT 0,
+            UNIQUE (founder, creation_time)
+        );
+        CREATE INDEX IF NOT EXISTS teams_active ON teams (closed);
+
+        CREATE TABLE IF NOT EXISTS memberships (
+            team_id INTEGER NOT NULL REFERENCES teams (team_id),
+            member_id INTEGER NOT NULL,
+            PRIMARY KEY (team_id, member_id)
+        );
+        CREATE INDEX IF NOT EXISTS memberships_member ON memberships (member_id);
+
+        CREATE TABLE IF NOT EXISTS former_members (
+            team_id INTEGER NOT NULL REFERENCES teams (team_id),
+            member_id INTEGER NOT NULL,
+            PRIMARY KEY (team_id, member_id)
+        );
+
+        CREATE TABLE IF NOT EXISTS processed_messages (
+            team_id INTEGER NOT NULL REFERENCES teams (team_id),
+            manifest_key TEXT NOT NULL,
+            message_id INTEGER,
+            attachment_id INTEGER,
+            file TEXT,
+            sha256 TEXT,
+            size INTEGER,
+            author INTEGER,
+            created_at REAL,
+            saved_at REAL,
+            extra TEXT,
+            PRIMARY KEY (team_id, manifest_key)
+        );
+        CREATE INDEX IF NOT EXISTS processed_messages_sha256 ON processed_messages (sha256);
+
+        CREATE TABLE IF NOT EXISTS stored_images (
+            sha256 TEXT PRIMARY KEY,
+            size INTEGER,
+            first_seen REAL
+        );
+    """
+
+    # manifest fields that have their own column, everything else goes to 'extra'
+    manifest_columns = ("file", "sha256", "size", "author", "created_at", "saved_at")
+
+    def __init__(self, path: str = "data/database.sqlite3", read_only: bool = False):
+        self.path = path
+        self.lock = threading.Lock()
+        if read_only:
+            # for tools that read next to the running bot, the database must exist already
+            self.connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False,
+                                              isolation_level=None)
+            return
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(self.schema)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def is_empty(self) -> bool:
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM teams").fetchone()[0] == 0
+
+    def load(self) -> list[LoadedRecord]:
+        with self.lock:
+            cur = self.connection.cursor()
+            teams = cur.execute(
+                "SELECT team_id, founder, creation_time, team_name, guild, dm_channel, data_folder, last_message_id "
+                "FROM teams WHERE closed = 0"
+            ).fetchall()
+
+            loaded = []
+            for team_id, founder, creation_time, team_name, guild, dm_channel, data_folder, last_message_id in teams:
+                members = [row[0] for row in cur.execute(
+                    "SELECT member_id FROM memberships WHERE team_id = ?", (team_id,))]
+                old_members = [row[0] for row in cur.execute(
+                    "SELECT member_id FROM former_members WHERE team_id = ?", (team_id,))]
+
+                manifest = {}
+                for key, *values, extra in cur.execute(
+                        f"SELECT manifest_key, {', '.join(self.manifest_columns)}, extra "
+                        f"FROM processed_messages WHERE team_id = ?", (team_id,)):
+                    entry = dict(zip(self.manifest_columns, values))
+                    if extra:
+                        entry.update(json.loads(extra))
+                    manifest[key] = entry
+
+                record = {
+                    "team_name": team_name,
+                    "founder": founder,
+                    "other_members": [m for m in members if m != founder],
+                    "dm_channel": dm_channel,
+                    "old_members": old_members,
+                    "guild": guild,
+                    "data_folder": data_folder,
+                    "creation_time": creation_time,
+                    "last_message_id": last_message_id,
+                }
+                loaded.append((record, manifest))
+
+        return loaded
+
+    def __write_one(self, cur: sqlite3.Cursor, snapshot: RecordSnapshot):
+        data_folder, record, manifest = snapshot
+        cur.execute(
+            "INSERT INTO teams "
+            "(founder, creation_time, team_name, guild, dm_channel, data_folder, last_message_id, closed) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (founder, creation_time) DO UPDATE SET "
+            "team_name = excluded.team_name, guild = excluded.guild, dm_channel = excluded.dm_channel, "
+            "data_folder = excluded.data_folder, last_message_id = excluded.last_message_id, closed = excluded.closed",
+            (record["founder"], record["creation_time"], record["team_name"], record["guild"], record["dm_channel"],
+             data_folder, record.get("last_message_id"), int(is_closed(data_folder)))
+        )
+        team_id = cur.execute(
+            "SELECT team_id FROM teams WHERE founder = ? AND creation_time = ?",
+            (record["founder"], record["creation_time"])
+        ).fetchone()[0]
+
+        cur.execute("DELETE FROM memberships WHERE team_id = ?", (team_id,))
+        cur.executemany(
+            "INSERT OR IGNORE INTO memberships (team_id, member_id) VALUES (?, ?)",
+            [(team_id, member_id) for member_id in (record["founder"], *record["other_members"])]
+        )
+        cur.executemany(
+            "INSERT OR IGNORE INTO former_members (team_id, member_id) VALUES (?, ?)",
+            [(team_id, member_id) for member_id in record["old_members"]]
+        )
+
+        rows = []
+        images = []
+        for key, entry in manifest.items():
+            message_id, _, attachment_id = key.partition("_")
+            extra = {k: v for k, v in entry.items() if k not in self.manifest_columns}
+            rows.append((
+                team_id, key,
+                int(message_id) if message_id.isdigit() else None,
+                int(attachment_id) if attachment_id.isdigit() else None,
+                *(entry.get(column) for column in self.manifest_columns),
+                json.dumps(extra) if extra else None
+            ))
+            if entry.get("sha256"):
+                images.append((entry["sha256"], entry.get("size"), entry.get("saved_at")))
+
+        cur.executemany(
+            f"INSERT OR REPLACE INTO processed_messages "
+            f"(team_id, manifest_key, message_id, attachment_id, {', '.join(self.manifest_columns)}, extra) "
+            f"VALUES ({', '.join('?' * (len(self.manifest_columns) + 5))})",
+            rows
+        )
+        cur.executemany("INSERT OR IGNORE INTO stored_images (sha256, size, first_seen) VALUES (?, ?, ?)", images)
+
+    def write(self, snapshots: Iterable[RecordSnapshot]):
+        with self.lock:
+            cur = self.connection.cursor()
+            cur.execute("BEGIN")
+            try:
+                for snapshot in snapshots:
+                    self.__write_one(cur, snapshot)
+            except BaseException:
+                cur.execute("ROLLBACK")
+                raise
+            cur.execute("COMMIT")
+
+    def import_json(self, json_backend: JsonBackend) -> int:
+        """!
+        One-shot import of the json layout, closed teams included.
+        Importing twice is harmless, rows are updated in place.
+        @return number of imported teams
+        """
+        snapshots = []
+        for file_path in json_backend.record_files(include_closed=True):
+            record, manifest = json_backend.read(file_path)
+            # the folder might have been moved when the team was closed
+            snapshots.append((os.path.dirname(file_path), record, manifest or {}))
+
+        self.write(snapshots)
+        return len(snapshots)
+
+
+def make_backend(name: str, sqlite_path: str = "data/database.sqlite3", rebuild_index: bool = False) -> Backend:
+    """!
+    Create the configured backend.
+    An empty sqlite database is filled from the json layout, so an existing deployment can just switch over.
+    """
+    if name == "json":
+        return JsonBackend(rebuild_index=rebuild_index)
+
+    if name == "sqlite":
+        backend = SqliteBackend(sqlite_path)
+        if backend.is_empty():
+            start = time.perf_counter()
+            count = backend.import_json(JsonBackend())
+            if count:
+                logger.warning(f"Imported {count} teams from json files into '{sqlite_path}' "
+                               f"in {time.perf_counter() - start:.1f}s")
+        return backend
+
+    raise ValueError(f"Unknown storage backend '{name}', use 'json' or 'sqlite'")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Storage tools for the image submission bot")
+    sub = parser.add_subparsers(dest="command", required=True)
+    import_parser = sub.add_parser("import-json", help="Import the json layout into a sqlite database")
+    import_parser.add_argument("--db", default="data/database.sqlite3", help="sqlite database to write to")
+    import_parser.add_argument("--data", default="data", help="folder containing the team folders")
+    index_parser = sub.add_parser("rebuild-index", help="Rebuild the team index of the json layout by a folder scan")
+    index_parser.add_argument("--data", default="data", help="folder containing the team folders")
+    args = parser.parse_args()
+    start_logging(to_file=False)
+
+    if args.command == "import-json":
+        count = SqliteBackend(args.db).import_json(JsonBackend(root=args.data))
+        print(f"Imported {count} teams into '{args.db}'")
+
+    elif args.command == "rebuild-index":
+        index = JsonBackend(root=args.data).scan_index()
+        print(f"Indexed {len(index)} active teams")
+
+
+if __name__ == '__main__':
+    main()
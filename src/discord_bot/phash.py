@@ -0,0 +1,234 @@
+import asyncio
+import json
+import os
+import threading
+from dataclasses import dataclass
+from typing import Iterator
+
+from discord_bot.database import Singleton, SingletonDatabase, TeamRecord
+from discord_bot.images import has_pillow, perceptual_hash
+from discord_bot.log_setup import logger
+from discord_bot.workers import get_process_pool, pool_size
+
+### @package phash
+#
+# Near-duplicate detection across teams.
+# Every saved submission gets a perceptual hash, computed in the shared process pool.
+# The hashes are kept in a BK-tree for fast hamming distance queries and persisted as append-only json lines,
+# which are loaded in batches on startup.
+#
+
+LOAD_BATCH_SIZE = 5000
+
+
+@dataclass(frozen=True)
+class HashedImage:
+    phash: int
+    sha256: str
+    founder: int
+    team_name: str
+    file: str
+
+    def to_json(self) -> dict:
+        return {"phash": f"{self.phash:016x}", "sha256": self.sha256, "founder": self.founder,
+                "team_name": self.team_name, "file": self.file}
+
+    @staticmethod
+    def from_json(data: dict) -> "HashedImage":
+        return HashedImage(int(data["phash"], 16), data["sha256"], data["founder"], data["team_name"], data["file"])
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    """!
+    Burkhard-Keller tree over 64 bit hashes with the hamming distance as metric.
+    A node is [hash, images with exactly that hash, {distance: child node}]
+    """
+
+    def __init__(self):
+        self.root: list = None
+        self.size = 0
+
+    def add(self, image: HashedImage):
+        self.size += 1
+        if self.root is None:
+            self.root = [image.phash, [image], {}]
+            return
+
+        node = self.root
+        while True:
+            distance = hamming(image.phash, node[0])
+            if distance == 0:
+                node[1].append(image)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [image.phash, [image], {}]
+                return
+            node = child
+
+    def query(self, phash: int, radius: int) -> Iterator[tuple[int, HashedImage]]:
+        """! All images within radius of phash, with their distance """
+        if self.root is None:
+            return
+        stack = [self.root]
+        while stack:
+            node_hash, images, children = stack.pop()
+            distance = hamming(phash, node_hash)
+            if distance <= radius:
+                for image in images:
+                    yield distance, image
+            # triangle inequality: only children in [distance - radius, distance + radius] can match
+            for child_distance, child in children.items():
+                if distance - radius <= child_distance <= distance + radius:
+                    stack.append(child)
+
+    def __iter__(self) -> Iterator[HashedImage]:
+        if self.root is None:
+            return
+        stack = [self.root]
+        while stack:
+            _, images, children = stack.pop()
+            yield from images
+            stack.extend(children.values())
+
+
+class PerceptualIndex(metaclass=Singleton):
+    """!
+    Perceptual hashes of all submissions, queryable by hamming distance
+    """
+
+    def __init__(self, path: str = "data/phash_index.jsonl"):
+        self.path = path
+        self.enabled = has_pillow()
+        if not self.enabled:
+            logger.warning("Pillow is not installed, no perceptual hashes will be computed")
+
+        self.tree = BKTree()
+        # (founder, sha256) of everything in the tree, so nothing is hashed twice
+        self.known: set[tuple[int, str]] = set()
+        # the tree is filled from a worker thread while loading
+        self.lock = threading.Lock()
+        self.loaded = asyncio.Event()
+        self.__load_task: asyncio.Task = None
+        self.tasks: set[asyncio.Task] = set()
+
+    def ensure_loaded(self):
+        if self.__load_task is None:
+            self.__load_task = asyncio.create_task(self.__load())
+
+    def __insert(self, images: list[HashedImage]) -> int:
+        added = 0
+        with self.lock:
+            for image in images:
+                if (image.founder, image.sha256) not in self.known:
+                    self.known.add((image.founder, image.sha256))
+                    self.tree.add(image)
+                    added += 1
+        return added
+
+    def __read_batches(self) -> Iterator[list[HashedImage]]:
+        batch = []
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    batch.append(HashedImage.from_json(json.loads(line)))
+                except (json.JSONDecodeError, KeyError, ValueError):
+                    logger.warning(f"Skipping broken line in '{self.path}'")
+                if len(batch) >= LOAD_BATCH_SIZE:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+    async def __load(self):
+        """! Load the persisted hashes batch by batch, without blocking the event loop """
+        if os.path.isfile(self.path):
+            batches = self.__read_batches()
+            while True:
+                batch = await asyncio.to_thread(next, batches, None)
+                if batch is None:
+                    break
+                await asyncio.to_thread(self.__insert, batch)
+            logger.info(f"Loaded {self.tree.size} perceptual hashes")
+        self.loaded.set()
+
+    def __store(self, image: HashedImage):
+        """! Add a new hash to the tree and the file, blocking since a query may hold the lock """
+        if not self.__insert([image]):
+            return
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a") as f:
+                f.write(json.dumps(image.to_json(), separators=(",", ":")) + "\n")
+
+    async def add(self, team_record: TeamRecord, source: str, sha256: str) -> HashedImage | None:
+        """! Hash an image in a worker process and add it to the index """
+        founder = team_record.founder.id
+        if not self.enabled or (founder, sha256) in self.known:
+            return None
+
+        try:
+            phash = await asyncio.get_running_loop().run_in_executor(get_process_pool(), perceptual_hash, source)
+        except Exception as e:
+            logger.warning(f"Failed to compute perceptual hash of '{source}': {e!r}")
+            return None
+
+        image = HashedImage(phash, sha256, founder, team_record.team_name, source)
+        await self.loaded.wait()
+        await asyncio.to_thread(self.__store, image)
+        return image
+
+    def submit(self, team_record: TeamRecord, source: str, sha256: str):
+        """! Hash an image in the background """
+        if not self.enabled or sha256 is None:
+            return
+        self.ensure_loaded()
+        task = asyncio.create_task(self.add(team_record, source, sha256))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def backfill(self, database: SingletonDatabase) -> int:
+        """! Hash all images of active teams that aren't in the index yet """
+        self.ensure_loaded()
+        await self.loaded.wait()
+
+        pending = [
+            (team_record, f"{team_record.data_folder}/{entry['file']}", entry["sha256"])
+            for team_record in list(database.teams.values())
+            for entry in list(team_record.manifest.values())
+            if entry.get("sha256") and (team_record.founder.id, entry["sha256"]) not in self.known
+        ]
+        # the pool limits the parallelism, gathering in chunks keeps the number of futures small
+        chunk = pool_size() * 4
+        for i in range(0, len(pending), chunk):
+            await asyncio.gather(*(self.add(*args) for args in pending[i:i + chunk]))
+
+        logger.info(f"Computed {len(pending)} missing perceptual hashes")
+        return len(pending)
+
+    def __find_duplicates(self, max_distance: int, active_founders: set[int]) -> list[tuple[int, HashedImage, HashedImage]]:
+        pairs = {}
+        with self.lock:
+            for image in self.tree:
+                if image.founder not in active_founders:
+                    continue
+                for distance, other in self.tree.query(image.phash, max_distance):
+                    if other.founder == image.founder or other.founder not in active_founders:
+                        continue
+                    key = tuple(sorted(((image.founder, image.sha256), (other.founder, other.sha256))))
+                    if key not in pairs:
+                        pairs[key] = (distance, image, other)
+        return sorted(pairs.values(), key=lambda pair: pair[0])
+
+    async def find_cross_team_duplicates(self, max_distance: int, active_founders: set[int]
+                                         ) -> list[tuple[int, HashedImage, HashedImage]]:
+        """!
+        Find pairs of images from different active teams that are (nearly) the same
+        @return (distance, image, other image), closest pairs first
+        """
+        await self.loaded.wait()
+        return await asyncio.to_thread(self.__find_duplicates, max_distance, active_founders)
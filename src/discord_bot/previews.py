@@ -0,0 +1,130 @@
+import asyncio
+import os
+
+from discord_bot.database import Singleton, SingletonDatabase, TeamRecord
+from discord_bot.environment import PREVIEW_THUMB_SIZE, PREVIEW_SIZE, PREVIEW_QUEUE_SIZE
+from discord_bot.images import has_pillow, make_previews
+from discord_bot.log_setup import logger
+from discord_bot.storage import BlobStore
+from discord_bot.workers import get_process_pool, pool_size
+
+### @package previews
+#
+# Background stage that renders thumbnails and previews of all submissions for the judges.
+# Previews are stored by content hash under data/previews/, rendering the same image twice is a no-op.
+# The queue is bounded: live submissions are skipped when it's full (the backfill catches up later),
+# the backfill waits for free space instead.
+#
+
+PREVIEW_QUALITY = 80
+
+
+class PreviewGenerator(metaclass=Singleton):
+    """!
+    Feeds images through a bounded queue into the shared process pool
+    """
+
+    def __init__(self, folder: str = "data/previews", queue_size: int = PREVIEW_QUEUE_SIZE):
+        self.folder = folder
+        self.sizes = {"thumb": PREVIEW_THUMB_SIZE, "preview": PREVIEW_SIZE}
+        self.enabled = has_pillow()
+        if not self.enabled:
+            logger.warning("Pillow is not installed, no thumbnails or previews will be generated")
+
+        # path of the image, its hash if known and a callback that receives the hash
+        self.queue: asyncio.Queue[tuple[str, str | None, callable]] = asyncio.Queue(maxsize=queue_size)
+        self.workers: list[asyncio.Task] = []
+
+        self.rendered = 0
+        self.failed = 0
+        self.skipped = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "queued": self.queue.qsize(),
+            "rendered": self.rendered,
+            "failed": self.failed,
+            "skipped": self.skipped,
+        }
+
+    def __ensure_workers(self):
+        if self.workers:
+            return
+        # one consumer per worker process keeps the pool busy without piling up futures
+        for _ in range(pool_size()):
+            self.workers.append(asyncio.create_task(self.__work()))
+
+    async def __work(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            source, sha256, on_done = await self.queue.get()
+            try:
+                sha256 = await loop.run_in_executor(
+                    get_process_pool(), make_previews, source, sha256, self.folder, self.sizes, PREVIEW_QUALITY
+                )
+                self.rendered += 1
+                if on_done is not None:
+                    on_done(sha256)
+            except Exception as e:
+                self.failed += 1
+                logger.warning(f"Failed to render previews of '{source}': {e!r}")
+            finally:
+                self.queue.task_done()
+
+    def submit(self, source: str, sha256: str | None):
+        """!
+        Queue an image without waiting, used for live submissions
+        @param source path of the image
+        @param sha256 content hash of the image
+        """
+        if not self.enabled:
+            return
+        self.__ensure_workers()
+        try:
+            self.queue.put_nowait((source, sha256, None))
+        except asyncio.QueueFull:
+            self.skipped += 1
+            logger.debug(f"Preview queue is full, skipping '{source}' for now")
+
+    async def enqueue(self, source: str, sha256: str | None, on_done: callable = None):
+        """! Queue an image, waits while the queue is full """
+        if not self.enabled:
+            return
+        self.__ensure_workers()
+        await self.queue.put((source, sha256, on_done))
+
+    async def backfill(self, database: SingletonDatabase, blobs: BlobStore = None) -> int:
+        """!
+        Render previews of everything already on disk.
+        That's every blob in the store and every image of an active team that was saved before the store existed,
+        the hash of those is computed on the way and added to their manifest entry.
+        @return number of queued images
+        """
+        blobs = blobs if blobs is not None else BlobStore()
+        count = 0
+
+        def blob_paths() -> list[tuple[str, str]]:
+            if not os.path.isdir(blobs.root):
+                return []
+            return [(entry.path, entry.name)
+                    for prefix in os.scandir(blobs.root) if prefix.is_dir()
+                    for entry in os.scandir(prefix.path) if entry.is_file()]
+
+        for path, sha256 in await asyncio.to_thread(blob_paths):
+            await self.enqueue(path, sha256)
+            count += 1
+
+        def fill_hash(team_record: TeamRecord, key: str, entry: dict):
+            def on_done(sha256: str):
+                database.update_image(team_record, key, {**entry, "sha256": sha256})
+            return on_done
+
+        for team_record in list(database.teams.values()):
+            for key, entry in list(team_record.manifest.items()):
+                if entry.get("sha256") is None:
+                    await self.enqueue(f"{team_record.data_folder}/{entry['file']}", None,
+                                       fill_hash(team_record, key, entry))
+                    count += 1
+
+        logger.info(f"Queued {count} images for previews")
+        return count
@@ -0,0 +1,105 @@
+import gzip
+import json
+import time
+from typing import IO, Iterator
+
+import discord
+
+from discord_bot.database import Singleton
+from discord_bot.environment import RECORD_EVENTS
+from discord_bot.log_setup import logger
+
+### @package recorder
+#
+# Records the DMs and interactions the bot receives, so an event can be replayed offline (see benchmarks.replay).
+# One json object per line with short keys, the file is gzip compressed if its name ends with .gz.
+# Only ids, sizes and timings are recorded, no message content and no attachment urls.
+#
+# Line format, t is the time in seconds since the recording started:
+# {"k": "h", "v": 1, "started": <unix time>}                 header, starts a recording session
+# {"k": "m", "t", "id", "a": author, "c": channel, "att": [[id, size, content type], ...]}   DM
+# {"k": "r", "t", "u": user, "n": team name, "m": [member ids]}   /register
+# {"k": "l", "t", "u": user}                                  /leave
+# {"k": "w", "t", "u": user}                                  /which_team
+#
+
+FORMAT_VERSION = 1
+
+
+def open_recording(path: str, mode: str) -> IO[str]:
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def read_recording(path: str) -> Iterator[dict]:
+    """!
+    All events of a recording, oldest first.
+    The times of later sessions continue where the previous session ended.
+    """
+    offset = 0.0
+    last = 0.0
+    with open_recording(path, "r") as f:
+        for line_no, line in enumerate(f, 1):
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning(f"Skipping broken line {line_no} of recording '{path}'")
+                continue
+            if event["k"] == "h":
+                offset = last
+                continue
+            event["t"] += offset
+            last = event["t"]
+            yield event
+
+
+class EventRecorder(metaclass=Singleton):
+    """!
+    Appends incoming events to the recording, disabled if RECORD_EVENTS is empty
+    """
+
+    def __init__(self, path: str = RECORD_EVENTS):
+        self.path = path
+        self.enabled = bool(path)
+        self.file: IO[str] = None
+        self.start = time.monotonic()
+        self.recorded = 0
+
+    def __write(self, kind: str, **fields):
+        if self.file is None:
+            # writes are buffered, they only hit the disk every few kilobytes
+            self.file = open_recording(self.path, "a")
+            self.file.write(json.dumps({"k": "h", "v": FORMAT_VERSION, "started": time.time()}) + "\n")
+            logger.info(f"Recording events to '{self.path}'")
+        self.file.write(json.dumps({"k": kind, "t": round(time.monotonic() - self.start, 4), **fields},
+                                   separators=(",", ":")) + "\n")
+        self.recorded += 1
+
+    def message(self, m: discord.Message):
+        if not self.enabled:
+            return
+        self.__write("m", id=m.id, a=m.author.id, c=m.channel.id,
+                     att=[[a.id, a.size, a.content_type] for a in m.attachments])
+
+    def register(self, interaction: discord.Interaction, team_name: str, members: set[discord.Member]):
+        if not self.enabled:
+            return
+        self.__write("r", u=interaction.user.id, n=team_name, m=[m.id for m in members])
+
+    def leave(self, interaction: discord.Interaction):
+        if self.enabled:
+            self.__write("l", u=interaction.user.id)
+
+    def which_team(self, interaction: discord.Interaction):
+        if self.enabled:
+            self.__write("w", u=interaction.user.id)
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
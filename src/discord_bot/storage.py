@@ -0,0 +1,100 @@
+import os
+import shutil
+from typing import IO
+
+from discord_bot.log_setup import logger
+from discord_bot.utils import files
+
+### @package storage
+#
+# Content-addressed store for submitted images.
+# Every image is stored exactly once under data/blobs/<first two hex chars>/<sha256>.
+# The per-team folders contain hardlinks into this store, so they stay browsable as before
+# while byte-identical images take disk space only once.
+#
+
+
+class BlobStore:
+    """!
+    Stores files by the sha256 of their content and links them into the team folders
+    """
+
+    def __init__(self, root: str = "data/blobs"):
+        self.root = root
+
+    def path_for(self, digest: str) -> str:
+        return f"{self.root}/{digest[:2]}/{digest}"
+
+    def store(self, f: IO[bytes], tmp_path: str, digest: str, target: str) -> bool:
+        """!
+        Move a downloaded temp file into the store and link it to target.
+        If the content is already known the temp file is dropped and nothing is written.
+        This is blocking, call it from a worker thread when running on the event loop.
+
+        @param f open handle of the temp file
+        @param tmp_path path of the temp file
+        @param digest sha256 hex digest of the content
+        @param target path in the team folder the image shall be visible under
+        @return True if the content was new to the store
+        """
+        blob = self.path_for(digest)
+        if os.path.isfile(blob):
+            files.discard_temp_file(f, tmp_path)
+            is_new = False
+        else:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            files.commit_temp_file(f, tmp_path, blob)
+            is_new = True
+
+        self.link(blob, target)
+        return is_new
+
+    def store_file(self, tmp_path: str, digest: str, target: str) -> bool:
+        """!
+        Like store(), for a temp file that is already closed and synced
+        @return True if the content was new to the store
+        """
+        blob = self.path_for(digest)
+        if os.path.isfile(blob):
+            os.remove(tmp_path)
+            is_new = False
+        else:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            os.replace(tmp_path, blob)
+            is_new = True
+
+        self.link(blob, target)
+        return is_new
+
+    def release(self, digest: str, target: str):
+        """!
+        Remove an image from a team folder and drop the blob if no team links it anymore
+        """
+        try:
+            os.remove(target)
+        except FileNotFoundError:
+            pass
+
+        blob = self.path_for(digest)
+        try:
+            if os.stat(blob).st_nlink == 1:
+                os.remove(blob)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def link(blob: str, target: str):
+        """! Make the blob visible under target, falls back to copying if hardlinks aren't supported """
+        if os.path.exists(target):
+            return
+
+        try:
+            os.link(blob, target)
+        except FileExistsError:
+            pass
+        except OSError as e:
+            logger.warning(f"Can't hardlink '{blob}' to '{target}', copying instead: {e!r}")
+            f, tmp_path = files.open_temp_file(target)
+            with open(blob, "rb") as src:
+                shutil.copyfileobj(src, f)
+            files.commit_temp_file(f, tmp_path, target)
@@ -0,0 +1,112 @@
+import asyncio
+import os
+
+from discord_bot.database import Singleton, SingletonDatabase, TeamRecord
+from discord_bot.environment import TRANSCODE_FORMAT, TRANSCODE_QUALITY, TRANSCODE_MIN_BYTES
+from discord_bot.images import has_pillow, transcode, pillow_formats
+from discord_bot.log_setup import logger
+from discord_bot.phash import PerceptualIndex
+from discord_bot.previews import PreviewGenerator
+from discord_bot.storage import BlobStore
+from discord_bot.workers import get_process_pool, pool_size
+
+### @package transcoding
+#
+# Optional background stage that re-encodes large submissions to a smaller format.
+# The encoding runs in the shared process pool, the message is acknowledged long before.
+# The original is replaced in the team folder and dropped from the blob store once no team links it anymore.
+# Images it takes are handed to the previews and perceptual hashes only once it's done, so nothing reads a removed original.
+#
+
+# animations would be lost
+skipped_extensions = {"gif"}
+
+
+class Transcoder(metaclass=Singleton):
+    """!
+    Re-encodes saved images in worker processes, disabled if TRANSCODE_FORMAT is empty
+    """
+
+    def __init__(self, database: SingletonDatabase, blobs: BlobStore = None,
+                 extension: str = TRANSCODE_FORMAT, quality: int = TRANSCODE_QUALITY, min_bytes: int = TRANSCODE_MIN_BYTES):
+        self.database = database
+        self.blobs = blobs if blobs is not None else BlobStore()
+        self.extension = extension.lower().lstrip(".")
+        self.quality = quality
+        self.min_bytes = min_bytes
+        self.enabled = bool(self.extension)
+
+        if self.enabled and self.extension not in pillow_formats:
+            logger.error(f"Can't transcode to '{self.extension}', use one of {list(pillow_formats)}. Transcoding is off")
+            self.enabled = False
+        if self.enabled and not has_pillow():
+            logger.error("Transcoding needs Pillow to be installed. Transcoding is off")
+            self.enabled = False
+
+        # keep the pool's queue short, waiting tasks are cheap
+        self.limit = asyncio.Semaphore(pool_size() * 2) if self.enabled else None
+        self.tasks: set[asyncio.Task] = set()
+        self.saved_bytes = 0
+
+    def submit(self, team_record: TeamRecord, key: str, entry: dict) -> bool:
+        """!
+        Queue a saved image for transcoding if it's worth it
+        @param team_record team the image belongs to
+        @param key manifest key of the image
+        @param entry manifest entry of the image
+        @return True if the image is transcoded, its final file goes to the previews and hashes afterwards
+        """
+        if not self.enabled or entry.get("sha256") is None or entry.get("size", 0) < self.min_bytes:
+            return False
+
+        current = os.path.splitext(entry["file"])[1].lstrip(".").lower()
+        if current in skipped_extensions or pillow_formats.get(current) == pillow_formats[self.extension]:
+            return False
+
+        task = asyncio.create_task(self.__transcode(team_record, key, entry))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return True
+
+    @staticmethod
+    def __fan_out(team_record: TeamRecord, path: str, sha256: str):
+        PreviewGenerator().submit(path, sha256)
+        PerceptualIndex().submit(team_record, path, sha256)
+
+    async def __transcode(self, team_record: TeamRecord, key: str, entry: dict):
+        data_folder = team_record.data_folder
+        source = f"{data_folder}/{entry['file']}"
+
+        async with self.limit:
+            try:
+                tmp_path, sha256, size = await asyncio.get_running_loop().run_in_executor(
+                    get_process_pool(), transcode, source, data_folder, self.extension, self.quality
+                )
+            except Exception as e:
+                logger.warning(f"Failed to transcode '{source}', keeping the original: {e!r}")
+                self.__fan_out(team_record, source, entry["sha256"])
+                return
+
+        if size >= entry["size"]:
+            logger.debug(f"Transcoding '{source}' doesn't save space, keeping the original")
+            await asyncio.to_thread(os.remove, tmp_path)
+            self.__fan_out(team_record, source, entry["sha256"])
+            return
+
+        new_file = f"{os.path.splitext(entry['file'])[0]}.{self.extension}"
+        await asyncio.to_thread(self.blobs.store_file, tmp_path, sha256, f"{data_folder}/{new_file}")
+
+        # the manifest points to the new file before the original is removed
+        self.database.update_image(team_record, key, {
+            **entry,
+            "file": new_file,
+            "size": size,
+            "sha256": sha256,
+            "original_sha256": entry["sha256"],
+            "original_size": entry["size"],
+        })
+        await asyncio.to_thread(self.blobs.release, entry["sha256"], source)
+        self.__fan_out(team_record, f"{data_folder}/{new_file}", sha256)
+
+        self.saved_bytes += entry["size"] - size
+        logger.info(f"Transcoded '{source}' to {self.extension}: {entry['size']} -> {size} bytes")
@@ -0,0 +1,56 @@
+import json
+import os
+import tempfile
+from typing import IO
+
+### @package files
+#
+# Helpers for crash safe file handling.
+# A file is always written to a temporary file in the target folder first and then renamed into place.
+# A crash can therefore never leave a truncated file under the final name.
+#
+
+
+def open_temp_file(target: str) -> tuple[IO[bytes], str]:
+    """!
+    Open a hidden temporary file next to target for binary writing
+    @param target final path the file will be renamed to
+    @return open file handle and its path
+    """
+    folder, name = os.path.split(target)
+    fd, tmp_path = tempfile.mkstemp(dir=folder or ".", prefix=f".{name}.", suffix=".part")
+    return os.fdopen(fd, "wb"), tmp_path
+
+
+def commit_temp_file(f: IO[bytes], tmp_path: str, target: str):
+    """!
+    Flush and fsync an open temp file, then atomically rename it to target.
+    This is blocking, call it from a worker thread when running on the event loop.
+    """
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    os.replace(tmp_path, target)
+
+
+def discard_temp_file(f: IO[bytes], tmp_path: str):
+    """! Close and remove a temp file that won't be committed """
+    f.close()
+    try:
+        os.remove(tmp_path)
+    except FileNotFoundError:
+        pass
+
+
+def write_json_atomic(path: str, data, **dump_kwargs):
+    """!
+    Write data as json to path via temp file + fsync + rename.
+    This is blocking, call it from a worker thread when running on the event loop.
+    """
+    f, tmp_path = open_temp_file(path)
+    try:
+        f.write(json.dumps(data, **dump_kwargs).encode())
+        commit_temp_file(f, tmp_path, path)
+    except BaseException:
+        discard_temp_file(f, tmp_path)
+        raise
@@ -0,0 +1,96 @@
+import asyncio
+import sys
+import threading
+import time
+import traceback
+
+from discord_bot import metrics
+from discord_bot.log_setup import logger
+
+### @package watchdog
+#
+# Detects blocking calls on the event loop.
+# A task on the loop beats every few milliseconds, a thread watches the beats.
+# If the loop doesn't beat for longer than the threshold, the thread logs the stack the loop thread is stuck in.
+# Lag and stalls are reported to the metrics once the loop is running again.
+#
+
+loop_lag = metrics.registry.histogram(
+    "bot_event_loop_lag_seconds", "Delay of the watchdog's wakeups on the event loop",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5))
+loop_stalls = metrics.registry.counter(
+    "bot_event_loop_stalls_total", "Times the event loop was blocked longer than the stall threshold")
+loop_stall_seconds = metrics.registry.histogram(
+    "bot_event_loop_stall_seconds", "Duration of event loop stalls",
+    buckets=(0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+
+
+class LoopWatchdog:
+    """!
+    Measures the lag of the event loop and reports what blocks it
+    """
+
+    def __init__(self, threshold: float, interval: float = 0.05, stack_limit: int = 30):
+        """!
+        @param threshold seconds without a beat until the loop counts as stalled
+        @param interval seconds between two beats
+        @param stack_limit max. number of frames to log
+        """
+        self.threshold = threshold
+        self.interval = interval
+        self.stack_limit = stack_limit
+
+        self.loop_thread_id: int = None
+        self.last_beat = time.monotonic()
+        # set by the watcher thread, picked up by the loop when it runs again
+        self.stalled_since: float | None = None
+
+        self.__task: asyncio.Task = None
+        self.__stop = threading.Event()
+        self.__thread: threading.Thread = None
+
+    def start(self):
+        """! Start watching the running loop, call this from the loop """
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self.__task = asyncio.create_task(self.__beat())
+        self.__thread = threading.Thread(target=self.__watch, name="loop-watchdog", daemon=True)
+        self.__thread.start()
+        logger.info(f"Watching the event loop for stalls longer than {self.threshold * 1000:.0f}ms")
+
+    def stop(self):
+        self.__stop.set()
+        if self.__task is not None:
+            self.__task.cancel()
+
+    async def __beat(self):
+        while True:
+            before = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.last_beat = now
+            loop_lag.observe(max(now - before - self.interval, 0))
+
+            stalled_since = self.stalled_since
+            if stalled_since is not None:
+                self.stalled_since = None
+                loop_stalls.inc()
+                loop_stall_seconds.observe(now - stalled_since)
+                logger.warning(f"Event loop was blocked for {(now - stalled_since) * 1000:.0f}ms")
+
+    def __stack(self) -> str:
+        frame = sys._current_frames().get(self.loop_thread_id)
+        if frame is None:
+            return "  <loop thread is gone>\n"
+        return "".join(traceback.format_stack(frame, limit=self.stack_limit))
+
+    def __watch(self):
+        while not self.__stop.wait(self.interval):
+            last_beat = self.last_beat
+            if self.stalled_since is not None or time.monotonic() - last_beat < self.threshold:
+                continue
+
+            # only one report per stall, the loop resets it on its next beat
+            self.stalled_since = last_beat
+            logger.warning(f"Event loop is blocked for more than {self.threshold * 1000:.0f}ms, "
+                           f"it's stuck in:\n{self.__stack()}")
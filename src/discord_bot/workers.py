@@ -0,0 +1,28 @@
+import atexit
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from discord_bot.environment import IMAGE_WORKERS
+from discord_bot.log_setup import logger
+
+### @package workers
+#
+# Process pool for CPU heavy image work, shared by all background stages.
+# It's created on first use and lives in this module, so that reloading a cog doesn't spawn a new pool.
+#
+
+_pool: ProcessPoolExecutor = None
+
+
+def pool_size() -> int:
+    """! Number of worker processes of the pool, without starting it """
+    return IMAGE_WORKERS or os.cpu_count() or 1
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=pool_size())
+        atexit.register(_pool.shutdown, wait=False, cancel_futures=True)
+        logger.info(f"Started process pool with {pool_size()} workers for image processing")
+    return _pool
@@ -0,0 +1,75 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+# the package lives in src/, the fakes of the benchmarks are reused
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(root, "src"), root]
+
+from benchmarks.fakes import FakeAttachment, FakeBot, FakeDMChannel, FakeGuild, FakeMember, FakeMessage, snowflakes  # noqa: E402
+from discord_bot.database import Singleton, SingletonDatabase, TeamRecord  # noqa: E402
+from discord_bot.download_queue import DownloadJob, DownloadQueue  # noqa: E402
+from discord_bot.downloads import NotAnImage, SavedAttachment  # noqa: E402
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """! Run in an empty folder with fresh singletons, everything is written to data/ relative to it """
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("data")
+    Singleton._instances.clear()
+    yield tmp_path
+    Singleton._instances.clear()
+
+
+class StubDownloads:
+    """! Saves every attachment after 'save_delay' seconds, the ones in not_images fail after 'delay' seconds """
+
+    def __init__(self, not_images: set[int] = (), delay: float = 0, save_delay: float = 0):
+        self.not_images = set(not_images)
+        self.delay = delay
+        self.save_delay = save_delay
+        self.calls = 0
+
+    async def download(self, team_record, attachment, file_base) -> SavedAttachment:
+        self.calls += 1
+        await asyncio.sleep(self.save_delay)
+        if attachment.id in self.not_images:
+            await asyncio.sleep(self.delay)
+            raise NotAnImage(f"Attachment {attachment.id} isn't an image")
+        return SavedAttachment(file_name=f"{file_base}.png", extension="png", sha256=str(attachment.id),
+                               size=attachment.size, deduplicated=False)
+
+
+async def setup_team(downloads: StubDownloads, **options) -> tuple[SingletonDatabase, TeamRecord, DownloadQueue]:
+    bot = FakeBot(FakeGuild(1))
+    database = SingletonDatabase(bot)
+    database.ensure_loaded()
+    await database.wait_until_ready()
+
+    founder = FakeMember(snowflakes.next(), "founder", bot.guild)
+    channel = FakeDMChannel(snowflakes.next(), founder)
+    team_record = TeamRecord(team_name="team", founder=founder, other_members=set(), dm_channel=channel)
+    team_record.data_folder = f"data/{channel.id}"
+    database.add_record(team_record)
+
+    queue = DownloadQueue(database, downloads, path="data/download_queue.sqlite3", retry_seconds=0.05, **options)
+    queue.on_saved = lambda t, job, saved: database.record_image(
+        t, job.message_id, job.attachment_id, saved.file_name, saved.size, saved.sha256, job.author_id, job.created)
+    queue.ensure_started()
+    return database, team_record, queue
+
+
+def send(team_record: TeamRecord, attachments: int, live: bool = True) -> tuple[FakeMessage, list[DownloadJob]]:
+    message = FakeMessage(team_record.founder, team_record.dm_channel,
+                          [FakeAttachment(snowflakes.next(), "http://cdn/", 10) for _ in range(attachments)])
+    team_record.dm_channel.messages.append(message)
+    return message, [DownloadJob.from_attachment(team_record, message, a, live=live) for a in message.attachments]
+
+
+async def close(database: SingletonDatabase, queue: DownloadQueue):
+    await queue.stop()
+    queue.close()
+    database.journal.close()
@@ -0,0 +1,76 @@
+import asyncio
+
+from conftest import StubDownloads, close, send, setup_team
+
+
+def test_message_is_acknowledged_if_a_non_image_finishes_last(workdir):
+    async def run():
+        downloads = StubDownloads(delay=0.1)
+        database, team_record, queue = await setup_team(downloads)
+        message, jobs = send(team_record, 2)
+        downloads.not_images.add(message.attachments[1].id)
+        await queue.enqueue(jobs)
+        await asyncio.wait_for(queue.wait_until_idle(), 5)
+
+        assert message.reactions == ["✅"]
+        assert list(team_record.manifest) == [jobs[0].key]
+
+        # nothing was saved, nothing to acknowledge
+        only_video, jobs = send(team_record, 1)
+        downloads.not_images.add(only_video.attachments[0].id)
+        await queue.enqueue(jobs)
+        await asyncio.wait_for(queue.wait_until_idle(), 5)
+        assert only_video.reactions == []
+        await close(database, queue)
+
+    asyncio.run(run())
+
+
+def test_dispatcher_survives_queue_errors(workdir):
+    async def run():
+        downloads = StubDownloads()
+        database, team_record, queue = await setup_team(downloads)
+        await asyncio.wait_for(queue.wait_until_resumed(), 5)
+
+        claim = queue.store.claim
+        failures = []
+
+        def failing_claim(*args):
+            if not failures:
+                failures.append(True)
+                raise OSError("database is locked")
+            return claim(*args)
+
+        queue.store.claim = failing_claim
+        message, jobs = send(team_record, 1)
+        await queue.enqueue(jobs)
+        await asyncio.wait_for(queue.wait_until_idle(), 5)
+
+        assert failures and message.reactions == ["✅"]
+        assert not queue.dispatcher.done()
+        await close(database, queue)
+
+    asyncio.run(run())
+
+
+def test_backfill_leaves_room_for_live_jobs(workdir):
+    async def run():
+        downloads = StubDownloads(save_delay=0.2)
+        database, team_record, queue = await setup_team(downloads, max_backfill=2)
+        await asyncio.wait_for(queue.wait_until_resumed(), 5)
+        _, backfill = send(team_record, 10, live=False)
+        await queue.enqueue(backfill)
+        await asyncio.sleep(0.05)
+        assert len(queue.in_flight) == 2
+
+        # started right away, not after the backfill that's waiting on disk
+        live, jobs = send(team_record, 1)
+        await queue.enqueue(jobs)
+        await asyncio.sleep(0.05)
+        assert jobs[0].key in queue.in_flight and len(queue.in_flight) == 3
+
+        await asyncio.wait_for(queue.wait_until_idle(), 5)
+        assert live.reactions == ["✅"] and len(team_record.manifest) == 11
+        await close(database, queue)
+
+    asyncio.run(run())
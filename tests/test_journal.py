@@ -0,0 +1,147 @@
+import asyncio
+import json
+import threading
+
+from benchmarks.fakes import FakeBot, FakeDMChannel, FakeGuild, FakeMember, snowflakes
+from discord_bot.database import SingletonDatabase, TeamRecord
+from discord_bot.journal import read_entries, replay
+
+
+def record(founder: int, creation_time: float, name: str, folder: str) -> dict:
+    return {"team_name": name, "founder": founder, "other_members": [], "dm_channel": 1, "old_members": [],
+            "guild": 1, "data_folder": folder, "creation_time": creation_time, "last_message_id": None}
+
+
+def test_replay_keeps_later_team_of_same_founder():
+    a = record(7, 100.0, "A", "data/1")
+    b = record(7, 200.0, "B", "data/2")
+    entries = [
+        {"op": "add_team", "record": a},
+        {"op": "image_saved", "founder": 7, "creation_time": 100.0, "key": "1_1", "entry": {"file": "1_1.png"}},
+        {"op": "delete_team", "founder": 7, "creation_time": 100.0, "data_folder": "data/closed_1"},
+        {"op": "add_team", "record": b},
+    ]
+    # the snapshot contains B already, replaying must not close it
+    active, retired, changed = replay([(dict(b), {"2_2": {"file": "2_2.png"}})], iter(entries))
+
+    assert [(data["team_name"], manifest) for data, manifest in active] == [("B", {"2_2": {"file": "2_2.png"}})]
+    assert [(folder, data["team_name"], manifest) for folder, data, manifest in retired] == \
+           [("data/closed_1", "A", {"1_1": {"file": "1_1.png"}})]
+    assert changed == {(7, 100.0), (7, 200.0)}
+
+
+def test_replay_is_idempotent():
+    a = record(7, 100.0, "A", "data/1")
+    entries = [
+        {"op": "add_team", "record": a},
+        {"op": "remove_member", "founder": 7, "creation_time": 100.0, "member": 8, "data_folder": "data/1"},
+        {"op": "checkpoint", "founder": 7, "creation_time": 100.0, "message_id": 5},
+        {"op": "checkpoint", "founder": 7, "creation_time": 100.0, "message_id": 3},
+    ]
+    with_member = dict(a, other_members=[8])
+    once, _, _ = replay([(with_member, {})], iter(entries))
+    twice, _, _ = replay(once, iter(entries))
+    assert once == twice
+    data, _ = twice[0]
+    assert data["other_members"] == [] and data["old_members"] == [8] and data["last_message_id"] == 5
+
+
+def test_replay_of_entries_without_creation_time():
+    # written before the creation time was journaled, they belong to the active team of the founder
+    a = record(7, 100.0, "A", "data/1")
+    entries = [{"op": "checkpoint", "founder": 7, "message_id": 5},
+               {"op": "delete_team", "founder": 7, "data_folder": "data/closed_1"}]
+    active, retired, _ = replay([(a, {})], iter(entries))
+    assert active == [] and retired[0][0] == "data/closed_1" and retired[0][1]["last_message_id"] == 5
+
+
+class GatedBackend:
+    """! Blocks every write until released, then fails the first 'failures' writes """
+
+    def __init__(self, failures: int):
+        self.failures = failures
+        self.gate = threading.Event()
+        self.writing = threading.Event()
+        self.written: dict[str, dict] = {}
+
+    def load(self):
+        return []
+
+    def write(self, snapshots):
+        self.writing.set()
+        self.gate.wait(5)
+        if self.failures:
+            self.failures -= 1
+            raise OSError("disk full")
+        for folder, data, manifest in snapshots:
+            self.written[folder] = data
+
+
+def add_team(database: SingletonDatabase, bot: FakeBot) -> TeamRecord:
+    founder = FakeMember(snowflakes.next(), "founder", bot.guild)
+    channel = FakeDMChannel(snowflakes.next(), founder)
+    team_record = TeamRecord(team_name="team", founder=founder, other_members=set(), dm_channel=channel)
+    team_record.data_folder = f"data/{channel.id}"
+    database.add_record(team_record)
+    return team_record
+
+
+def journaled_ops(database: SingletonDatabase) -> list[str]:
+    database.journal.sync()
+    return [entry["op"] for entry in read_entries(database.journal.folder)]
+
+
+async def concurrent_flushes(backend: GatedBackend):
+    bot = FakeBot(FakeGuild(1))
+    database = SingletonDatabase(bot, backend=backend)
+    database.ensure_loaded()
+    await database.wait_until_ready()
+    team_record = add_team(database, bot)
+
+    first = asyncio.create_task(database.flush_dirty_records())
+    await asyncio.to_thread(backend.writing.wait, 5)
+    second = asyncio.create_task(database.flush_dirty_records())
+    await asyncio.sleep(0.2)
+    # the second flush waits for the first one, nothing is compacted while the write is in flight
+    assert "add_team" in journaled_ops(database)
+
+    backend.gate.set()
+    results = await asyncio.gather(first, second, return_exceptions=True)
+    return database, team_record, results
+
+
+def test_failed_write_keeps_journal_until_written(workdir):
+    backend = GatedBackend(failures=1)
+    database, team_record, results = asyncio.run(concurrent_flushes(backend))
+
+    assert isinstance(results[0], OSError) and results[1] is None
+    assert team_record.data_folder in backend.written
+    assert not team_record.dirty
+    assert journaled_ops(database) == []
+    database.journal.close()
+
+
+def test_failing_writes_never_compact(workdir):
+    backend = GatedBackend(failures=2)
+    database, team_record, results = asyncio.run(concurrent_flushes(backend))
+
+    assert all(isinstance(result, OSError) for result in results)
+    assert team_record.dirty
+    assert journaled_ops(database) == ["add_team"]
+
+    # the synchronous flush on shutdown takes the same lock and writes the team
+    database.save_or_update_records()
+    assert team_record.data_folder in backend.written
+    assert journaled_ops(database) == []
+    database.journal.close()
+
+
+def test_reading_skips_segments_compacted_meanwhile(tmp_path):
+    for segment in (1, 2):
+        (tmp_path / f"journal.{segment:08d}.jsonl").write_text(json.dumps({"op": "checkpoint", "segment": segment}) + "\n")
+
+    skipped = []
+    entries = read_entries(str(tmp_path), skipped)
+    assert next(entries)["segment"] == 1
+    (tmp_path / "journal.00000002.jsonl").unlink()
+    assert list(entries) == [] and skipped == [2]
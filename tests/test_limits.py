@@ -0,0 +1,45 @@
+import asyncio
+
+from discord_bot.limits import Admission, TeamLimiter
+from conftest import StubDownloads, close, send, setup_team
+
+
+def test_quota_follows_the_download_outcome(workdir):
+    async def run():
+        downloads = StubDownloads()
+        database, team_record, queue = await setup_team(downloads)
+        limiter = TeamLimiter(window=60, max_attachments=0, max_bytes=0, quota_bytes=25)
+        queue.on_finished = lambda job: limiter.release(job.data_folder, job.key)
+
+        message, jobs = send(team_record, 2)
+        downloads.not_images.add(message.attachments[1].id)
+        admission = limiter.admit(team_record, message.id, message.attachments)
+        assert len(admission.accepted) == 2 and limiter.usage(team_record) == 20
+
+        # delivered again while queued, not charged twice
+        again = limiter.admit(team_record, message.id, message.attachments)
+        assert again.accepted == [] and again.over_quota == []
+
+        await queue.enqueue(jobs)
+        await asyncio.wait_for(queue.wait_until_idle(), 5)
+        # only the saved image is left, the non-image gave its bytes back
+        assert limiter.usage(team_record) == team_record.stored_bytes == 10
+        assert limiter.reserved == {}
+
+        # transcoding shrinks the stored size
+        key = jobs[0].key
+        database.update_image(team_record, key, dict(team_record.manifest[key], size=4))
+        assert limiter.usage(team_record) == 4
+        assert await queue.queued([key, "1_2"]) == set()
+        await close(database, queue)
+
+    asyncio.run(run())
+
+
+def test_one_message_explains_all_refusals(workdir):
+    limiter = TeamLimiter(window=60, max_attachments=1, max_bytes=0, quota_bytes=0)
+    admission = Admission(rate_limited=["a"], too_large=["b", "c"], retry_after=5)
+    text = limiter.describe(admission, team_record=None, max_attachment_bytes=25 * 1024 ** 2)
+
+    assert "2 image(s) were **not** saved, files may be at most 25.0 MB." in text
+    assert "Slow down" in text
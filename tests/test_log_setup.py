@@ -0,0 +1,17 @@
+import json
+import logging
+import sys
+
+from discord_bot.log_setup import JsonFormatter, queue_handler
+
+
+def test_queued_record_keeps_exception_for_the_json_file():
+    try:
+        raise ValueError("broken")
+    except ValueError:
+        record = logging.getLogger("test").makeRecord("test", logging.ERROR, __file__, 1, "failed %s", ("job",),
+                                                      exc_info=sys.exc_info())
+    entry = json.loads(JsonFormatter().format(queue_handler.prepare(record)))
+
+    assert entry["message"] == "failed job"
+    assert "ValueError: broken" in entry["exception"]